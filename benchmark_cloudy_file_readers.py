@@ -0,0 +1,118 @@
+# Imports
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from time import perf_counter
+
+from cloudy_file_readers import read_columns, read_converged_iteration
+from make_synthetic_grid import EM_STR_COLUMNS, OVR_COLUMNS
+
+
+################################################################################
+# Global variables
+
+NUMBER_OF_ZONES = 4000 # set nend 4000
+NUMBER_OF_ITERATIONS = 3 # iterate to converge
+NUMBER_OF_REPEATS = 10
+################################################################################
+
+
+# Main
+def main():
+
+    with tempfile.TemporaryDirectory() as directory:
+        em_str_file_path, ovr_file_path = write_files(directory)
+
+        print(f"_em.str: {os.path.getsize(em_str_file_path) / 1e6:.2f} MB, .ovr: {os.path.getsize(ovr_file_path) / 1e6:.2f} MB")
+
+        time_current = best_time(lambda: np.loadtxt(fname=em_str_file_path))
+        print_result("_em.str np.loadtxt (current)", time_current, time_current)
+        # The intensity script parses all columns (every line of the catalog), which is not faster than np.loadtxt. Only reading fewer columns
+        # is faster.
+        print_result(
+            "_em.str read_columns, all columns",
+            best_time(lambda: read_columns(em_str_file_path)),
+            time_current
+        )
+        print_result(
+            "_em.str read_columns, 2 columns",
+            best_time(lambda: read_columns(em_str_file_path, columns=[0, 13])),
+            time_current
+        )
+
+        # Path of the intensity script: all columns of the converged iteration. The speedup comes from not parsing the earlier iterations,
+        # so it grows with the number of iterations.
+        time_current = best_time(lambda: find_converged_run_loop(np.loadtxt(fname=em_str_file_path)))
+        print_result("_em.str loadtxt + loop (current)", time_current, time_current)
+        print_result(
+            "_em.str read_converged_iteration",
+            best_time(lambda: read_converged_iteration(em_str_file_path)),
+            time_current
+        )
+
+        time_current = best_time(lambda: pd.read_csv(ovr_file_path, sep=r"\s+"))
+        print_result(".ovr pd.read_csv (current)", time_current, time_current)
+        print_result(
+            ".ovr read_columns, 4 columns",
+            best_time(lambda: read_columns(ovr_file_path, columns=["depth", "hden", "2H_2/H", "CO/C"])),
+            time_current
+        )
+
+    return 0
+
+
+# Functions
+
+def write_files(directory):
+    # Writes an _em.str file with NUMBER_OF_ITERATIONS iterations and a .ovr file with NUMBER_OF_ZONES zones
+
+    rng = np.random.default_rng(seed=0)
+    depth = np.sort(rng.uniform(1e10, 3e18, NUMBER_OF_ZONES))
+
+    em_str_file_path = f"{directory}/benchmark_em.str"
+    with open(em_str_file_path, "w") as file:
+        file.write("\t".join(EM_STR_COLUMNS) + "\n")
+        for iteration in range(NUMBER_OF_ITERATIONS):
+            if iteration > 0:
+                file.write("#" * 40 + "\n")
+            emissivities = 10**rng.uniform(-30, -15, size=(NUMBER_OF_ZONES, len(EM_STR_COLUMNS) - 1))
+            np.savetxt(file, np.column_stack([depth, emissivities]), fmt="%.4e", delimiter="\t")
+
+    ovr_file_path = f"{directory}/benchmark.ovr"
+    overview = rng.uniform(0, 1, size=(NUMBER_OF_ZONES, len(OVR_COLUMNS)))
+    overview[:, 0] = depth
+    np.savetxt(ovr_file_path, overview, fmt="%.4e", delimiter="\t", header="\t".join(OVR_COLUMNS), comments="")
+
+    return em_str_file_path, ovr_file_path
+
+
+def find_converged_run_loop(cloudy_em_str, threshold=0):
+    # find_converged_run as it was written in calculate_intensity_finished_cloudy_jobs_2.py before read_converged_iteration
+
+    index = 0
+    for i in range(len(cloudy_em_str) - 1):
+        if (cloudy_em_str[i][0] - cloudy_em_str[i + 1][0]) > threshold:
+            index = i + 1
+
+    return cloudy_em_str[index:]
+
+
+def best_time(function):
+
+    times = []
+    for repeat in range(NUMBER_OF_REPEATS):
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+
+    return min(times)
+
+
+def print_result(name, time, time_current):
+
+    print(f"{name:<40} {time * 1e3:8.2f} ms   speedup: {time_current / time:5.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+# Imports
+import os
+import sys
+import json
+import resource
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from time import perf_counter
+
+from make_synthetic_grid import make_synthetic_grid, EM_STR_COLUMNS
+from run_status_manifest import read_centers_file, directory_names
+from out_file_status import classify_out_file, REASON_OK, TAIL_BYTES
+from cloudy_file_readers import read_columns, read_columns_as_df, find_converged_run, read_converged_iteration
+from line_integration import integrate_lines, integrate_ragged
+from results_store import write_results
+
+try:
+    # Needs tools.constants (see calculate_other_properties_from_finished_cloudy_runs.py)
+    from calculate_other_properties_from_finished_cloudy_runs import calculate_fh2, calculate_fCO
+except ImportError as e:
+    print(f"fh2 and fCO are not benchmarked: {e}")
+    calculate_fh2, calculate_fCO = None, None
+
+
+################################################################################
+# Times each post-processing stage on a synthetic grid (make_synthetic_grid.py) in a single process and reports runs per second, MB per
+# second read from the files and the peak memory allocated in the stage (tracemalloc, measured in a second pass so it does not slow down
+# the timing). Run it before a production submission to catch performance regressions:
+#
+#   python benchmark_post_processing.py [number of runs] [number of zones] [results.json]
+#
+# If a results file is given the numbers are written to it as well.
+################################################################################
+
+# Global variables
+NUMBER_OF_RUNS = 500
+NUMBER_OF_ZONES = 1000
+
+OVR_COLUMNS_READ = ["depth", "hden", "2H_2/H", "CO/C"]
+
+
+# Main
+def main(number_of_runs=NUMBER_OF_RUNS, number_of_zones=NUMBER_OF_ZONES, results_file_path=None):
+
+    with tempfile.TemporaryDirectory() as base_file_dir:
+        make_synthetic_grid(base_file_dir, number_of_runs, number_of_zones)
+        results = run_benchmarks(base_file_dir)
+
+    print(f"\n{number_of_runs} runs, {number_of_zones} zones")
+    print(f"{'stage':<32} {'time [s]':>9} {'runs/s':>10} {'MB/s':>9} {'peak [MB]':>10}")
+    for result in results:
+        mb_per_second = f"{result['mb_per_second']:9.1f}" if result["mb_per_second"] is not None else f"{'-':>9}"
+        print(
+            f"{result['stage']:<32} {result['seconds']:9.3f} {result['runs_per_second']:10.1f} {mb_per_second} "
+            f"{result['peak_memory_mb']:10.1f}"
+        )
+    print(f"Max resident memory of the process: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+    if results_file_path is not None:
+        with open(results_file_path, "w") as file:
+            json.dump({"number_of_runs": number_of_runs, "number_of_zones": number_of_zones, "stages": results}, file, indent=4)
+        print(f"File written to {results_file_path}")
+
+    return 0
+
+
+# Functions
+
+def measure(stage, function, number_of_runs, number_of_bytes=None):
+    """
+    Calls function once to time it and once more under tracemalloc to find its peak memory. Returns the result of the first call and a
+    dictionary with the numbers of the stage.
+    """
+
+    start = perf_counter()
+    result = function()
+    seconds = perf_counter() - start
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, {
+        "stage": stage,
+        "seconds": seconds,
+        "runs_per_second": number_of_runs / seconds if seconds > 0 else float("inf"),
+        "mb_per_second": number_of_bytes / 1e6 / seconds if (number_of_bytes is not None and seconds > 0) else None,
+        "peak_memory_mb": peak / 1e6,
+    }
+
+
+def run_benchmarks(base_file_dir):
+
+    results = []
+
+    centers = read_centers_file(base_file_dir)
+    fdirs = directory_names(centers)
+    run_file_paths = [f"{base_file_dir}/{fdir}/{fdir}" for fdir in fdirs]
+
+    def file_sizes(suffix, paths):
+        return sum(os.path.getsize(f"{path}{suffix}") for path in paths)
+
+    # Status scan of all runs. Only the tail of the .out files is read.
+    reasons, result = measure(
+        "status scan (.out tail)",
+        lambda: [classify_out_file(f"{path}.out") for path in run_file_paths],
+        len(run_file_paths),
+        sum(min(os.path.getsize(f"{path}.out"), TAIL_BYTES) for path in run_file_paths if os.path.isfile(f"{path}.out")),
+    )
+    results.append(result)
+
+    ok_paths = [path for path, reason in zip(run_file_paths, reasons) if reason == REASON_OK]
+    em_str_bytes = file_sizes("_em.str", ok_paths)
+    usecols = list(range(len(EM_STR_COLUMNS)))
+
+    em_strs, result = measure(
+        "_em.str parsing (all iterations)",
+        lambda: [read_columns(f"{path}_em.str", usecols) for path in ok_paths],
+        len(ok_paths),
+        em_str_bytes,
+    )
+    results.append(result)
+
+    converged, result = measure(
+        "find_converged_run",
+        lambda: [find_converged_run(em_str) for em_str in em_strs],
+        len(ok_paths),
+    )
+    results.append(result)
+
+    result = measure(
+        "read_converged_iteration",
+        lambda: [read_converged_iteration(f"{path}_em.str", usecols) for path in ok_paths],
+        len(ok_paths),
+        em_str_bytes,
+    )[1]
+    results.append(result)
+
+    path_integrals, result = measure(
+        "integration (per run)",
+        lambda: np.array([integrate_lines(em_str[:, 1:], em_str[:, 0]) for em_str in converged]).reshape(-1, len(EM_STR_COLUMNS) - 1),
+        len(ok_paths),
+    )
+    results.append(result)
+
+    offsets = np.concatenate([[0], np.cumsum([len(em_str) for em_str in converged])])
+    buffer = np.concatenate(converged) if len(converged) > 0 else np.zeros((0, len(EM_STR_COLUMNS)))
+    result = measure(
+        "integration (ragged batch)",
+        lambda: integrate_ragged(buffer[:, 1:], buffer[:, 0], offsets),
+        len(ok_paths),
+    )[1]
+    results.append(result)
+
+    densities, result = measure(
+        ".ovr parsing",
+        lambda: [read_columns_as_df(f"{path}.ovr", OVR_COLUMNS_READ) for path in ok_paths],
+        len(ok_paths),
+        file_sizes(".ovr", ok_paths),
+    )
+    results.append(result)
+
+    if calculate_fh2 is not None:
+        result = measure(
+            "calculate_fh2 + calculate_fCO",
+            lambda: [
+                (calculate_fh2(density), calculate_fCO(density, 10**metallicity))
+                for density, metallicity in zip(densities, centers["log_metallicity"])
+            ],
+            len(ok_paths),
+        )[1]
+        results.append(result)
+
+    # Output of all centers, broken runs are NaN
+    table = np.full((len(centers), len(centers.columns) + len(EM_STR_COLUMNS) - 1), np.nan)
+    table[:, : len(centers.columns)] = centers.to_numpy()
+    table[np.flatnonzero(np.array(reasons) == REASON_OK), len(centers.columns) :] = path_integrals
+
+    def write_txt():
+        np.savetxt(fname=f"{base_file_dir}/benchmark_output.txt", X=table, fmt="%.8e")
+
+    def write_npy():
+        write_results(df=pd.DataFrame(table), base_file_dir=base_file_dir, name="benchmark_output", backend="npy")
+
+    results.append(measure("output writing (txt)", write_txt, len(centers))[1])
+    results.append(measure("output writing (npy)", write_npy, len(centers))[1])
+
+    return results
+
+
+if __name__ == "__main__":
+
+    arguments = sys.argv[1:]
+    main(
+        number_of_runs=int(arguments[0]) if len(arguments) > 0 else NUMBER_OF_RUNS,
+        number_of_zones=int(arguments[1]) if len(arguments) > 1 else NUMBER_OF_ZONES,
+        results_file_path=arguments[2] if len(arguments) > 2 else None,
+    )
@@ -6,8 +6,15 @@ import pandas as pd
 # import matplotlib.pyplot as plt
 # plt.style.use("seaborn-poster")
 
-from scipy import integrate
-from time import time
+from out_file_status import is_out_file_ok, REASON_OK
+from cloudy_file_readers import read_converged_iteration
+from line_integration import integrate_lines
+from pack_cloudy_outputs import run_file_source
+from grid_shards import shard_from_argv
+from line_catalog import select_lines, output_header, em_str_columns
+from run_prefetch import file_source
+from instrumentation import stage
+from run_cache import cache_from_argv
 
 
 # # Some functions need to be defined here
@@ -29,6 +36,43 @@ from time import time
 # TRAIN_DATA_FILE_PATH = "/scratch/m/murray/dtolgay/cloudy_runs/z_0/cr_1_CO87_CII_H_O3/cr_1_CO87_CII_H_O3_metallicity_minus2_minus3point5"
 TRAIN_DATA_FILE_PATH = "/home/m/murray/dtolgay/scratch/cloudy_runs/z_3/m12f_res7100_md_test"
 
+# Number of processes used to calculate the line intensities. Set it to 1 to run everything serially in a single process (useful for debugging).
+MAX_WORKERS = 40
+# The centers are split into MAX_WORKERS * CHUNKS_PER_WORKER chunks. Using more chunks than workers balances the work, because high density runs
+# take longer to read and the workers that finish early pick up the remaining chunks.
+CHUNKS_PER_WORKER = 4
+
+# Each process reads the files of the next PREFETCH_DEPTH runs with IO_THREADS threads while it integrates the current run (see
+# run_prefetch.py), so it does not wait for the file system between the runs. Memory used per process is about PREFETCH_DEPTH _em.str files.
+# Use a larger depth on Lustre, a smaller one on a local disk. 0 reads the files one after the other when they are needed.
+PREFETCH_DEPTH = 8
+IO_THREADS = 4
+
+# If True the OK runs are taken from the run status manifest of the grid (run_status_manifest.py) and the .out files are not read again.
+# Runs that are not OK in the manifest are written as NaN without opening any file.
+USE_MANIFEST = False
+
+# "txt" writes I_line_values_without_reversing.txt with np.savetxt. "npy" or "parquet" write a binary table with the same column names and
+# units (see results_store.py), which is much faster to write and to read back. OUTPUT_FLOAT32 downcasts the binary table to float32.
+OUTPUT_BACKEND = "txt"
+OUTPUT_FLOAT32 = False
+
+# The output table is allocated once and filled in place, one row per center. If OUTPUT_MEMMAP is True it is a memory map of
+# <TRAIN_DATA_FILE_PATH>/<output name>_table.npy (removed after the output is written) instead of an array in memory, so the memory used
+# does not grow with the number of centers. Use it for grids with millions of centers.
+OUTPUT_MEMMAP = False
+
+# If CHECKPOINT is True the finished centers are written to <TRAIN_DATA_FILE_PATH>/checkpoints/ every CHECKPOINT_INTERVAL_SECONDS (see
+# result_checkpoints.py), so the work is not lost if the job hits the wall time. With RESUME the centers in the checkpoints are not processed
+# again unless their .out file changed. New or rerun centers are processed and merged into the output. Off by default: checkpoints stat the
+# .out file of every center and write to the grid directory. RESUME turns them on.
+CHECKPOINT = False
+RESUME = False
+
+# Intensities of the runs whose .in file is the same as a run that is already calculated (in any grid) are taken from the row cache in
+# RUN_CACHE_DIRECTORY and the calculated intensities are added to it (see run_cache.py). None does not use the cache. It can be given on
+# the command line with --cache <directory>.
+RUN_CACHE_DIRECTORY = None
 
 
 # GLOBAL VARIABLES
@@ -47,87 +91,70 @@ TRAIN_DATA_FILE_PATH = "/home/m/murray/dtolgay/scratch/cloudy_runs/z_3/m12f_res7
 #     "13CO": 2719.67e-6,
 # }
 
-COLUMNS_EMISSIVITY = [
-    "radius",
-    "ly_alpha",
-    "h_alpha",
-    "h_beta",
-    "CO10",
-    "CO21",
-    "CO32",
-    "CO43",
-    "CO54",
-    "CO65",
-    "CO76",
-    "CO87",
-    "13CO",
-    "C2",
-    "O3_88um",
-    "O3_5006um",
-    "O3_4958um",
-]
+# Lines that are read from the _em.str files (see line_catalog.py). None reads all lines in the catalog. Only the columns of the given lines
+# are parsed, e.g. ["CO10", "C2"] reads only CO(1-0) and [CII] even if the runs saved many more lines.
+LINE_NAMES = None
+LINES = select_lines(LINE_NAMES)
+
+COLUMNS_EMISSIVITY = ["radius"] + [line["name"] for line in LINES]
+
+# Header of I_line_values_without_reversing.txt. Names and units of the columns.
+OUTPUT_HEADER = output_header(LINES)
 
 ########################### Functions
-def find_converged_run(cloudy_em_str: np.ndarray, threshold: float = 0) -> np.ndarray:
-    """
-    To use the coverged value, I will look at the radius values in the file. If radius decreases to initial radius and simulations
-    ran one more time starting from the beginning then it means that in the first run it is not coverged and simulation was run again
-    Second run gives the converged value. Use the second run.
-    """
+def calculate_path_integrals(em_str_file_path):
+    '''
+    Reads the converged iteration of the _em.str file and returns the path integrals of the LINES (all columns of COLUMNS_EMISSIVITY except
+    radius) in the order of COLUMNS_EMISSIVITY [erg s^-1 cm^-2].
+    '''
 
-    index = 0
-    for i in range(len(cloudy_em_str) - 1):
-        if (cloudy_em_str[i][0] - cloudy_em_str[i + 1][0]) > threshold:
-            index = i + 1
+    # Only the coverged run is read. Columns of the LINES are found in the header of the file, so a file with other lines raises a KeyError
+    # instead of giving the intensities of the wrong lines. The header read by read_converged_iteration is used, the file is opened once.
+    cloudy_em_str = read_converged_iteration(
+        file_path=em_str_file_path,
+        columns=lambda header: em_str_columns(em_str_file_path, LINES, header),
+    )
 
-    cloudy_em_str = cloudy_em_str[index:]
+    # All lines are integrated over radius in a single call (see line_integration.py). Same values as integrate.simpson for each line.
+    with stage("integrate"):
+        path_integrals = integrate_lines(
+            y=cloudy_em_str[:, 1:],
+            x=cloudy_em_str[:, 0],
+            axis=0,
+        ) # erg s^-1 cm^-2
 
-    return cloudy_em_str
+    return path_integrals
 
 
-def get_L_line(center):
+def get_L_line(center, check_out_file=True, files=None, base_file_dir=None):
 
     '''
-    This code is dependent on the global array: COLUMNS_EMISSIVITY. 
-    First .out file is read. If the runs ran properly, indicated by OK at the end of the file
-    line luminosity calculation starts. If not functions returns NaN and center values. 
-    If the run is OK, then converged data is found by using the find_converged_run function and that data is used. Cloudy outputs distance from the face of
-    the cloud, but to integrate for gas particles, I have to express the integration parameter (distance) starting from the center of the cloud so I subtract
-    max distance and reverse the array. The resulting value 'r' is my integration parameter. Then I am reversing all the other columns of the data and matching
-    them with the names of the lines by using the COLUMNS_EMISSIVITY. COLUMNS_EMISSIVITY stores all of the names of the lines that I am expecting to have in 
-    the *_em.str file. Then I am reversing the data in each column. Finally I am taking the path integral of all of the lines (all columns except radius).
-    To process the returned data properly I am converting dictionary to numpy array.
+    This code is dependent on the global list: LINES (the columns of COLUMNS_EMISSIVITY).
+    First the end of the .out file is read. If the run ran properly, indicated by OK at the end of the file, line luminosity calculation
+    starts. If check_out_file is False the run is already known to be OK (e.g. from the run status manifest) and the .out file is not read.
+    files are the files of the run that are already read by run_prefetch.py, then the status of the run is taken from them. If it is None
+    the files are read here. The run is in base_file_dir (TRAIN_DATA_FILE_PATH if it is None), files of packed runs are read from their shard.
+    If the run is OK, calculate_path_integrals reads only the converged iteration of the _em.str file and integrates the emissivities of all
+    LINES over the radius (distance from the face of the cloud) with integrate_lines. Returns (path integrals in the order of
+    COLUMNS_EMISSIVITY without radius [erg s^-1 cm^-2], center), or (None, center) if the run is not OK or its files cannot be read.
     '''
 
     # fdir = f"hden{center[1]:.3f}_metallicity{center[0]:.3f}_turbulence{center[2]:.3f}_isrf{center[3]:.3f}_radius{center[4]:.3f}"
     fdir = f"hden{center['log_hden']:.5f}_metallicity{center['log_metallicity']:.5f}_turbulence{center['log_turbulence']:.5f}_isrf{center['log_isrf']:.5f}_radius{center['log_radius']:.5f}"
+    base_file_dir = TRAIN_DATA_FILE_PATH if base_file_dir is None else base_file_dir
 
     try:
-        with open(f"{TRAIN_DATA_FILE_PATH}/{fdir}/{fdir}.out", "r") as file:
-            lines = file.readlines()
-            last_line = lines[-1]
-
-        if "OK" == last_line[len(last_line) - 4 : len(last_line) - 2]:
-            cloudy_em_str = np.loadtxt(
-                fname=f"{TRAIN_DATA_FILE_PATH}/{fdir}/{fdir}_em.str"
-            )
-            # Only use the coverged run
-            cloudy_em_str = find_converged_run(cloudy_em_str=cloudy_em_str)
-
-            # Create a dictionary to store separate arrays for each column
-            emissivity_arrays = {
-                column_name: cloudy_em_str[:, idx] for idx, column_name in enumerate(COLUMNS_EMISSIVITY)
-            }
-
-            path_integrals = {}
-            for key in emissivity_arrays:
-                if key != "radius":
-                    path_integrals[key] = (
-                        integrate.simpson(y=emissivity_arrays[key], x=emissivity_arrays['radius'])
-                    ) # erg s^-1 cm^-2
-
-            # Convert volume integrals into numpy array 
-            path_integrals = np.array(list(path_integrals.values())) # Only get the numerical values. Don't bother returning keys.
+        if files is not None:
+            run_is_ok = file_source(files, "reason") == REASON_OK
+        elif check_out_file:
+            # Only the end of the .out file is read. Files of packed runs are read from their shard (see pack_cloudy_outputs.py).
+            run_is_ok = is_out_file_ok(run_file_source(base_file_dir, fdir, ".out"))
+        else:
+            run_is_ok = True
+
+        if run_is_ok:
+            em_str_source = file_source(files, "_em.str") if files is not None else run_file_source(base_file_dir, fdir, "_em.str")
+            path_integrals = calculate_path_integrals(em_str_source)
 
             return path_integrals, center
 
@@ -137,110 +164,44 @@ def get_L_line(center):
     except Exception as e:
         print("\n")
         print(f"An error occurred: {e}")
-        print(f"File {TRAIN_DATA_FILE_PATH}/{fdir}/{fdir}.out cannot read!")
+        print(f"File {base_file_dir}/{fdir}/{fdir}.out cannot read!")
         return None, center
 
 
 ########################### Main
-
-# Get the file path
-centers_file_path = f"{TRAIN_DATA_FILE_PATH}/centers.txt"
-centers_train = np.loadtxt(fname=centers_file_path) 
-
-print(f"Using {centers_file_path} as a center.txt file")
-
-centers_train_df = pd.DataFrame(
-    centers_train,
-    columns=[
-        "log_metallicity",
-        "log_hden",
-        "log_turbulence",
-        "log_isrf",
-        "log_radius",
-    ],
-)
-
-
-start = time()
-
-centers_and_line_luminosities = []
-ok_runs = []
-broken_runs = []
-
-start_2 = time()
-
-for row, center in centers_train_df.iterrows():
-    # Get the line luminosities and file name
-    result = get_L_line(center)
-
-    if result[0] is not None:
-        # Save both the line luminosites and file name of the successful runs
-        centers_and_line_luminosities.append(np.append(result[1], result[0])) 
-        ok_runs.append(result[1])
-
-    else:
-        centers_and_line_luminosities.append(
-            np.append( result[1], [np.nan for i in range(len(COLUMNS_EMISSIVITY) - 1)] )
-            ) # Return the NaN array
-        broken_runs.append(result[1])
-
-    if row % 1e4 == 1:
-        print(f"{row} finished. Left {len(centers_train_df) - row}")
-        stop_2 = time()
-        time_passed_in_minutes = (stop_2 - start_2) / 60
-        print(f"Time passed is {round(time_passed_in_minutes, 3)} minutes")
-
-
-# Convert centers_and_line_luminosities to a numpy array
-centers_and_line_luminosities = np.array(centers_and_line_luminosities)
-
-end = time()
-print(f"It took {round((end - start)/60, 2)} minutes to calculate line luminosities!")
-
-print(
-    f"len(ok_runs) = {len(ok_runs)} --------------------------- len(broken_runs) = {len(broken_runs)}"
-)
-
-
-# Create dataframe to store the successful runs.
-columns = list(centers_train_df.keys())
-# Get the name of the lines
-columns_luminosities = [column for column in COLUMNS_EMISSIVITY if column != "radius"]
-columns.extend(columns_luminosities)
-successful_runs = pd.DataFrame(centers_and_line_luminosities, columns=columns)
-
-## Writing to a file
-header = """
-Column 0: log_metallicity [log(Zsolar)]
-Column 1: log_hden [log(cm^-3)]
-Column 2: log_turbulence [log(km s^-1)]
-Column 3: log_isrf [log(G0)]
-Column 4: log_radius [log(pc)]
-Column 5: I_ly_alpha [erg s^-1 cm^-2]
-Column 6: I_h_alpha [erg s^-1 cm^-2]
-Column 7: I_h_beta [erg s^-1 cm^-2]
-Column 8: I_co_10 [erg s^-1 cm^-2]
-Column 9: I_co_21 [erg s^-1 cm^-2]
-Column 10: I_co_32 [erg s^-1 cm^-2]
-Column 11: I_co_43 [erg s^-1 cm^-2]
-Column 12: I_co_54 [erg s^-1 cm^-2]
-Column 13: I_co_65 [erg s^-1 cm^-2]
-Column 14: I_co_76 [erg s^-1 cm^-2]
-Column 15: I_co_87 [erg s^-1 cm^-2]
-Column 16: I_13co [erg s^-1 cm^-2]
-Column 17: I_c2 [erg s^-1 cm^-2]
-Column 18: I_o3_88 [erg s^-1 cm^-2]
-Column 19: I_o3_5006 [erg s^-1 cm^-2]
-Column 20: I_o3_4958 [erg s^-1 cm^-2]
-"""
-
-out_file_name = "I_line_values_without_reversing.txt"
-
-np.savetxt(
-    fname=f"{TRAIN_DATA_FILE_PATH}/{out_file_name}",
-    X=successful_runs,
-    fmt="%.8e",
-    header=header,
-)
-
-print(f"File written to {TRAIN_DATA_FILE_PATH}/{out_file_name}")
+def main(
+    max_workers=MAX_WORKERS,
+    use_manifest=USE_MANIFEST,
+    output_backend=OUTPUT_BACKEND,
+    checkpoint=CHECKPOINT,
+    resume=RESUME,
+    shard=None,
+    run_cache_directory=RUN_CACHE_DIRECTORY,
+):
+
+    # The grid is post-processed by post_process_cloudy_runs.py with only the line intensities. It is imported here because it imports this
+    # script.
+    import post_process_cloudy_runs
+
+    return post_process_cloudy_runs.post_process_grid(
+        base_file_dir=TRAIN_DATA_FILE_PATH,
+        name="I_line_values_without_reversing",
+        lines=True,
+        properties=False,
+        max_workers=max_workers,
+        use_manifest=use_manifest,
+        output_backend=output_backend,
+        float32=OUTPUT_FLOAT32,
+        output_memmap=OUTPUT_MEMMAP,
+        checkpoint=checkpoint,
+        resume=resume,
+        shard=shard,
+        run_cache_directory=run_cache_directory,
+        chunks_per_worker=CHUNKS_PER_WORKER,
+        prefetch_depth=PREFETCH_DEPTH,
+        io_threads=IO_THREADS,
+    )
+
+
+if __name__ == "__main__":
+    main(shard=shard_from_argv(), run_cache_directory=cache_from_argv(default=RUN_CACHE_DIRECTORY))
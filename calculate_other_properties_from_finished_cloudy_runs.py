@@ -7,47 +7,98 @@ import pandas as pd
 
 from tools import constants
 
-def main(base_file_dir):
-    centers = read_centers_file(base_file_dir=base_file_dir)
-
-    properties = []
-    for row, center in centers.iterrows():
-
-        metallicity_center = 10**center['log_metallicity'] 
-
-        try: 
-            densities = read_ovr_file(
-                base_file_dir=base_file_dir,
-                center=center
-                )
-            
-            average_fh2 = calculate_fh2(densities)
-            average_fCO = calculate_fCO(
-                densities=densities, 
-                metallicity=metallicity_center
-                )
-
-            properties.append((average_fh2, average_fCO))
-        except Exception as e: 
-            # If exception occurs return NaN
-            properties.append((np.nan, np.nan))
-            print(f"Exception occured for run {center}: \n{e}")
-
-        if row % 1e4 == 1: 
-            print(f"{row} finished. Left {len(centers) - row}")
-
-
-    centers[['fh2', 'fCO']] = np.array(properties)
-
-    print(centers)
-
-    write_to_a_file(
-        df = centers,
-        base_file_dir = base_file_dir,
-        file_name = "other_properties.csv"
+from cloudy_file_readers import read_header, read_columns_as_df
+from pack_cloudy_outputs import run_file_source
+from grid_shards import shard_from_argv
+from instrumentation import stage
+from run_prefetch import file_source
+
+
+################################################################################
+# Calculates fh2, fCO and the averages of the EXTRA_OVR_COLUMNS of every run from its .ovr file. Every quantity is averaged over the zones
+# of the slab weighted with the hydrogen column density of the zone (hden * thickness, see calculate_mass_weighted_fractions), so fCO is
+# weighted the same way as fh2. For runs with a constant hden this is the same as weighting with the thickness of the zones.
+################################################################################
+
+# .ovr columns that are averaged over the slab in addition to fh2 and fCO (e.g. "HI", "HII", "C1", "C2", "H2O/O").
+# Every column in the list is written to the output file with its averaged value.
+EXTRA_OVR_COLUMNS = []
+
+# Number of processes (see post_process_cloudy_runs.py). Set it to 1 to run serially in a single process.
+MAX_WORKERS = 40
+
+# The .ovr files of the next PREFETCH_DEPTH runs are read with IO_THREADS threads while the current run is averaged (see run_prefetch.py).
+# 0 reads each file when it is needed.
+PREFETCH_DEPTH = 8
+IO_THREADS = 4
+
+# The output table is allocated once and filled in place. If OUTPUT_MEMMAP is True it is a memory map of <base_file_dir>/<output name>_table.npy
+# (removed after the output is written), so the memory used does not grow with the number of centers.
+OUTPUT_MEMMAP = False
+
+def main(base_file_dir, use_manifest=False, output_backend="csv", checkpoint=False, resume=False, shard=None, max_workers=MAX_WORKERS):
+    # The grid is post-processed by post_process_cloudy_runs.py with only the properties: fh2, fCO and the averaged EXTRA_OVR_COLUMNS are
+    # calculated for every run whose .ovr file can be read. It is imported here because it imports this script.
+    import post_process_cloudy_runs
+
+    return post_process_cloudy_runs.post_process_grid(
+        base_file_dir=base_file_dir,
+        name="other_properties",
+        lines=False,
+        properties=True,
+        max_workers=max_workers,
+        use_manifest=use_manifest,
+        output_backend=output_backend,
+        output_memmap=OUTPUT_MEMMAP,
+        checkpoint=checkpoint,
+        resume=resume,
+        shard=shard,
+        prefetch_depth=PREFETCH_DEPTH,
+        io_threads=IO_THREADS,
     )
 
-    return 0
+def calculate_properties(base_file_dir, center, files=None):
+    # Returns (fh2, fCO, averages of the EXTRA_OVR_COLUMNS) of a run. NaN if the .ovr file can not be read. files are the files of the run
+    # already read by run_prefetch.py, the .ovr file is read here if it is None.
+
+    metallicity_center = 10**center['log_metallicity'] 
+
+    try: 
+        densities = read_ovr_file(
+            base_file_dir=base_file_dir,
+            center=center,
+            columns=ovr_columns(),
+            source=file_source(files, ".ovr") if files is not None else None,
+            )
+
+        return properties_from_densities(densities, metallicity_center)
+
+    except Exception as e: 
+        # If exception occurs return NaN
+        print(f"Exception occured for run {center}: \n{e}")
+        return (np.nan, np.nan) + tuple(np.nan for column in EXTRA_OVR_COLUMNS)
+
+def ovr_columns():
+    # Columns read from the .ovr files
+    return ["depth", "hden", "2H_2/H", "CO/C"] + EXTRA_OVR_COLUMNS
+
+def properties_from_densities(densities, metallicity):
+    # Returns (fh2, fCO, averages of the EXTRA_OVR_COLUMNS). densities must have the ovr_columns().
+
+    # Average all species in a single pass over the zones
+    with stage("integrate"):
+        averaged_fractions = calculate_mass_weighted_fractions(
+            densities=densities,
+            columns=["2H_2/H", "CO/C"] + EXTRA_OVR_COLUMNS,
+            )
+
+    average_fh2 = averaged_fractions["2H_2/H"]
+    average_fCO = CO_over_C_to_fCO(
+        CO_over_C=averaged_fractions["CO/C"], 
+        metallicity=metallicity
+        )
+
+    return (average_fh2, average_fCO) + tuple(averaged_fractions[column] for column in EXTRA_OVR_COLUMNS)
 
 def read_centers_file(base_file_dir):
 
@@ -70,13 +121,16 @@ def read_centers_file(base_file_dir):
 
     return centers_train_df
 
-def read_ovr_file(base_file_dir, center):
+def read_ovr_file(base_file_dir, center, columns=None, source=None):
 
     fdir = f"hden{center['log_hden']:.5f}_metallicity{center['log_metallicity']:.5f}_turbulence{center['log_turbulence']:.5f}_isrf{center['log_isrf']:.5f}_radius{center['log_radius']:.5f}"
 
-    # Read files 
-    densities = pd.read_csv(f"{base_file_dir}/{fdir}/{fdir}.ovr", delim_whitespace=True)
-    densities.rename(columns={'#depth': 'depth'}, inplace=True)
+    # Read files. If columns is None all columns of the .ovr file are read. Packed runs are read from their shard. source is the content of
+    # the file if it is already read.
+    file_path = run_file_source(base_file_dir, fdir, ".ovr") if source is None else source
+    if columns is None:
+        columns = read_header(file_path)
+    densities = read_columns_as_df(file_path, columns)
 
     # Calculate the column density 
     densities['column_density'] = \
@@ -84,76 +138,52 @@ def read_ovr_file(base_file_dir, center):
 
     return densities
 
+def calculate_mass_weighted_fractions(densities, columns, weight_column="hden"):
+    '''
+    Averages the given .ovr columns over the slab in one pass. The thickness of every zone is the difference between its depth and the 
+    depth of the previous zone (the first zone starts at depth 0). Each zone is weighted with weight_column * thickness, which is 
+    proportional to the hydrogen column density of the zone for weight_column = "hden". If weight_column is None zones are weighted only 
+    with their thickness. Constant factors like the proton mass cancel in the average, so they are not multiplied in.
+
+    Returns a dictionary with the averaged value of each column.
+    '''
+
+    thickness = np.diff(densities['depth'].to_numpy(dtype=float), prepend=0)
+
+    if weight_column is None:
+        weights = thickness
+    else:
+        weights = densities[weight_column].to_numpy(dtype=float) * thickness
+
+    fractions = densities[columns].to_numpy(dtype=float)  # (number of zones, number of columns)
+    averaged_fractions = (weights @ fractions) / np.sum(weights)
+
+    return dict(zip(columns, averaged_fractions))
+
 def calculate_fh2(densities):
 
-    # Calculate total h2 column density  
-    sigma_h2 = np.zeros(len(densities)) * np.nan
-    sigma_h = np.zeros(len(densities)) * np.nan
-    depth_difference = np.zeros(len(densities)) * np.nan
-
-    for row, density in densities.iterrows():
-        if row == 0:
-            sigma_h2[row] = density['2H_2/H'] * density['hden'] * constants.proton_mass * constants.kg2g * density['depth']
-            sigma_h[row] = density['hden'] * constants.proton_mass * constants.kg2g * density['depth']
-            depth_difference[row] = density['depth']
-        else: 
-            sigma_h2[row] = density['2H_2/H'] * density['hden'] * constants.proton_mass * constants.kg2g * (density['depth'] - previous_row['depth'])
-            sigma_h[row] = density['hden'] * constants.proton_mass * constants.kg2g * (density['depth'] - previous_row['depth'])
-            depth_difference[row] = density['depth'] - previous_row['depth']
-        
-        # Store the previous row for depth calculation
-        previous_row = density
-        
-    fh2 = sigma_h2 / sigma_h    
-    averaged_fh2 = sum(fh2 * sigma_h) / sum(sigma_h)
+    # H2 mass fraction weighted with the hydrogen column density of the zones
+    averaged_fh2 = calculate_mass_weighted_fractions(densities, columns=['2H_2/H'])['2H_2/H']
 
     return averaged_fh2
 
-def calculate_fCO(densities, metallicity):
-    
+def CO_over_C_to_fCO(CO_over_C, metallicity):
+
     C_over_H_mass_ratio = 12 / 1 
     C_over_H_number_ratio = 2.51e-4 # ~ C/H /home/m/murray/dtolgay/cloudy/c23.00/data/abundances/ISM.abn 
     CO_over_C_mass_ratio = 28 / 12
     
     C_mass_ratio = C_over_H_number_ratio * C_over_H_mass_ratio 
 
+    # Carbon density is scaled with the metallicity. CO mass over hydrogen mass.
+    return C_mass_ratio * metallicity * CO_over_C * CO_over_C_mass_ratio
+
+def calculate_fCO(densities, metallicity):
     
-    # Set hden
-    hden = densities.iloc[0]['hden'] * constants.proton_mass * constants.kg2g # hden is constant in the run [gr/cm^3]
-    C_density = hden * C_mass_ratio * metallicity # Scaling according to the metallicity [g/cm^3] 
-    
-    # Initiate the arrays 
-    sigma_C = np.zeros(len(densities)) * np.nan
-    sigma_h = np.zeros(len(densities)) * np.nan
-    sigma_CO = np.zeros(len(densities)) * np.nan
-    sigma_h2 = np.zeros(len(densities)) * np.nan
-    
+    # CO mass fraction weighted with the hydrogen column density of the zones, the same as in properties_from_densities
+    averaged_CO_over_C = calculate_mass_weighted_fractions(densities, columns=['CO/C'])['CO/C']
 
-    # Calculate CO abundance
-    for row, density in densities.iterrows():
-        if row == 0:
-            sigma_C[row] = C_density * density['depth']
-            
-            sigma_CO[row] = sigma_C[row] * density['CO/C'] * CO_over_C_mass_ratio
-            
-            sigma_h[row] = hden * density['depth']
-            
-            sigma_h2[row] = density['2H_2/H'] * hden * density['depth']            
-        
-        else: 
-            sigma_C[row] = C_density * (density['depth'] - previous_row['depth'])
-            
-            sigma_CO[row] = sigma_C[row] * density['CO/C'] * CO_over_C_mass_ratio
-            
-            sigma_h[row] = hden * (density['depth'] - previous_row['depth'])
-            
-            sigma_h2[row] = density['2H_2/H'] * hden * (density['depth'] - previous_row['depth'])           
-
-        # Store the previous row for depth calculation
-        previous_row = density
-
-    f_CO = sigma_CO / sigma_h
-    averaged_f_CO = sum(f_CO * sigma_h) / sum(sigma_h) 
+    averaged_f_CO = CO_over_C_to_fCO(CO_over_C=averaged_CO_over_C, metallicity=metallicity)
 
     return averaged_f_CO
 
@@ -180,4 +210,4 @@ if __name__ == "__main__":
     base_file_dir = "/scratch/m/murray/dtolgay/cloudy_runs/z_0/cr_1_CO87_CII_H_O3/cr_1_CO87_CII_H_O3_metallicity_above_minus_2"
 
 
-    main(base_file_dir)
\ No newline at end of file
+    main(base_file_dir, shard=shard_from_argv())
\ No newline at end of file
@@ -0,0 +1,438 @@
+# Imports
+import io
+import os
+import gzip
+import warnings
+import numpy as np
+import pandas as pd
+
+from instrumentation import stage, add_bytes
+
+try:
+    # Only needed for the files compressed with zstd (see compress_cloudy_outputs.py)
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+################################################################################
+# Cloudy save files (_em.str, .ovr, ...) are tab separated tables. The first line is the header starting with "#" and the iterations are
+# separated with lines of "#" characters. Only the columns that are asked for are converted to floats.
+
+# Since numpy 1.23 np.loadtxt is implemented in C and with usecols it is the fastest reader for these files (see 
+# benchmark_cloudy_file_readers.py). Older numpy versions parse line by line in python, the C parser of pandas is used for them. The time
+# goes into converting the text to floats, so reading all columns is as slow as np.loadtxt of the whole table. Fewer rows (only the converged
+# iteration, read_converged_iteration) or fewer columns are what makes the readers faster.
+NUMPY_HAS_C_LOADTXT = tuple(int(number) for number in np.__version__.split(".")[:2]) >= (1, 23)
+
+# Files of finished runs can be compressed by compress_cloudy_outputs.py to <file>.gz or <file>.zst. If <file> does not exist the readers
+# read the compressed file. The compression is found from the first bytes of the content, so packed compressed files are read as well.
+COMPRESSED_EXTENSIONS = [".gz", ".zst"]
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+################################################################################
+
+
+# Functions
+
+# All readers accept the path of a file, the content of the file as bytes or a FileRange (a file packed in a shard, see
+# pack_cloudy_outputs.py). Only the bytes that are needed are read from a FileRange, e.g. the end of a .out file.
+
+class FileRange:
+    # Bytes [offset, offset + size) of an open file. They are read with os.pread, so the same file can be read by many threads.
+
+    def __init__(self, file_descriptor, offset, size):
+
+        self.file_descriptor = file_descriptor
+        self.offset = offset
+        self.size = size
+
+    def pread(self, size, position):
+        # At most size bytes starting from position (relative to the start of the range)
+
+        size = max(min(size, self.size - position), 0)
+
+        return os.pread(self.file_descriptor, size, self.offset + position) if size > 0 else b""
+
+    def read(self):
+
+        return self.pread(self.size, 0)
+
+
+class FileRangeReader(io.RawIOBase):
+    # Seekable file object over a FileRange. Wrapped in io.BufferedReader by open_binary, so readline works.
+
+    def __init__(self, file_range):
+
+        self.file_range = file_range
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=os.SEEK_SET):
+
+        if whence == os.SEEK_CUR:
+            position += self.position
+        elif whence == os.SEEK_END:
+            position += self.file_range.size
+        self.position = max(position, 0)
+
+        return self.position
+
+    def readinto(self, buffer):
+
+        content = self.file_range.pread(len(buffer), self.position)
+        buffer[: len(content)] = content
+        self.position += len(content)
+
+        return len(content)
+
+
+def open_compressed(file_path, opener):
+    # Calls opener(file_path) and if the file does not exist opener(<file_path>.gz) and opener(<file_path>.zst). Raises the
+    # FileNotFoundError of file_path if none of them exists.
+
+    try:
+        return opener(file_path)
+    except FileNotFoundError as error:
+        for extension in COMPRESSED_EXTENSIONS:
+            try:
+                return opener(f"{file_path}{extension}")
+            except FileNotFoundError:
+                pass
+        raise error
+
+
+def stat_file(file_path):
+    # os.stat of the file or of its compressed file. compress_cloudy_outputs.py keeps the mtime of the original file.
+
+    return open_compressed(file_path, os.stat)
+
+
+def is_compressed(content):
+
+    return (content[:2] == GZIP_MAGIC) or (content[:4] == ZSTD_MAGIC)
+
+
+def decompress(content):
+    # Decompresses gzip or zstd content. Other content (Cloudy files are ASCII) is returned as it is.
+
+    if content[:2] == GZIP_MAGIC:
+        with stage("decompress"):
+            content = gzip.decompress(content)
+    elif content[:4] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise ImportError("The file is compressed with zstd. Install the zstandard package to read it.")
+        with stage("decompress"):
+            content = zstandard.ZstdDecompressor().decompressobj().decompress(content)
+    else:
+        return content
+
+    add_bytes("decompress", len(content))
+
+    return content
+
+
+def open_binary(source):
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(decompress(source))
+
+    if isinstance(source, FileRange):
+        if is_compressed(source.pread(4, 0)):
+            # Compressed files can not be read from the end, the whole file is decompressed
+            return io.BytesIO(decompress(source.read()))
+        return io.BufferedReader(FileRangeReader(source))
+
+    file = open_compressed(source, lambda file_path: open(file_path, "rb"))
+    if file.name == source:
+        return file
+
+    # Compressed files can not be read from the end, the whole file is decompressed
+    with file:
+        return io.BytesIO(decompress(file.read()))
+
+
+def read_file(source):
+    # Returns the (decompressed) content of the file. Bytes are returned as they are if they are not compressed.
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return decompress(source)
+
+    with stage("read"):
+        if isinstance(source, FileRange):
+            content = source.read()
+        else:
+            with open_compressed(source, lambda file_path: open(file_path, "rb")) as file:
+                content = file.read()
+    add_bytes("read", len(content))
+
+    return decompress(content)
+
+
+def source_name(source):
+
+    return "<packed file>" if isinstance(source, (bytes, bytearray, memoryview, FileRange)) else source
+
+
+def read_header(file_path):
+    # Returns the column names in the first line of the file. The leading "#" is removed, e.g. "#depth" -> "depth".
+
+    with open_binary(file_path) as file:
+        return parse_header_line(file.readline())
+
+
+def parse_header_line(line):
+
+    header = line.decode("ascii", errors="replace")
+
+    return [column_name.strip() for column_name in header.lstrip("#").rstrip("\n").split("\t")]
+
+
+def column_indices(file_path, columns, header=None):
+    """
+    columns can be a list of column names in the header, a list of column indices or a function that returns the column indices from the 
+    header (e.g. line_catalog.em_str_columns). If the header is already read it can be given, otherwise it is read from the file.
+    """
+
+    if not callable(columns) and all(isinstance(column, (int, np.integer)) for column in columns):
+        return [int(column) for column in columns]
+
+    header = read_header(file_path) if header is None else header
+    if callable(columns):
+        return [int(column) for column in columns(header)]
+
+    try:
+        return [header.index(column.lstrip("#")) for column in columns]
+    except ValueError:
+        missing = [column for column in columns if column.lstrip("#") not in header]
+        raise KeyError(f"Columns {missing} are not in the header of {source_name(file_path)}. Header: {header}")
+
+
+def parse_table(source, usecols=None, number_of_columns=None):
+    """
+    Parses the rows of a Cloudy save file. source is a file path, the content of the file (bytes) or a file-like object. usecols is a list of column indices or None to 
+    parse all columns. number_of_columns is only used to set the shape of the returned array if there are no rows and usecols is None.
+    Returns a C contiguous float64 array, columns are in the order of usecols.
+    """
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        add_bytes("parse", len(source))
+        source = io.BytesIO(source)
+
+    with stage("parse"):
+        return _parse_table(source, usecols, number_of_columns)
+
+
+def _parse_table(source, usecols, number_of_columns):
+
+    if NUMPY_HAS_C_LOADTXT:
+        with warnings.catch_warnings():
+            # Files with only the header are expected. Cloudy is stopped before the first zone.
+            warnings.filterwarnings("ignore", message="loadtxt: input contained no data")
+            data = np.loadtxt(
+                fname=source,
+                dtype=np.float64,
+                comments="#",
+                usecols=usecols,
+                ndmin=2,
+            )
+
+        if len(data) == 0:
+            data = data.reshape(0, len(usecols) if usecols is not None else (number_of_columns or 0))
+    else:
+        try:
+            data = pd.read_csv(
+                source,
+                sep=r"\s+",
+                header=None,
+                comment="#",
+                usecols=usecols,
+                dtype=np.float64,
+                engine="c",
+                float_precision="round_trip", # Same values as np.loadtxt
+            )
+        except pd.errors.EmptyDataError:
+            return np.zeros((0, len(usecols) if usecols is not None else (number_of_columns or 0)), dtype=np.float64)
+
+        if usecols is not None:
+            # pandas returns the columns in the order they are in the file
+            data = data[usecols]
+
+        data = data.to_numpy(dtype=np.float64)
+
+    return np.ascontiguousarray(data)
+
+
+def read_columns(file_path, columns=None):
+    """
+    Reads the columns of a Cloudy save file. columns is a list of column names (as written in the header) or column indices. If columns is
+    None all columns are read. Returns a C contiguous float64 array with shape (number of rows, len(columns)), columns are in the requested
+    order. Lines starting with "#" (header and the iteration separators) are skipped.
+    """
+
+    # The file is read before it is parsed, so the time spent reading and parsing is measured separately (see instrumentation.py). The 
+    # header is taken from the content, the file is opened only once.
+    content = read_file(file_path)
+    header = parse_header_line(content[: content.find(b"\n") + 1])
+
+    usecols = None if columns is None else column_indices(file_path, columns, header)
+
+    return parse_table(
+        source=content,
+        usecols=usecols,
+        number_of_columns=len(header) if usecols is None else None,
+    )
+
+
+def find_converged_run(cloudy_em_str, threshold=0):
+    """
+    Returns the rows of the last iteration. When the depth (first column) decreases the simulation is run one more time starting from the
+    beginning, so the rows after the last decrease in depth belong to the converged iteration. 
+    """
+
+    depth = cloudy_em_str[:, 0]
+    drops = np.flatnonzero((depth[:-1] - depth[1:]) > threshold)
+
+    index = drops[-1] + 1 if len(drops) > 0 else 0
+
+    return cloudy_em_str[index:]
+
+
+def find_last_block(tail):
+    """
+    Finds the rows after the last line starting with "#" (Cloudy separates the iterations with a line of "#" characters) in the bytes at the 
+    end of a file. Cloudy writes the separator after every iteration, the last one as well, so the separator and blank lines at the end of
+    the file are skipped first. Returns (start of the last block, end of the last block, last data line before the separator). The start and
+    the data line are None if they are not found completely inside the tail.
+    """
+
+    # Skip the separator and blank lines at the end of the file
+    block_end = len(tail)
+    while block_end > 0:
+        line_start = tail.rfind(b"\n", 0, block_end - 1) + 1
+        line = tail[line_start:block_end]
+        if line.strip() and not line.startswith(b"#"):
+            break
+        block_end = line_start
+
+    separator = tail.rfind(b"\n#", 0, block_end)
+    if separator == -1:
+        return None, block_end, None
+
+    end_of_separator = tail.find(b"\n", separator + 1)
+    block_start = block_end if end_of_separator == -1 else min(end_of_separator + 1, block_end)
+
+    # Walk back over the lines before the separator to find the last row of the previous iteration
+    end = separator
+    while end > 0:
+        start = tail.rfind(b"\n", 0, end)
+        if start == -1:
+            # The line may start before the tail
+            return block_start, block_end, None
+
+        line = tail[start + 1 : end]
+        if line.strip() and not line.startswith(b"#"):
+            return block_start, block_end, line
+
+        end = start
+
+    return block_start, block_end, None
+
+
+def read_last_block(file_path, tail_bytes=2**18):
+    """
+    Reads the header line and the end of the file: the last separator line before the last rows and the last row of the previous iteration
+    are looked for in the last tail_bytes of the file. If they are not found the window is enlarged. Returns (header line, tail, start of the
+    tail in the file) and the result of find_last_block(tail).
+    """
+
+    with open_binary(file_path) as file:
+        header_line = file.readline()
+        file_size = file.seek(0, os.SEEK_END)
+
+        while True:
+            start = max(file_size - tail_bytes, 0)
+            with stage("read"):
+                file.seek(start)
+                tail = file.read()
+            add_bytes("read", len(tail))
+
+            block_start, block_end, previous_line = find_last_block(tail)
+            if (previous_line is not None) or (start == 0):
+                break
+            tail_bytes *= 4
+
+    return header_line, tail, start, block_start, block_end, previous_line
+
+
+def read_converged_iteration(file_path, columns=None, threshold=0, tail_bytes=2**18):
+    """
+    Reads only the converged (last) iteration of a file written with "iterate to converge", e.g. _em.str. Returns the same rows as
+    find_converged_run(read_columns(file_path))[:, columns] but the earlier iterations are not parsed. columns can be given as in
+    column_indices.
+
+    The file is read from the end (read_last_block). The rows after the separator are parsed and the converged iteration is found in them if
+    the depth drops at the separator or inside the block. Otherwise (e.g. the file has no separator lines) the whole file is parsed. 
+    """
+
+    # The header is read from the same file, so the columns can be given as a function of the header
+    header_line, tail, start, block_start, block_end, previous_line = read_last_block(file_path, tail_bytes)
+    header = parse_header_line(header_line)
+
+    # Depth is always parsed because the iterations are found with it
+    usecols = list(range(len(header))) if columns is None else column_indices(file_path, columns, header)
+    usecols_with_depth = usecols if 0 in usecols else [0] + usecols
+    selected = [usecols_with_depth.index(column) for column in usecols]
+    depth_index = usecols_with_depth.index(0)
+
+    if previous_line is not None:
+        block = parse_table(source=tail[block_start:block_end], usecols=usecols_with_depth)
+        previous_depth = float(previous_line.split()[0])
+
+        if len(block) > 0:
+            depth = block[:, depth_index]
+            if ((previous_depth - depth[0]) > threshold) or np.any((depth[:-1] - depth[1:]) > threshold):
+                converged = find_converged_run(block[:, [depth_index] + selected], threshold=threshold)[:, 1:]
+                return np.ascontiguousarray(converged)
+
+    # Iterations can not be found from the separators. Parse everything.
+    data = parse_table(source=tail if start == 0 else read_file(file_path), usecols=usecols_with_depth)
+    converged = find_converged_run(data[:, [depth_index] + selected], threshold=threshold)[:, 1:]
+
+    return np.ascontiguousarray(converged)
+
+
+def read_last_iteration_bytes(file_path, threshold=0, tail_bytes=2**18):
+    """
+    Returns only the bytes of the file that read_converged_iteration needs: the header, the last row of the previous iteration, a separator
+    line and the rows of the last iteration. read_converged_iteration gives the same rows for them as for the whole file. Only the end of the
+    file is read (used to prefetch _em.str, see run_prefetch.py). The whole content is returned if the depth does not drop at the last
+    separator.
+    """
+
+    header_line, tail, start, block_start, block_end, previous_line = read_last_block(file_path, tail_bytes)
+
+    if previous_line is not None:
+        block = tail[block_start:block_end]
+        first_row = block.split(None, 1)
+        if len(first_row) > 0 and (float(previous_line.split()[0]) - float(first_row[0])) > threshold:
+            return header_line + previous_line + b"\n" + b"#" * 40 + b"\n" + block
+
+    return tail if start == 0 else read_file(file_path)
+
+
+def read_columns_as_df(file_path, columns):
+    # Same as read_columns but returns a DataFrame with the given column names (leading "#" removed)
+
+    return pd.DataFrame(
+        read_columns(file_path, columns),
+        columns=[column.lstrip("#") if isinstance(column, str) else column for column in columns],
+    )
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# Imports
+import sys
+import random
+from time import sleep, time
+
+
+################################################################################
+# Stand-in for the Cloudy executable to test run_cloudy_grid.py on a local machine:
+#
+#   python run_cloudy_grid.py with CLOUDY_EXECUTABLE = "/path/to/cloudy_stand_in.py"
+#
+# Called as "cloudy_stand_in.py -r <name>" in the directory of the run like Cloudy. Reads <name>.in, sleeps a random time between
+# MIN_SECONDS and MAX_SECONDS and writes <name>.out with the summary (zones, iterations, ExecTime) and the last line that Cloudy writes
+# when it exits OK.
+################################################################################
+
+MIN_SECONDS = 0.1
+MAX_SECONDS = 2.0
+
+
+def main(argv):
+
+    start = time()
+    name = argv[argv.index("-r") + 1]
+
+    with open(f"{name}.in", "r") as file:
+        in_file = file.read()
+
+    with open(f"{name}.out", "w") as file:
+        file.write(in_file)
+        file.flush()
+
+        sleep(random.uniform(MIN_SECONDS, MAX_SECONDS))
+
+        file.write(" Cloudy ends: 1 zone, 1 iteration\n")
+        file.write(f" ExecTime(s) {time() - start:.2f}\n")
+        file.write(" [Stop in cdMain at ../maincl.cpp:157, Cloudy exited OK]\n")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,199 @@
+# Imports
+import os
+import sys
+import gzip
+import shutil
+import numpy as np
+from time import time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from run_status_manifest import read_centers_file, directory_names
+from out_file_status import classify_out_file, REASON_OK, REASON_WARNINGS, REASON_ABORT
+from cloudy_file_readers import stat_file, zstandard
+from run_cloudy_grid import LOCK_SUFFIX
+from instrumentation import stage, add_bytes, Progress, write_summary
+
+
+################################################################################
+# Compresses the large ASCII files of the finished runs in place: <fdir><suffix> is replaced by <fdir><suffix>.gz (gzip) or
+# <fdir><suffix>.zst (zstd, needs the zstandard package). The tables of floats compress several times, so less of the scratch quota is
+# used and the post-processing scripts read several times fewer bytes from Lustre. The readers (cloudy_file_readers.py) read the
+# compressed file if the original file does not exist, so nothing else has to be changed.
+#
+#   python compress_cloudy_outputs.py <base_file_dir> [gzip|zstd]
+#
+# Only runs that are finished are compressed: the .out file ends with the "[Stop in ...]" line of Cloudy (ok, warnings or abort, see
+# out_file_status.py), the run is not claimed by run_cloudy_grid.py (<fdir>.lock) and the .out file is not modified in the last
+# MIN_AGE_SECONDS. Truncated runs are killed or still running, they are left as they are. The compressed file is written to a temporary file,
+# gets the mtime of the original file (the checkpoints and the manifest compare the mtime of the .out file) and only then the original is
+# removed, so a killed job never leaves a run without its files. Running it again compresses only the files that are not compressed yet.
+#
+# Files are compressed with max_threads threads. zlib and zstandard release the GIL while they compress.
+################################################################################
+
+# Global variables
+BASE_FILE_DIR = "/scratch/m/murray/dtolgay/cloudy_runs/z_0/cr_1_CO87_CII_H_O3/cr_1_CO87_CII_H_O3_metallicity_above_minus_2"
+
+# .out is compressed last, so a run is only skipped by the next call if all its files are compressed
+COMPRESSED_SUFFIXES = ["_em.str", ".ovr", ".con", ".mol1", ".out"]
+
+# Extension and default level of each method
+METHODS = {
+    "gzip": (".gz", 6),
+    "zstd": (".zst", 9),
+}
+
+FINISHED_REASONS = [REASON_OK, REASON_WARNINGS, REASON_ABORT]
+
+# Cloudy may still be writing the save files right after the .out file is finished
+MIN_AGE_SECONDS = 600
+
+# Number of runs that are given to the threads at once
+RUNS_PER_BATCH = 1000
+
+
+# Main
+def main(base_file_dir=BASE_FILE_DIR, method="gzip", max_threads=16, level=None):
+
+    start = time()
+
+    compress_runs(
+        base_file_dir=base_file_dir,
+        method=method,
+        max_threads=max_threads,
+        level=level,
+    )
+
+    print(f"It took {round((time() - start) / 60, 3)} minutes to compress the runs")
+
+    return 0
+
+
+# Functions
+
+def compress_content(content, method, level):
+
+    if method == "gzip":
+        # mtime=0 so compressing the same content gives the same bytes
+        return gzip.compress(content, compresslevel=level, mtime=0)
+
+    return zstandard.ZstdCompressor(level=level).compress(content)
+
+
+def compress_file(file_path, method, level):
+    # Replaces the file with its compressed file. Returns (size of the file, size of the compressed file).
+
+    extension = METHODS[method][0]
+    compressed_file_path = f"{file_path}{extension}"
+
+    with stage("read"):
+        with open(file_path, "rb") as file:
+            content = file.read()
+    add_bytes("read", len(content))
+
+    with stage("compress"):
+        compressed = compress_content(content, method, level)
+
+    with stage("write"):
+        with open(f"{compressed_file_path}.tmp", "wb") as file:
+            file.write(compressed)
+        shutil.copystat(file_path, f"{compressed_file_path}.tmp")
+        os.replace(f"{compressed_file_path}.tmp", compressed_file_path)
+        os.remove(file_path)
+    add_bytes("write", len(compressed))
+
+    return len(content), len(compressed)
+
+
+def is_run_finished(base_file_dir, fdir, min_age_seconds=MIN_AGE_SECONDS):
+
+    run_file_path = f"{base_file_dir}/{fdir}/{fdir}"
+
+    if os.path.exists(f"{run_file_path}{LOCK_SUFFIX}"):
+        return False
+
+    try:
+        with stage("stat"):
+            stat = stat_file(f"{run_file_path}.out")
+    except FileNotFoundError:
+        return False
+
+    if time() - stat.st_mtime < min_age_seconds:
+        return False
+
+    return classify_out_file(f"{run_file_path}.out") in FINISHED_REASONS
+
+
+def compress_run(base_file_dir, fdir, method, level, min_age_seconds=MIN_AGE_SECONDS):
+    """
+    Compresses the COMPRESSED_SUFFIXES files of a run that are not compressed yet if the run is finished. Returns (number of files,
+    bytes before, bytes after).
+    """
+
+    try:
+        with os.scandir(f"{base_file_dir}/{fdir}") as entries:
+            file_names = {entry.name for entry in entries if entry.is_file()}
+    except FileNotFoundError:
+        # Not created or packed and removed (see pack_cloudy_outputs.py)
+        return 0, 0, 0
+
+    file_names = [f"{fdir}{suffix}" for suffix in COMPRESSED_SUFFIXES if f"{fdir}{suffix}" in file_names]
+    if len(file_names) == 0 or not is_run_finished(base_file_dir, fdir, min_age_seconds):
+        return 0, 0, 0
+
+    sizes = np.zeros(2, dtype=np.int64)
+    for file_name in file_names:
+        sizes += compress_file(f"{base_file_dir}/{fdir}/{file_name}", method, level)
+
+    return len(file_names), int(sizes[0]), int(sizes[1])
+
+
+def compress_runs(base_file_dir, method="gzip", max_threads=16, level=None, min_age_seconds=MIN_AGE_SECONDS):
+    # Compresses the finished runs of the centers in centers.txt
+
+    if method not in METHODS:
+        raise ValueError(f"Unknown method {method}. Possible methods: {list(METHODS)}")
+    if method == "zstd" and zstandard is None:
+        raise ImportError("zstd compression needs the zstandard package")
+
+    level = METHODS[method][1] if level is None else level
+    fdirs = directory_names(read_centers_file(base_file_dir))
+    print(f"Compressing the finished runs of {len(fdirs)} centers with {method} (level {level})")
+
+    function = partial(compress_run, base_file_dir, method=method, level=level, min_age_seconds=min_age_seconds)
+    progress = Progress(len(fdirs), name="Checked:")
+    totals = np.zeros(4, dtype=np.int64)  # runs, files, bytes before, bytes after
+
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        for batch_start in range(0, len(fdirs), RUNS_PER_BATCH):
+            batch = fdirs[batch_start : batch_start + RUNS_PER_BATCH]
+
+            for number_of_files, size, compressed_size in executor.map(function, batch):
+                totals += (number_of_files > 0, number_of_files, size, compressed_size)
+
+            progress.add(len(batch))
+
+    number_of_runs, number_of_files, size, compressed_size = (int(total) for total in totals)
+    print(
+        f"{number_of_files} files of {number_of_runs} runs are compressed: {round(size / 1024**2, 1)} MB -> "
+        f"{round(compressed_size / 1024**2, 1)} MB (ratio {round(size / max(compressed_size, 1), 2)})"
+    )
+
+    write_summary(
+        base_file_dir,
+        "compress_cloudy_outputs",
+        progress,
+        max_threads,
+        extra={"runs": number_of_runs, "files": number_of_files, "bytes_before": size, "bytes_after": compressed_size},
+    )
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    main(
+        base_file_dir=sys.argv[1] if len(sys.argv) > 1 else BASE_FILE_DIR,
+        method=sys.argv[2] if len(sys.argv) > 2 else "gzip",
+    )
@@ -2,21 +2,87 @@
 import numpy as np 
 import pandas as pd 
 import os 
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+
+from run_status_manifest import directory_names
+from grid_shards import select_shard, shard_from_argv
+from instrumentation import Progress
+from line_catalog import in_file_block
+
+
+# Content of the .in files. Values of the center are formatted with 5 decimals as in the directory names.
+IN_FILE_TEMPLATE = (
+    "title Parallel Plane Slab DT\n"
+    "set nend 4000\n"  # Set number limiting number of zones.
+    "table ISM factor {log_isrf:.5f} log\n"
+    "radius 30\n"
+    "hden {log_hden:.5f} log\n"
+    "CMB, z={redshift:.5f}\n"
+    "abundances ISM\n"
+    "metals and grains {log_metallicity:.5f} log\n"
+    "turbulence {log_turbulence:.5f} km/sec log\n"
+    "cosmic rays background {cosmic_ray:.3f} linear\n"
+    "stop thickness {log_radius:.5f} log parsec\n"  # This sets the stopping radius
+    "stop temperature off\n"
+    # "iterate\n"  # iterate to converge option might be better
+    "iterate to converge\n"
+    "print line sort intensity\n"
+    # "element carbon isotopes (12, 5) (13, 1)\n"
+) + (
+    # "save lines, emissivity" block with the lines of line_catalog.py
+    in_file_block().replace("{", "{{").replace("}", "}}")
+) + (
+    "save lines, array, \".lines\"\n"
+    "save grain abundance \".gbu\"\n"
+    "save performance \".per\"\n"
+    "save overveiw last \".ovr\"\n"
+    "save monitors last \".asr\"\n"
+    "save temperature last \".tem\"\n"
+    "save overview \".ovr1\"\n"
+    "save molecules last \".mol\"\n"
+    "save molecules \".mol1\"\n"
+    "save heating \".het\"\n"
+    "save cooling \".col\" # Column densities\n"
+    "save dr last \".dr\"\n"
+    "save results last \".rlt\"\n"
+    "save continuum last \".con\" units microns\n"
+    "Save line labels [long] [no index] \".labels\"\n"
+    "print line optical depths \".tau\"\n"
+)
 
 
 ##########################################################################################################################################################################################
 # Main 
 
-def main(fdir, verbose):
+def main(fdir, verbose, centers_file_name="centers.txt", bulk=True, max_threads=16, dry_run=False, shard=None):
 
-    # Read file 
-    centers = create_df(np.loadtxt(fname=f"{fdir}/centers.txt")) 
+    # Read file. centers_file_name can be one of the centers_rerun_<reason>.txt files written by run_status_manifest.py to resubmit runs.
+    centers = create_df(np.loadtxt(fname=f"{fdir}/{centers_file_name}", ndmin=2)) 
+
+    # Only the centers of the shard (i, N) if a shard is given. The shards are made from centers.txt, see grid_shards.py
+    centers = select_shard(fdir, centers, shard)
 
     # Defining run specifications
     redshift = 3.0
     cosmic_ray = 1.0
 
+    # Bulk mode: existing directories are listed once and the missing directories and .in files are created with a thread pool
+    if bulk:
+        create_grid(
+            fdir = fdir,
+            centers = centers,
+            redshift = redshift,
+            cosmic_ray = cosmic_ray,
+            max_threads = max_threads,
+            dry_run = dry_run,
+            verbose = verbose,
+        )
+
+        return 0
+
     #################### Create .in files
+    progress = Progress(len(centers))
     for row, center in centers.iterrows():
 
 
@@ -39,9 +105,7 @@ def main(fdir, verbose):
                 cosmic_ray = cosmic_ray
             )
 
-            if row % 1e4 == 1:
-                print(f"{row} finished. Left {len(centers) - row}")            
-                print(f"Directory {directory_name} created!\n")            
+            progress.update(row + 1)
             
         except FileExistsError:
             if (verbose): print(f"Directory {directory_name} already exists. Only checking to create .in file. \n")
@@ -86,66 +150,25 @@ def create_df(array:np.array):
 
 
 
+def render_in_file(center, redshift, cosmic_ray):
+    # Returns the content of the .in file of a center. center is a row of the centers DataFrame or a dictionary.
+
+    return IN_FILE_TEMPLATE.format(
+        log_hden=center["log_hden"],
+        log_metallicity=center["log_metallicity"],
+        log_turbulence=center["log_turbulence"],
+        log_isrf=center["log_isrf"],
+        log_radius=center["log_radius"],
+        redshift=redshift,
+        cosmic_ray=cosmic_ray,
+    )
+
+
 def create_in_file(file_name, center, redshift, cosmic_ray):
     
-    log_hden = "{:.5f}".format(center["log_hden"])
-    log_metallicity = "{:.5f}".format(center["log_metallicity"])
-    log_turbulence = "{:.5f}".format(center["log_turbulence"])
-    log_isrf = "{:.5f}".format(center["log_isrf"])
-    log_radius = "{:.5f}".format(center["log_radius"])
-    
     try:
         with open(file_name, "w") as fp:
-            fp.write("title Parallel Plane Slab DT\n")
-            fp.write("set nend 4000\n")  # Set number limiting number of zones.
-            fp.write(f"table ISM factor {log_isrf} log\n")
-            fp.write("radius 30\n")
-            fp.write(f"hden {log_hden} log\n")
-            fp.write(f"CMB, z={redshift:.5f}\n")
-            fp.write("abundances ISM\n")
-            fp.write(f"metals and grains {log_metallicity} log\n")
-            fp.write(f"turbulence {log_turbulence} km/sec log\n")
-            fp.write(f"cosmic rays background {cosmic_ray:.3f} linear\n")
-            fp.write(f"stop thickness {log_radius} log parsec\n")  # This sets the stopping radius
-            fp.write("stop temperature off\n")
-            # fp.write("iterate\n")  # iterate to converge option might be better
-            fp.write("iterate to converge\n")
-            fp.write("print line sort intensity\n")
-            # fp.write("element carbon isotopes (12, 5) (13, 1)\n")
-            fp.write("save lines, emissivity, \"_em.str\"\n")
-            fp.write("H  1 1215.67 # Lya\n")
-            fp.write("H  1 6562.80 # Ha\n")
-            fp.write("H  1 4861.32 # Hb\n")
-            fp.write("CO  2600.05m # CO(1-0)\n")
-            fp.write("CO  1300.05m # CO(2-1)\n")
-            fp.write("CO  866.727m # CO(3-2)\n")
-            fp.write("CO  650.074m # CO(4-3)\n")
-            fp.write("CO  520.089m # CO(5-4)\n")
-            fp.write("CO  433.438m # CO(6-5)\n")
-            fp.write("CO  371.549m # CO(7-6)\n")
-            fp.write("CO  325.137m # CO(8-7)\n")
-            fp.write("\"^13CO\" 2719.67m\n")
-            fp.write("C  2 157.636m\n")
-            fp.write("O  3 88.3323m\n")
-            fp.write("O  3 5006.84 # wavelength in Angstrom\n")
-            fp.write("O  3 4958.91 # wavelength in Angstrom\n")
-            fp.write("end of lines\n")
-            fp.write("save lines, array, \".lines\"\n")
-            fp.write("save grain abundance \".gbu\"\n")
-            fp.write("save performance \".per\"\n")
-            fp.write("save overveiw last \".ovr\"\n")
-            fp.write("save monitors last \".asr\"\n")
-            fp.write("save temperature last \".tem\"\n")
-            fp.write("save overview \".ovr1\"\n")
-            fp.write("save molecules last \".mol\"\n")
-            fp.write("save molecules \".mol1\"\n")
-            fp.write("save heating \".het\"\n")
-            fp.write("save cooling \".col\" # Column densities\n")
-            fp.write("save dr last \".dr\"\n")
-            fp.write("save results last \".rlt\"\n")
-            fp.write("save continuum last \".con\" units microns\n")
-            fp.write("Save line labels [long] [no index] \".labels\"\n")
-            fp.write("print line optical depths \".tau\"\n")
+            fp.write(render_in_file(center, redshift, cosmic_ray))
 
         # print(f"File {file_name} created!")
 
@@ -153,6 +176,66 @@ def create_in_file(file_name, center, redshift, cosmic_ray):
         print(f"Error opening file: {e}")
 
 
+def create_grid(fdir, centers, redshift, cosmic_ray, max_threads=16, dry_run=False, verbose=False):
+    """
+    Creates the directories and .in files of all centers that do not have them yet. The grid directory is listed once instead of calling 
+    os.makedirs for every center and .in files are only looked for in the directories that already exist. Directories and files are created
+    with a pool of max_threads threads. If dry_run is True nothing is created, only the number of directories and files that would be 
+    created are reported. Returns (number of directories, number of .in files) that are (or would be) created.
+    """
+
+    start = time()
+
+    names = directory_names(centers)
+    records = centers.to_dict("records")
+
+    # One listing of the grid directory instead of one makedirs call per center
+    existing_directories = set(os.listdir(fdir))
+    is_directory_missing = np.array([name not in existing_directories for name in names], dtype=bool)
+
+    def in_file_exists(directory_name):
+        return os.path.isfile(f"{fdir}/{directory_name}/{directory_name}.in")
+
+    has_in_file = np.zeros(len(names), dtype=bool)
+    existing_rows = np.flatnonzero(~is_directory_missing)
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        has_in_file[existing_rows] = list(executor.map(in_file_exists, [names[i] for i in existing_rows]))
+
+    rows_to_create = np.flatnonzero(~has_in_file)
+    number_of_directories = int(np.sum(is_directory_missing))
+    number_of_in_files = len(rows_to_create)
+
+    print(f"{number_of_directories} directories and {number_of_in_files} .in files {'would be' if dry_run else 'will be'} created. "
+          f"{len(names) - number_of_in_files} runs already have a .in file.")
+
+    if dry_run:
+        return number_of_directories, number_of_in_files
+
+    def create_run(row):
+        directory_name = names[row]
+        try:
+            if is_directory_missing[row]:
+                os.makedirs(f"{fdir}/{directory_name}", mode=0o777, exist_ok=True)  # 0777 permission in Python
+
+            with open(f"{fdir}/{directory_name}/{directory_name}.in", "w") as fp:
+                fp.write(render_in_file(records[row], redshift, cosmic_ray))
+
+            return True
+
+        except Exception as e:
+            if (verbose): print(f"Unable to create directory or .in file: {directory_name}. Error: {e}\n")
+            return False
+
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        created = list(executor.map(create_run, rows_to_create))
+
+    number_of_created = sum(created)
+    print(f"{number_of_created} .in files are created. {len(created) - number_of_created} failed.")
+    print(f"It took {round((time() - start) / 60, 3)} minutes to create the grid")
+
+    return number_of_directories, number_of_in_files
+
+
 ##########################################################################################################################################################################################
 
 if __name__ == "__main__":
@@ -163,4 +246,4 @@ if __name__ == "__main__":
     # Niagara clusters
     fdir = "/scratch/m/murray/dtolgay/cloudy_runs/z_0/cr_1_CO87_CII_H_O3/cr_1_CO87_CII_H_O3_metallicity_above_minus_2"
 
-    main(fdir=fdir, verbose=False)
\ No newline at end of file
+    main(fdir=fdir, verbose=False, shard=shard_from_argv())
\ No newline at end of file
@@ -0,0 +1,311 @@
+# Imports
+import os
+import re
+import sys
+import numpy as np
+import pandas as pd
+
+from run_status_manifest import (
+    read_centers_file, create_manifest, read_manifest, write_manifest, directory_names, find_rows, CENTER_COLUMNS, MANIFEST_FILE_NAME
+)
+from results_store import read_results, read_metadata, write_results, sidecar_file_path
+from runtime_model import read_runtime_model, predict_runtime, pack_into_jobs
+
+
+################################################################################
+# Splits a grid over the tasks of a SLURM job array. Every script that takes a shard (create_cloudy_directories_and_files.py,
+# run_cloudy_grid.py, run_status_manifest.py, the post-processing scripts) is called with
+#
+#   python <script>.py --shard i/N        (0 <= i < N, e.g. --shard ${SLURM_ARRAY_TASK_ID}/N with --array=0-(N-1))
+#
+# and processes only the centers of shard i. Centers are given to the shards with the same predicted total runtime if runtime_model.json
+# exists (see runtime_model.py) and one after the other (center j to shard j % N) otherwise. The split is made once for N shards by the
+# first task and saved to <base_file_dir>/shard_assignment_<N>.npy (centers and shard), so every script gives the same centers to the same
+# shard even if runtime_model.json is written or refitted later. Centers appended to centers.txt are added to the saved split one after the
+# other; the saved centers must stay the first rows of centers.txt.
+#
+# The outputs of a shard are written with _shard<i>of<N> added to their name (e.g. I_line_values_without_reversing_shard003of010.txt).
+# After all shards are finished
+#
+#   python grid_shards.py <base_file_dir> <N>
+#
+# merges them into the usual output files with the rows in the order of centers.txt.
+################################################################################
+
+ASSIGNMENT_DTYPE = np.dtype([(column, np.float64) for column in CENTER_COLUMNS] + [("shard", np.int32)])
+
+# Outputs that are merged. Text tables (.txt written by np.savetxt, .csv) and tables written by results_store.py are recognized.
+MERGED_OUTPUT_NAMES = ["I_line_values_without_reversing", "other_properties", "post_processed_runs"]
+
+
+# Main
+def main(base_file_dir, number_of_shards):
+
+    merge_manifests(base_file_dir, number_of_shards)
+
+    for name in MERGED_OUTPUT_NAMES:
+        merge_output(base_file_dir, name, number_of_shards)
+
+    return 0
+
+
+# Functions
+
+def parse_shard(text):
+    # "i/N" -> (i, N)
+
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", text)
+    if match is None:
+        raise ValueError(f"Shard must be given as i/N, got {text}")
+
+    shard = (int(match.group(1)), int(match.group(2)))
+    if not (0 <= shard[0] < shard[1]):
+        raise ValueError(f"Shard {text}: i must be between 0 and N - 1")
+
+    return shard
+
+
+def shard_from_argv(argv=None):
+    # Returns (i, N) given with --shard i/N (or --shard=i/N) on the command line, None if there is no --shard
+
+    argv = sys.argv[1:] if argv is None else argv
+
+    for i, argument in enumerate(argv):
+        if argument == "--shard" and i + 1 < len(argv):
+            return parse_shard(argv[i + 1])
+        if argument.startswith("--shard="):
+            return parse_shard(argument[len("--shard="):])
+
+    return None
+
+
+def shard_name(name, shard):
+    # Name of the output of a shard. name itself if shard is None.
+
+    if shard is None:
+        return name
+
+    return f"{name}_shard{shard[0]:03d}of{shard[1]:03d}"
+
+
+def assignment_file_path(base_file_dir, number_of_shards):
+
+    return f"{base_file_dir}/shard_assignment_{number_of_shards}.npy"
+
+
+def shard_assignment(base_file_dir, centers, number_of_shards):
+    """
+    Returns the shard of each center. The assignment saved in shard_assignment_<N>.npy is used if it exists. It is computed and saved
+    otherwise, and extended if centers has more rows than the saved assignment. Raises ValueError if the saved centers are not the first
+    rows of centers (centers.txt is reordered or edited).
+    """
+
+    file_path = assignment_file_path(base_file_dir, number_of_shards)
+    fdirs = directory_names(centers)
+
+    if os.path.isfile(file_path):
+        assignment = check_assignment(np.load(file_path), fdirs, file_path)
+        if len(assignment) == len(fdirs):
+            return assignment["shard"]
+
+        # Appended centers are given to the shards one after the other, so every task saves the same file
+        shards = (len(assignment) + np.arange(len(fdirs) - len(assignment))) % number_of_shards
+        assignment = np.concatenate([assignment, assignment_table(centers.iloc[len(assignment):], shards)])
+        publish_assignment(assignment, file_path, replace=True)
+        print(f"{len(shards)} centers are added to {file_path}")
+
+    else:
+        model = read_runtime_model(base_file_dir)
+        if model is None:
+            shards = np.arange(len(centers)) % number_of_shards
+        else:
+            shards, totals = pack_into_jobs(predict_runtime(model, centers), number_of_shards)
+
+        # The first task that saves the assignment wins, the others use its file
+        publish_assignment(assignment_table(centers, shards), file_path, replace=False)
+
+    return check_assignment(np.load(file_path), fdirs, file_path)["shard"]
+
+
+def assignment_table(centers, shards):
+
+    assignment = np.zeros(len(centers), dtype=ASSIGNMENT_DTYPE)
+    for column in CENTER_COLUMNS:
+        assignment[column] = centers[column]
+    assignment["shard"] = shards
+
+    return assignment
+
+
+def check_assignment(assignment, fdirs, file_path):
+    # Returns the rows of the saved assignment that are in fdirs. Their centers must be the first centers of fdirs.
+
+    saved_fdirs = directory_names(assignment)
+    number_of_rows = min(len(saved_fdirs), len(fdirs))
+    if (len(saved_fdirs) > len(fdirs)) or (saved_fdirs[:number_of_rows] != fdirs[:number_of_rows]):
+        raise ValueError(
+            f"The centers in {file_path} are not the first centers of centers.txt. Remove the file to split the grid again "
+            "(only when no shard is running)."
+        )
+
+    return assignment
+
+
+def publish_assignment(assignment, file_path, replace):
+    # Writes a temporary file and links it to file_path, so the other tasks never read a half written file. If replace is False the file
+    # is not changed if it already exists.
+
+    temporary_file_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(temporary_file_path, "wb") as file:
+        np.save(file, assignment)
+
+    try:
+        if replace:
+            os.replace(temporary_file_path, file_path)
+        else:
+            os.link(temporary_file_path, file_path)
+    except FileExistsError:
+        pass
+    finally:
+        if os.path.exists(temporary_file_path):
+            os.remove(temporary_file_path)
+
+    return 0
+
+
+def select_shard(base_file_dir, centers, shard):
+    """
+    Returns the centers (DataFrame with the CENTER_COLUMNS) of the given shard in their original order with a new index starting from 0.
+    All centers are returned if shard is None. The shards are always made from centers.txt of the grid, so centers can be another centers
+    file (e.g. centers_rerun_<reason>.txt or centers_refinement.txt): its centers that are in the shard are returned. Centers that are not
+    in centers.txt are in no shard.
+    """
+
+    if shard is None:
+        return centers
+
+    grid_centers = read_centers_file(base_file_dir)
+    grid_shards = shard_assignment(base_file_dir, grid_centers, shard[1])
+
+    fdirs = directory_names(centers)
+    grid_fdirs = directory_names(grid_centers)
+    if fdirs == grid_fdirs:
+        rows = grid_shards == shard[0]
+    else:
+        grid_rows = find_rows(grid_fdirs, fdirs)
+        if np.any(grid_rows < 0):
+            print(f"{np.sum(grid_rows < 0)} centers are not in centers.txt. They are in no shard.")
+        rows = (grid_rows >= 0) & (grid_shards[np.maximum(grid_rows, 0)] == shard[0])
+
+    print(f"Shard {shard[0]}/{shard[1]}: {np.sum(rows)} of {len(centers)} centers")
+
+    return centers[rows].reset_index(drop=True)
+
+
+def merge_manifests(base_file_dir, number_of_shards):
+    # Copies the rows of the shard manifests (written by run_status_manifest.py with a shard) to the manifest of the grid
+
+    shard_file_names = [
+        f"{shard_name(MANIFEST_FILE_NAME[:-len('.npy')], (i, number_of_shards))}.npy" for i in range(number_of_shards)
+    ]
+    shard_file_names = [file_name for file_name in shard_file_names if os.path.isfile(f"{base_file_dir}/{file_name}")]
+    if len(shard_file_names) == 0:
+        return 0
+
+    if os.path.isfile(f"{base_file_dir}/{MANIFEST_FILE_NAME}"):
+        manifest = read_manifest(base_file_dir)
+    else:
+        manifest = create_manifest(read_centers_file(base_file_dir))
+
+    fdirs = directory_names(manifest)
+    for file_name in shard_file_names:
+        shard_manifest = read_manifest(base_file_dir, file_name)
+        rows = find_rows(fdirs, directory_names(shard_manifest))
+
+        # Columns are copied by name, manifests written by older versions have other columns
+        for column in manifest.dtype.names:
+            if column in shard_manifest.dtype.names:
+                manifest[column][rows[rows >= 0]] = shard_manifest[column][rows >= 0]
+
+    write_manifest(manifest, base_file_dir)
+    print(f"{len(shard_file_names)} shard manifests are merged into {base_file_dir}/{MANIFEST_FILE_NAME}")
+
+    return 0
+
+
+def read_text_table(file_path):
+    # Returns the table and the header (without the leading "# ") of a file written by np.savetxt
+
+    header_lines = []
+    with open(file_path, "r") as file:
+        for line in file:
+            if not line.startswith("#"):
+                break
+            header_lines.append(line.rstrip("\n")[2:])
+
+    return np.loadtxt(file_path, ndmin=2), "\n".join(header_lines)
+
+
+def merge_output(base_file_dir, name, number_of_shards):
+    """
+    Merges the outputs of the shards of the table name into <base_file_dir>/<name> with the same format. The rows are put in the order of
+    centers.txt by matching the center columns. Centers that are in none of the shards get NaN values. Nothing is done if the first shard
+    has no output with this name.
+    """
+
+    names = [shard_name(name, (i, number_of_shards)) for i in range(number_of_shards)]
+
+    if os.path.isfile(f"{base_file_dir}/{names[0]}.txt"):
+        output_format = "txt"
+    elif os.path.isfile(f"{base_file_dir}/{names[0]}.csv"):
+        output_format = "csv"
+    elif os.path.isfile(sidecar_file_path(base_file_dir, names[0])):
+        output_format = read_metadata(base_file_dir, names[0])["backend"]
+    else:
+        return 0
+
+    tables = []
+    for shard_output_name in names:
+        if output_format == "txt":
+            table, header = read_text_table(f"{base_file_dir}/{shard_output_name}.txt")
+            tables.append(pd.DataFrame(table))
+        elif output_format == "csv":
+            tables.append(pd.read_csv(f"{base_file_dir}/{shard_output_name}.csv", float_precision="round_trip"))
+        else:
+            tables.append(read_results(base_file_dir, shard_output_name, mmap=False))
+
+    table = pd.concat(tables, ignore_index=True)
+
+    # The first five columns of every output are the centers in the order of CENTER_COLUMNS
+    centers = read_centers_file(base_file_dir)
+    rows = find_rows(directory_names(table.set_axis(CENTER_COLUMNS + list(table.columns[5:]), axis=1)), directory_names(centers))
+
+    merged = pd.DataFrame(np.nan, index=range(len(centers)), columns=table.columns)
+    merged.iloc[rows >= 0] = table.iloc[rows[rows >= 0]].to_numpy()
+    merged.iloc[:, :5] = centers.to_numpy()
+
+    print(f"{np.sum(rows >= 0)} of {len(centers)} centers are found in the {number_of_shards} shards of {name}")
+
+    if output_format == "txt":
+        np.savetxt(fname=f"{base_file_dir}/{name}.txt", X=merged.to_numpy(), fmt="%.8e", header=header)
+        print(f"File written to {base_file_dir}/{name}.txt")
+    elif output_format == "csv":
+        merged.to_csv(f"{base_file_dir}/{name}.csv", index=False)
+        print(f"File written to {base_file_dir}/{name}.csv")
+    else:
+        metadata = read_metadata(base_file_dir, names[0])
+        write_results(
+            df=merged,
+            base_file_dir=base_file_dir,
+            name=name,
+            units=metadata["units"],
+            backend=output_format,
+            float32=metadata["dtype"] == "float32",
+        )
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    main(base_file_dir=sys.argv[1], number_of_shards=int(sys.argv[2]))
@@ -0,0 +1,184 @@
+# Imports
+import json
+import socket
+import threading
+import multiprocessing
+from time import time, perf_counter
+from contextlib import contextmanager
+
+
+################################################################################
+# Progress reports and stage timers shared by the scripts.
+#
+# The hot paths time themselves with the stage timer of their process:
+#
+#   with stage("parse"):
+#       ...
+#   add_bytes("read", len(content))
+#
+# Stages: stat (os.stat of the .out files), read (bytes read from the files), parse (text to floats), integrate (line integrals and
+# averages over the zones) and write (output files). A worker process returns its totals with collect_stages(function, ...) and the
+# parent adds them to its own with merge_stages. Seconds of the stages are summed over all processes, so with many workers they can be
+# larger than the wall time. If read has a low MB/s compared to parse the grid is bound by the file system, otherwise by the CPU.
+#
+# Progress prints the number of finished runs, runs per second and the ETA at most every PROGRESS_INTERVAL_SECONDS. write_summary writes
+# the totals to <base_file_dir>/<name>_summary.json next to the outputs.
+################################################################################
+
+STAGES = ["stat", "read", "parse", "integrate", "write"]
+
+PROGRESS_INTERVAL_SECONDS = 60
+
+# Totals of the stages in this process: name -> {"seconds", "calls", "bytes"}. Files can be read by threads (see run_prefetch.py).
+_stages = {}
+_lock = threading.Lock()
+
+
+# Functions
+
+def new_stage_totals():
+
+    return {"seconds": 0.0, "calls": 0, "bytes": 0}
+
+
+@contextmanager
+def stage(name):
+    # Adds the time spent in the block to the stage
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        seconds = perf_counter() - start
+        with _lock:
+            totals = _stages.setdefault(name, new_stage_totals())
+            totals["seconds"] += seconds
+            totals["calls"] += 1
+
+
+def add_bytes(name, number_of_bytes):
+
+    with _lock:
+        _stages.setdefault(name, new_stage_totals())["bytes"] += int(number_of_bytes)
+
+
+def get_stages():
+    # Copy of the totals of this process
+
+    with _lock:
+        return {name: dict(totals) for name, totals in _stages.items()}
+
+
+def reset_stages():
+
+    with _lock:
+        _stages.clear()
+
+
+def merge_stages(stages):
+    # Adds the totals of another process (returned by collect_stages) to the totals of this process
+
+    with _lock:
+        for name, totals in stages.items():
+            merged = _stages.setdefault(name, new_stage_totals())
+            for key in merged:
+                merged[key] += totals[key]
+
+
+def collect_stages(function, *args, **kwargs):
+    """
+    Runs function in a worker process and returns (result, stage totals of the call). The parent calls merge_stages with the totals. If
+    it is called in the parent process (e.g. max_workers == 1) the totals are already in the parent and an empty dictionary is returned.
+    """
+
+    if multiprocessing.parent_process() is None:
+        return function(*args, **kwargs), {}
+
+    reset_stages()
+    result = function(*args, **kwargs)
+
+    return result, get_stages()
+
+
+class Progress:
+    # Prints the progress of number_of_runs runs: finished, left, runs per second and the ETA
+
+    def __init__(self, number_of_runs, name="", interval_seconds=PROGRESS_INTERVAL_SECONDS):
+
+        self.number_of_runs = number_of_runs
+        self.name = name
+        self.interval_seconds = interval_seconds
+        self.start = time()
+        self.last_print = self.start
+        self.number_of_finished = 0
+
+    def update(self, number_of_finished, force=False):
+        # number_of_finished is the total number of finished runs so far
+
+        self.number_of_finished = number_of_finished
+
+        now = time()
+        if not force and (now - self.last_print < self.interval_seconds) and (number_of_finished < self.number_of_runs):
+            return 0
+        self.last_print = now
+
+        elapsed = now - self.start
+        runs_per_second = number_of_finished / elapsed if elapsed > 0 else 0.0
+        left = self.number_of_runs - number_of_finished
+        eta = f"{left / runs_per_second / 60:.2f} minutes" if runs_per_second > 0 else "unknown"
+
+        print(
+            f"{self.name}{' ' if self.name else ''}{number_of_finished} finished. Left {left}. "
+            f"{runs_per_second:.1f} runs/s. Time passed is {elapsed / 60:.3f} minutes. ETA: {eta}"
+        )
+
+        return 0
+
+    def add(self, number_of_runs):
+
+        return self.update(self.number_of_finished + number_of_runs)
+
+    def elapsed(self):
+
+        return time() - self.start
+
+
+def summary(progress, max_workers=1, stages=None, extra=None):
+    # Dictionary with the wall time, throughput, stage totals (of this process if stages is None) and the items of extra
+
+    stages = get_stages() if stages is None else stages
+    wall_time = progress.elapsed()
+
+    return dict(extra or {}, **{
+        "host": socket.gethostname(),
+        "number_of_runs": progress.number_of_runs,
+        "number_of_finished": progress.number_of_finished,
+        "max_workers": max_workers,
+        "wall_time_seconds": wall_time,
+        "runs_per_second": progress.number_of_finished / wall_time if wall_time > 0 else None,
+        "stages": {
+            name: dict(
+                totals,
+                mb_per_second=totals["bytes"] / 1e6 / totals["seconds"] if totals["seconds"] > 0 and totals["bytes"] > 0 else None,
+            )
+            for name, totals in stages.items()
+        },
+    })
+
+
+def write_summary(base_file_dir, name, progress, max_workers=1, extra=None):
+    # Writes the summary to <base_file_dir>/<name>_summary.json and prints the stages
+
+    result = summary(progress, max_workers, extra=extra)
+
+    for stage_name, totals in result["stages"].items():
+        mb_per_second = f", {totals['mb_per_second']:.1f} MB/s" if totals["mb_per_second"] is not None else ""
+        print(f"{stage_name}: {totals['seconds']:.2f} s in {totals['calls']} calls{mb_per_second}")
+
+    fname = f"{base_file_dir}/{name}_summary.json"
+    with open(fname, "w") as file:
+        json.dump(result, file, indent=4)
+
+    print(f"File written to {fname}")
+
+    return 0
@@ -0,0 +1,318 @@
+# Imports
+import os
+import sys
+import pickle
+import numpy as np
+from time import time
+from scipy.spatial import cKDTree
+from scipy.interpolate import RegularGridInterpolator
+
+from results_store import read_results, parse_column_header
+from grid_shards import read_text_table
+from run_status_manifest import CENTER_COLUMNS
+
+
+################################################################################
+# Maps gas particles onto a post-processed grid (I_line_values_without_reversing, or any other table whose first five columns are the
+# CENTER_COLUMNS). A KD-tree is built over the centers of the runs that have values and it is saved to <base_file_dir>/<name>_kdtree.pkl,
+# so later calls only load it. It is built again if the table changes.
+#
+#   lookup = load_lookup(base_file_dir)
+#   values = lookup.nearest(particles)              # particles: (number of particles, 5) in the order of CENTER_COLUMNS
+#   values = lookup.idw(particles, k=8, power=2)    # inverse distance weighting of the k nearest runs
+#   values = lookup.linear(particles)               # multilinear, only if the centers make a regular grid
+#
+# Distances are measured in grid steps: every parameter is divided by the smallest spacing of its values, so a step in log_hden and a step
+# in log_radius count the same. Rows of broken runs (all values NaN) are not put in the tree. Single NaN values are skipped in the
+# weighted averages of idw. linear gives NaN next to broken runs and outside the grid; these particles are calculated with idw.
+#
+# Intensities change by orders of magnitude between the runs, so idw and linear interpolate log10 of the values and return 10**result
+# (LOG_INTERPOLATION). As in refine_grid.py, values are floored at the smallest positive value of their column before the log is taken, so
+# lines that are not emitted (0) are interpolated as the floor of their column. nearest returns the values of the run as they are.
+#
+# Particles are processed in chunks of CHUNK_SIZE (idw holds k values of every column for each particle of the chunk), so millions of
+# particles can be queried with a limited amount of memory.
+#
+#   python intensity_lookup.py <base_file_dir> <particles file> <nearest|idw|linear> <output file>
+#
+# The particles file has one particle per line with the 5 CENTER_COLUMNS. The output has the particles followed by the value columns.
+################################################################################
+
+# Global variables
+TABLE_NAME = "I_line_values_without_reversing"
+INDEX_SUFFIX = "_kdtree.pkl"
+
+CHUNK_SIZE = 100000
+
+# Number of threads used by the KD-tree queries. -1 uses all cores.
+WORKERS = -1
+
+# If True idw and linear interpolate log10 of the values. False interpolates the values (e.g. for tables with negative values).
+LOG_INTERPOLATION = True
+
+
+# Main
+def main(base_file_dir, particles_file_path, method, output_file_path, name=TABLE_NAME):
+
+    start = time()
+
+    lookup = load_lookup(base_file_dir, name)
+    particles = np.loadtxt(particles_file_path, ndmin=2)
+    print(f"{len(particles)} particles are read from {particles_file_path}")
+
+    if method == "nearest":
+        values = lookup.nearest(particles)
+    elif method == "idw":
+        values = lookup.idw(particles)
+    elif method == "linear":
+        values = lookup.linear(particles)
+    else:
+        raise ValueError(f"Unknown method {method}. Possible methods: nearest, idw, linear")
+
+    np.savetxt(
+        fname=output_file_path,
+        X=np.column_stack([particles, values]),
+        fmt="%.8e",
+        header=" ".join(CENTER_COLUMNS + lookup.columns),
+    )
+    print(f"File written to {output_file_path}")
+    print(f"It took {round((time() - start) / 60, 3)} minutes to look up the particles")
+
+    return 0
+
+
+# Functions
+
+def table_file_path(base_file_dir, name):
+    # Text table if it exists, otherwise the binary table of results_store.py
+
+    for extension in ["txt", "npy", "parquet"]:
+        if os.path.isfile(f"{base_file_dir}/{name}.{extension}"):
+            return f"{base_file_dir}/{name}.{extension}"
+
+    raise FileNotFoundError(f"There is no {name}.txt, {name}.npy or {name}.parquet in {base_file_dir}")
+
+
+def read_table(base_file_dir, name=TABLE_NAME):
+    # Returns the centers (number of rows, 5), the values (number of rows, number of value columns) and the names of the value columns
+
+    file_path = table_file_path(base_file_dir, name)
+
+    if file_path.endswith(".txt"):
+        table, header = read_text_table(file_path)
+        columns, units = parse_column_header(header)
+        columns = columns[len(CENTER_COLUMNS):] if len(columns) == table.shape[1] else [str(i) for i in range(len(CENTER_COLUMNS), table.shape[1])]
+    else:
+        df = read_results(base_file_dir, name, mmap=False)
+        table, columns = df.to_numpy(dtype=np.float64), list(df.columns[len(CENTER_COLUMNS):])
+
+    return table[:, :len(CENTER_COLUMNS)], table[:, len(CENTER_COLUMNS):], columns
+
+
+def log_values(values):
+    # log10 of the values. Each column is floored at its smallest positive value first (1 if it has none). NaN stays NaN.
+
+    floors = np.array([np.min(column[column > 0], initial=np.inf) for column in values.T])
+    floors[~np.isfinite(floors)] = 1
+
+    return np.log10(np.maximum(values, floors))
+
+
+def grid_steps(centers):
+    # Smallest spacing of the values of each parameter. 1 for parameters with a single value.
+
+    steps = np.ones(centers.shape[1])
+    for i in range(centers.shape[1]):
+        spacings = np.diff(np.unique(centers[:, i]))
+        spacings = spacings[spacings > 1e-8]
+        if len(spacings) > 0:
+            steps[i] = spacings.min()
+
+    return steps
+
+
+class IntensityLookup:
+    # KD-tree over the centers with values. Pickled by save_lookup. If log is True idw and linear interpolate log10 of the values.
+
+    def __init__(self, centers, values, columns, log=LOG_INTERPOLATION):
+
+        self.columns = list(columns)
+        self.log = log
+
+        # Broken runs have NaN in every column and are left out
+        has_values = ~np.all(np.isnan(values), axis=1)
+        self.centers = np.ascontiguousarray(centers[has_values], dtype=np.float64)
+        self.values = np.ascontiguousarray(values[has_values], dtype=np.float64)
+        print(f"{np.sum(has_values)} of {len(centers)} runs have values. {np.sum(~has_values)} broken runs are left out.")
+
+        # Values that are averaged by idw and linear
+        interpolated_values = log_values(values) if log else values
+        self.interpolated_values = np.ascontiguousarray(interpolated_values[has_values], dtype=np.float64)
+
+        self.steps = grid_steps(centers)
+        self.tree = cKDTree(self.centers / self.steps)
+
+        # Multilinear interpolator over the parameters with more than one value, None if the centers are not a regular grid
+        self.interpolator, self.interpolated_axes = regular_grid(centers, interpolated_values)
+
+    def query(self, points, k):
+        # Distances (in grid steps) and rows of the k nearest runs
+
+        points = np.asarray(points, dtype=np.float64)
+        if points.ndim != 2 or points.shape[1] != len(CENTER_COLUMNS):
+            raise ValueError(f"Points must have shape (number of points, {len(CENTER_COLUMNS)}), got {points.shape}")
+
+        return self.tree.query(points / self.steps, k=k, workers=WORKERS)
+
+    def nearest(self, points, chunk_size=CHUNK_SIZE):
+        # Values of the nearest run with values
+
+        values = np.empty((len(points), len(self.columns)))
+        for start in range(0, len(points), chunk_size):
+            distances, rows = self.query(points[start : start + chunk_size], k=1)
+            values[start : start + chunk_size] = self.values[rows]
+
+        return values
+
+    def idw(self, points, k=8, power=2, chunk_size=CHUNK_SIZE):
+        """
+        Inverse distance weighted average of the values (log10 of the values if self.log) of the k nearest runs, weights are
+        1 / distance**power. NaN values are left out of the average of their column. Particles at the position of a run get the values of
+        the run.
+        """
+
+        k = min(k, len(self.centers))
+        values = np.empty((len(points), len(self.columns)))
+
+        for start in range(0, len(points), chunk_size):
+            distances, rows = self.query(points[start : start + chunk_size], k=k)
+            distances, rows = distances.reshape(len(rows), k), rows.reshape(len(rows), k)
+
+            with np.errstate(divide="ignore"):
+                weights = 1 / distances**power
+
+            # Exact matches: only the runs at the position of the particle are used
+            exact = distances == 0
+            has_exact = np.any(exact, axis=1)
+            weights[has_exact] = exact[has_exact]
+
+            neighbour_values = self.interpolated_values[rows]  # (particles, k, columns)
+            is_nan = np.isnan(neighbour_values)
+            weights = np.where(is_nan, 0.0, weights[:, :, None])
+
+            with np.errstate(invalid="ignore"):
+                values[start : start + chunk_size] = np.sum(weights * np.where(is_nan, 0.0, neighbour_values), axis=1) / np.sum(weights, axis=1)
+
+        return 10**values if self.log else values
+
+    def linear(self, points, chunk_size=CHUNK_SIZE):
+        # Multilinear interpolation on the regular grid. Particles outside the grid or next to a broken run are calculated with idw.
+
+        if self.interpolator is None:
+            raise ValueError("Centers do not make a regular grid. Use nearest or idw.")
+
+        values = np.empty((len(points), len(self.columns)))
+        for start in range(0, len(points), chunk_size):
+            chunk = np.asarray(points[start : start + chunk_size], dtype=np.float64)
+            chunk_values = self.interpolator(chunk[:, self.interpolated_axes])
+            if self.log:
+                chunk_values = 10**chunk_values
+
+            missing = np.any(np.isnan(chunk_values), axis=1)
+            if np.any(missing):
+                chunk_values[missing] = self.idw(chunk[missing])
+
+            values[start : start + chunk_size] = chunk_values
+
+        return values
+
+
+def regular_grid(centers, values):
+    """
+    Returns (RegularGridInterpolator, parameters it interpolates over) if every combination of the parameter values is a center exactly
+    once, (None, None) otherwise. Parameters with a single value are left out of the interpolation. Broken runs are NaN in the grid.
+    """
+
+    axes = [np.unique(centers[:, i]) for i in range(centers.shape[1])]
+    shape = tuple(len(axis) for axis in axes)
+    indices = tuple(np.searchsorted(axis, centers[:, i]) for i, axis in enumerate(axes))
+
+    if (int(np.prod(shape)) != len(centers)) or (len(np.unique(np.ravel_multi_index(indices, shape))) != len(centers)):
+        return None, None
+
+    grid_values = np.full(shape + (values.shape[1],), np.nan)
+    grid_values[indices] = values
+
+    kept = [i for i, axis in enumerate(axes) if len(axis) > 1]
+    interpolator = RegularGridInterpolator(
+        [axes[i] for i in kept],
+        grid_values.reshape([len(axes[i]) for i in kept] + [values.shape[1]]),
+        method="linear",
+        bounds_error=False,
+        fill_value=np.nan,
+    )
+
+    return interpolator, kept
+
+
+def index_file_path(base_file_dir, name=TABLE_NAME):
+
+    return f"{base_file_dir}/{name}{INDEX_SUFFIX}"
+
+
+def table_signature(base_file_dir, name, log=LOG_INTERPOLATION):
+    # Path, mtime and size of the table and whether log10 of the values is interpolated. The index is built again if they change.
+
+    file_path = table_file_path(base_file_dir, name)
+    stat = os.stat(file_path)
+
+    return (file_path, stat.st_mtime_ns, stat.st_size, log)
+
+
+def load_lookup(base_file_dir, name=TABLE_NAME, rebuild=False, log=LOG_INTERPOLATION):
+    """
+    Returns the IntensityLookup of the table name. The saved index is used if it was built from the current table with the same log,
+    otherwise the index is built and saved to <base_file_dir>/<name>_kdtree.pkl.
+    """
+
+    signature = table_signature(base_file_dir, name, log)
+    file_path = index_file_path(base_file_dir, name)
+
+    if not rebuild and os.path.isfile(file_path):
+        with open(file_path, "rb") as file:
+            saved = pickle.load(file)
+        if saved["signature"] == signature:
+            print(f"Index is read from {file_path}")
+            return saved["lookup"]
+        print(f"{file_path} is built from an older table or with another LOG_INTERPOLATION. Building it again.")
+
+    start = time()
+    centers, values, columns = read_table(base_file_dir, name)
+    lookup = IntensityLookup(centers, values, columns, log)
+    print(f"It took {round(time() - start, 2)} seconds to build the index")
+
+    save_lookup(lookup, signature, file_path)
+
+    return lookup
+
+
+def save_lookup(lookup, signature, file_path):
+
+    # Written to a temporary file first so that a reader never sees a partial file
+    with open(f"{file_path}.tmp", "wb") as file:
+        pickle.dump({"signature": signature, "lookup": lookup}, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{file_path}.tmp", file_path)
+
+    print(f"Index written to {file_path}")
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    main(
+        base_file_dir=sys.argv[1],
+        particles_file_path=sys.argv[2],
+        method=sys.argv[3],
+        output_file_path=sys.argv[4],
+    )
@@ -0,0 +1,172 @@
+# Imports
+import re
+from functools import lru_cache
+
+from cloudy_file_readers import read_header, source_name
+
+
+################################################################################
+# The lines of the grid are listed once here. The list is used to
+#
+#   - write the "save lines, emissivity" block of the .in files (create_cloudy_directories_and_files.py),
+#   - find the column of each line in the header of the _em.str files when they are read (calculate_intensity_finished_cloudy_jobs_2.py).
+#     Columns are found by the species and the wavelength of the line, not by their position, so an _em.str file written with another
+#     list of lines is read correctly or raises a KeyError if a line is not in it,
+#   - write the header of the output tables (OUTPUT_HEADER).
+#
+# Every line has:
+#   name:        name used in the scripts (COLUMNS_EMISSIVITY)
+#   label:       line label as written in the .in file. Species (in quotes if it starts with "^") and wavelength. The wavelength is in
+#                Angstrom unless it ends with "m" (micron) or "c" (cm).
+#   output_name: name of the intensity column in the output tables
+#   comment:     comment written after the label in the .in file ("" for no comment)
+#
+# To add a line to the runs add it to LINES. Scripts that need only some of the lines read only their columns (select_lines).
+################################################################################
+
+LINES = [
+    {"name": "ly_alpha", "label": "H  1 1215.67", "output_name": "I_ly_alpha", "comment": "Lya"},
+    {"name": "h_alpha", "label": "H  1 6562.80", "output_name": "I_h_alpha", "comment": "Ha"},
+    {"name": "h_beta", "label": "H  1 4861.32", "output_name": "I_h_beta", "comment": "Hb"},
+    {"name": "CO10", "label": "CO  2600.05m", "output_name": "I_co_10", "comment": "CO(1-0)"},
+    {"name": "CO21", "label": "CO  1300.05m", "output_name": "I_co_21", "comment": "CO(2-1)"},
+    {"name": "CO32", "label": "CO  866.727m", "output_name": "I_co_32", "comment": "CO(3-2)"},
+    {"name": "CO43", "label": "CO  650.074m", "output_name": "I_co_43", "comment": "CO(4-3)"},
+    {"name": "CO54", "label": "CO  520.089m", "output_name": "I_co_54", "comment": "CO(5-4)"},
+    {"name": "CO65", "label": "CO  433.438m", "output_name": "I_co_65", "comment": "CO(6-5)"},
+    {"name": "CO76", "label": "CO  371.549m", "output_name": "I_co_76", "comment": "CO(7-6)"},
+    {"name": "CO87", "label": "CO  325.137m", "output_name": "I_co_87", "comment": "CO(8-7)"},
+    {"name": "13CO", "label": "\"^13CO\" 2719.67m", "output_name": "I_13co", "comment": ""},
+    {"name": "C2", "label": "C  2 157.636m", "output_name": "I_c2", "comment": ""},
+    {"name": "O3_88um", "label": "O  3 88.3323m", "output_name": "I_o3_88", "comment": ""},
+    {"name": "O3_5006um", "label": "O  3 5006.84", "output_name": "I_o3_5006", "comment": "wavelength in Angstrom"},
+    {"name": "O3_4958um", "label": "O  3 4958.91", "output_name": "I_o3_4958", "comment": "wavelength in Angstrom"},
+]
+
+# Unit of the intensities
+INTENSITY_UNIT = "erg s^-1 cm^-2"
+
+# Columns of the centers at the beginning of every output table
+CENTER_COLUMNS_AND_UNITS = [
+    ("log_metallicity", "log(Zsolar)"),
+    ("log_hden", "log(cm^-3)"),
+    ("log_turbulence", "log(km s^-1)"),
+    ("log_isrf", "log(G0)"),
+    ("log_radius", "log(pc)"),
+]
+
+# Cloudy writes the wavelengths with 6 significant digits
+WAVELENGTH_RELATIVE_TOLERANCE = 1e-4
+
+# Wavelength units of the labels in Angstrom
+WAVELENGTH_UNITS = {"A": 1.0, "m": 1e4, "c": 1e8}
+
+
+# Functions
+
+def select_lines(names=None):
+    # Lines with the given names in the given order. All LINES if names is None.
+
+    if names is None:
+        return list(LINES)
+
+    lines_by_name = {line["name"]: line for line in LINES}
+    missing = [name for name in names if name not in lines_by_name]
+    if len(missing) > 0:
+        raise KeyError(f"Lines {missing} are not in the line catalog. Lines: {list(lines_by_name)}")
+
+    return [lines_by_name[name] for name in names]
+
+
+def parse_label(label):
+    """
+    Returns (species, wavelength in Angstrom) of a line label written in the .in file ("CO  2600.05m") or in the header of the _em.str
+    file ("CO   2600.05m", "H  1 1215.67A"). Spaces in the species are collapsed, e.g. "H  1" -> "H 1".
+    """
+
+    match = re.fullmatch(r"\s*(.*?)\s+([0-9.]+(?:[eE][-+]?[0-9]+)?)([Amc]?)\s*", label)
+    if match is None:
+        raise ValueError(f"Can not parse the line label {label}")
+
+    species = " ".join(match.group(1).strip("\"").split())
+    wavelength = float(match.group(2)) * WAVELENGTH_UNITS[match.group(3) or "A"]
+
+    return species, wavelength
+
+
+def em_str_label(line):
+    # Label of the line in the header of the _em.str file as Cloudy writes it, e.g. "CO   2600.05m", "H  1 1215.67A"
+
+    species, wavelength = line["label"].rsplit(maxsplit=1)
+    wavelength = wavelength if wavelength[-1] in WAVELENGTH_UNITS else f"{wavelength}A"
+
+    return f"{species.strip(chr(34)):<4} {wavelength}"
+
+
+def in_file_block(lines=None):
+    # The "save lines, emissivity" block of the .in file
+
+    lines = LINES if lines is None else lines
+
+    block = "save lines, emissivity, \"_em.str\"\n"
+    for line in lines:
+        block += line["label"] + (f" # {line['comment']}" if line["comment"] else "") + "\n"
+    block += "end of lines\n"
+
+    return block
+
+
+@lru_cache(maxsize=64)
+def match_header(header, labels):
+    # Column index of each label in the header (tuples, so the result is cached: all files of a grid have the same header)
+
+    parsed_header = []
+    for column_name in header:
+        try:
+            parsed_header.append(parse_label(column_name))
+        except ValueError:
+            parsed_header.append((None, None))
+
+    indices = []
+    for label in labels:
+        species, wavelength = parse_label(label)
+        candidates = [
+            (abs(column_wavelength - wavelength), i)
+            for i, (column_species, column_wavelength) in enumerate(parsed_header)
+            if column_species == species and abs(column_wavelength - wavelength) <= WAVELENGTH_RELATIVE_TOLERANCE * wavelength
+        ]
+        indices.append(min(candidates)[1] if len(candidates) > 0 else None)
+
+    return tuple(indices)
+
+
+def em_str_columns(file_path, lines=None, header=None):
+    """
+    Returns the column indices of the depth and of the lines in the _em.str file (content as bytes is accepted as well). The columns are
+    found by matching the species and the wavelength of each line with the header. Raises KeyError if a line is not in the file. If the
+    header is already read (e.g. by read_converged_iteration, see calculate_path_integrals) the file is not opened.
+    """
+
+    lines = LINES if lines is None else lines
+    header = read_header(file_path) if header is None else header
+
+    if header[0] != "depth":
+        raise KeyError(f"First column of {source_name(file_path)} is not depth. Header: {header}")
+
+    indices = match_header(tuple(header), tuple(line["label"] for line in lines))
+
+    missing = [line["name"] for line, index in zip(lines, indices) if index is None]
+    if len(missing) > 0:
+        raise KeyError(f"Lines {missing} are not in the header of {source_name(file_path)}. Header: {header}")
+
+    return [0] + list(indices)
+
+
+def output_header(lines=None):
+    # Header of the intensity table: "Column i: <name> [<unit>]" for the centers and the lines
+
+    lines = LINES if lines is None else lines
+
+    columns = CENTER_COLUMNS_AND_UNITS + [(line["output_name"], INTENSITY_UNIT) for line in lines]
+
+    return "\n" + "".join(f"Column {i}: {name} [{unit}]\n" for i, (name, unit) in enumerate(columns))
@@ -0,0 +1,168 @@
+# Imports
+import os
+import sys
+import numpy as np
+import pandas as pd
+from time import time
+
+from run_status_manifest import directory_names, CENTER_COLUMNS
+from out_file_status import REASON_OK, REASON_WARNINGS, REASON_ABORT, REASON_TRUNCATED, REASON_MISSING
+from create_cloudy_directories_and_files import create_grid
+from line_catalog import LINES, em_str_label
+
+
+################################################################################
+# Writes a fake Cloudy grid to a local directory so that the post-processing scripts can be run and benchmarked without the grids on
+# Niagara: centers.txt, the run directories with their .in files (create_cloudy_directories_and_files.py), and for every started run an
+# .out file, an _em.str file with NUMBER_OF_ITERATIONS iterations and an .ovr file with the column names Cloudy writes. The runs end with
+# one of the out_file_status.py reasons with the probabilities in REASON_FRACTIONS. Values are random but have realistic magnitudes.
+#
+#   python make_synthetic_grid.py <directory> <number of runs> <number of zones>
+################################################################################
+
+# Global variables
+NUMBER_OF_ITERATIONS = 3  # iterate to converge
+
+# Ranges of the log center parameters (uniform)
+CENTER_RANGES = {
+    "log_metallicity": (-2.0, 1.0),
+    "log_hden": (-2.0, 6.0),
+    "log_turbulence": (-1.0, 2.0),
+    "log_isrf": (-2.0, 4.0),
+    "log_radius": (-2.0, 2.5),
+}
+
+REASON_FRACTIONS = {
+    REASON_OK: 0.85,
+    REASON_WARNINGS: 0.04,
+    REASON_ABORT: 0.02,
+    REASON_TRUNCATED: 0.04,
+    REASON_MISSING: 0.05,
+}
+
+# Header of the _em.str files as Cloudy writes it for the lines of line_catalog.py
+EM_STR_COLUMNS = ["#depth"] + [em_str_label(line) for line in LINES]
+
+OVR_COLUMNS = [
+    "#depth", "Te", "Heat", "cool", "hden", "eden", "2H_2/H", "HI", "HII", "HeI", "HeII", "HeIII", "CO/C", "C1", "C2", "C3", "C4",
+    "O1", "O2", "O3", "O4", "O5", "O6", "H2O/O", "AV(point)", "AV(extend)", "tau912",
+]
+
+# Lines that Cloudy writes to the .out file before the summary
+OUT_FILE_BODY_LINES = 200
+################################################################################
+
+
+# Main
+def main(base_file_dir, number_of_runs=1000, number_of_zones=500, seed=0):
+
+    start = time()
+
+    make_synthetic_grid(base_file_dir, number_of_runs, number_of_zones, seed)
+
+    print(f"It took {round((time() - start) / 60, 3)} minutes to write the synthetic grid")
+
+    return 0
+
+
+# Functions
+
+def make_centers(number_of_runs, rng):
+
+    return pd.DataFrame(
+        {column: np.round(rng.uniform(*CENTER_RANGES[column], number_of_runs), 5) for column in CENTER_COLUMNS}
+    )
+
+
+def write_out_file(file_path, reason, number_of_zones, rng):
+    # .out file ending as Cloudy does for the given reason (see out_file_status.py)
+
+    with open(file_path, "w") as file:
+        for i in range(OUT_FILE_BODY_LINES):
+            file.write(f" Zone {i:4d} Te:{rng.uniform(10, 1e4):.3e} Hden:{rng.uniform(1, 1e4):.3e} Ne:{rng.uniform(0, 1):.3e}\n")
+
+        if reason == REASON_TRUNCATED:
+            return 0
+
+        if reason == REASON_ABORT:
+            file.write(" PROBLEM DISASTER An ABORT has occurred.\n")
+
+        file.write(f" Cloudy ends: {number_of_zones} zones, {NUMBER_OF_ITERATIONS} iterations, 1 warning, 2 cautions.\n")
+        file.write(f" ExecTime(s) {rng.uniform(10, 3600):.2f}\n")
+
+        if reason == REASON_OK:
+            file.write(" [Stop in cdMain at ../maincl.cpp:157, Cloudy exited OK]\n")
+        else:
+            file.write(" [Stop in cdMain at ../maincl.cpp:157, something went wrong]\n")
+
+    return 0
+
+
+def write_em_str_file(file_path, depth, rng):
+    # Earlier iterations stop at a smaller depth, the last one is the converged iteration. Like Cloudy, a line of "#" characters is written
+    # after every iteration, the last one as well.
+
+    with open(file_path, "w") as file:
+        file.write("\t".join(EM_STR_COLUMNS) + "\n")
+        for iteration in range(NUMBER_OF_ITERATIONS):
+            number_of_rows = len(depth) if iteration == NUMBER_OF_ITERATIONS - 1 else max(len(depth) // 2, 1)
+            emissivities = 10 ** rng.normal(-20, 2, size=(number_of_rows, len(EM_STR_COLUMNS) - 1))
+            np.savetxt(file, np.column_stack([depth[:number_of_rows], emissivities]), fmt="%.4e", delimiter="\t")
+            file.write("#" * 40 + "\n")
+
+    return 0
+
+
+def write_ovr_file(file_path, depth, log_hden, rng):
+
+    number_of_zones = len(depth)
+    overview = rng.uniform(0, 1, size=(number_of_zones, len(OVR_COLUMNS)))
+    overview[:, 0] = depth
+    overview[:, OVR_COLUMNS.index("Te")] = 10 ** rng.uniform(1, 4, number_of_zones)
+    overview[:, OVR_COLUMNS.index("hden")] = 10**log_hden
+    overview[:, OVR_COLUMNS.index("eden")] = 10 ** (log_hden + rng.uniform(-4, 0, number_of_zones))
+
+    np.savetxt(file_path, overview, fmt="%.4e", delimiter="\t", header="\t".join(OVR_COLUMNS), comments="")
+
+    return 0
+
+
+def make_synthetic_grid(base_file_dir, number_of_runs, number_of_zones, seed=0):
+    """
+    Writes a synthetic grid with number_of_runs centers and number_of_zones zones per run to base_file_dir. Returns the reason each run
+    ends with.
+    """
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(base_file_dir, exist_ok=True)
+
+    centers = make_centers(number_of_runs, rng)
+    np.savetxt(f"{base_file_dir}/centers.txt", centers.to_numpy(), fmt="%.5f", header=" ".join(CENTER_COLUMNS))
+    create_grid(fdir=base_file_dir, centers=centers, redshift=3.0, cosmic_ray=1.0)
+
+    reasons = rng.choice(list(REASON_FRACTIONS.keys()), size=number_of_runs, p=list(REASON_FRACTIONS.values()))
+
+    for row, (fdir, reason) in enumerate(zip(directory_names(centers), reasons)):
+        if reason == REASON_MISSING:
+            continue
+
+        run_file_path = f"{base_file_dir}/{fdir}/{fdir}"
+        # Depth increases geometrically to the stopping thickness
+        depth = np.geomspace(1e12, 3.086e18 * 10 ** centers["log_radius"][row], number_of_zones)
+
+        write_out_file(f"{run_file_path}.out", reason, number_of_zones, rng)
+        write_em_str_file(f"{run_file_path}_em.str", depth, rng)
+        write_ovr_file(f"{run_file_path}.ovr", depth, centers["log_hden"][row], rng)
+
+        if (row + 1) % 1000 == 0:
+            print(f"{row + 1} runs written. Left {number_of_runs - row - 1}")
+
+    for reason in REASON_FRACTIONS:
+        print(f"{reason}: {np.sum(reasons == reason)}")
+
+    return reasons
+
+
+if __name__ == "__main__":
+
+    main(base_file_dir=sys.argv[1], number_of_runs=int(sys.argv[2]), number_of_zones=int(sys.argv[3]))
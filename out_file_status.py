@@ -0,0 +1,76 @@
+# Imports
+import os
+
+from cloudy_file_readers import open_binary
+from instrumentation import stage, add_bytes
+
+
+################################################################################
+# Global variables
+
+# Only the end of the .out file is read. Cloudy writes the summary of the run ("Cloudy ends: ...", warnings, ABORT/DISASTER messages and the
+# final "[Stop in ...]" line) at the very end of the file, so a few kB are enough.
+TAIL_BYTES = 8192
+
+# Reasons returned by classify_out_file
+REASON_OK = "ok"
+REASON_WARNINGS = "warnings"     # Cloudy finished but did not exit OK (warnings, botched monitors, ...)
+REASON_ABORT = "abort"           # ABORT or DISASTER in the summary of the run
+REASON_TRUNCATED = "truncated"   # There is no final "[Stop in ...]" line. Run is killed (e.g. wall time) or still running
+REASON_MISSING = "missing"       # There is no .out file. Run is not started
+
+REASONS = [REASON_OK, REASON_WARNINGS, REASON_ABORT, REASON_TRUNCATED, REASON_MISSING]
+################################################################################
+
+
+# Functions
+
+def read_out_file_tail(out_file_path, tail_bytes=TAIL_BYTES):
+    # Seeks to the end of the file and reads at most tail_bytes. Raises FileNotFoundError if the file does not exist. out_file_path can be
+    # the content of the file or a file packed in a shard as well (see pack_cloudy_outputs.py).
+
+    with stage("read"):
+        with open_binary(out_file_path) as file:
+            file.seek(0, os.SEEK_END)
+            file.seek(max(file.tell() - tail_bytes, 0))
+            tail = file.read()
+    add_bytes("read", len(tail))
+
+    return tail.decode("ascii", errors="replace")
+
+
+def is_last_line_ok(last_line):
+    # Cloudy writes "[Stop in cdMain at ../maincl.cpp:157, Cloudy exited OK]" as the last line if the run is finished successfully.
+    return "OK" == last_line[len(last_line) - 4 : len(last_line) - 2]
+
+
+def classify_out_file(out_file_path, tail_bytes=TAIL_BYTES):
+    """
+    Classifies a run by only reading the last tail_bytes of its .out file. Returns one of the REASONS:
+    ok, warnings, abort, truncated or missing.
+    """
+
+    try:
+        tail = read_out_file_tail(out_file_path, tail_bytes)
+    except FileNotFoundError:
+        return REASON_MISSING
+
+    lines = tail.splitlines(keepends=True)
+    if len(lines) == 0:
+        return REASON_TRUNCATED
+
+    if is_last_line_ok(lines[-1]):
+        return REASON_OK
+
+    if ("ABORT" in tail) or ("DISASTER" in tail):
+        return REASON_ABORT
+
+    if lines[-1].lstrip().startswith("[Stop in"):
+        return REASON_WARNINGS
+
+    return REASON_TRUNCATED
+
+
+def is_out_file_ok(out_file_path, tail_bytes=TAIL_BYTES):
+
+    return classify_out_file(out_file_path, tail_bytes) == REASON_OK
@@ -0,0 +1,353 @@
+# Imports
+import os
+import bisect
+import shutil
+import numpy as np
+from time import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from run_status_manifest import read_manifest, directory_names, STATUS_OK
+from instrumentation import stage, add_bytes
+from cloudy_file_readers import COMPRESSED_EXTENSIONS, FileRange
+
+
+################################################################################
+# Every Cloudy run writes ~20 small files. Finished runs are packed into a few large shard files in <base_file_dir>/packed/ to save inodes
+# and metadata operations on Lustre:
+#
+#   packed/shard_XXXXX.pack   the files of the runs written one after the other
+#   packed/index.npy          one row per packed file: file name without the directory name of the run in front of it (e.g. "_em.str"),
+#                             shard number, byte offset and size. The files of a run are in consecutive rows.
+#   packed/runs.npy           one row per packed run, sorted by the directory name: directory name, first row of its files in index.npy
+#                             and number of files
+#
+# Both tables have fixed size byte string fields (~84 bytes per file and ~108 bytes per run) and are memory mapped by the readers, so a
+# process does not load or sort the whole index. The run of a file is found with a binary search in runs.npy.
+#
+# The readers get a file with run_file_source(base_file_dir, fdir, suffix). It returns the offset and size of the file in its shard (a
+# FileRange, see cloudy_file_readers.py) if the file is packed and the path of the file otherwise, so the readers read only the bytes they
+# need from the shard. Each shard is opened only once per process.
+################################################################################
+
+PACKED_DIRECTORY_NAME = "packed"
+INDEX_FILE_NAME = "index.npy"
+RUNS_FILE_NAME = "runs.npy"
+
+# A new shard is started when the current one is larger than this
+MAX_SHARD_BYTES = 2 * 1024**3
+
+# Number of runs read ahead by each thread. Only these runs are held in memory while the files are written to the shard.
+RUNS_IN_FLIGHT_PER_THREAD = 2
+
+# Progress is printed after every PRINT_EVERY_RUNS runs
+PRINT_EVERY_RUNS = 1000
+
+INDEX_DTYPE = np.dtype(
+    [
+        ("file_name", "S64"),
+        ("shard", np.int32),
+        ("offset", np.int64),
+        ("size", np.int64),
+    ]
+)
+
+RUNS_DTYPE = np.dtype(
+    [
+        ("fdir", "S96"),
+        ("first_row", np.int64),
+        ("number_of_files", np.int32),
+    ]
+)
+
+
+# Main
+def main(base_file_dir, max_threads=16, remove_packed=False):
+
+    start = time()
+
+    pack_runs(
+        base_file_dir=base_file_dir,
+        max_threads=max_threads,
+        remove_packed=remove_packed,
+    )
+
+    print(f"It took {round((time() - start) / 60, 3)} minutes to pack the runs")
+
+    return 0
+
+
+# Functions
+
+def shard_file_path(base_file_dir, shard):
+
+    return f"{base_file_dir}/{PACKED_DIRECTORY_NAME}/shard_{shard:05d}.pack"
+
+
+def read_index(base_file_dir, mmap_mode=None):
+    # Returns the file and run tables of the packed runs (empty if nothing is packed). An index written before runs.npy existed (one row per
+    # file with the directory name and the whole file name) is converted in memory. It is written in the new format by the next pack_runs.
+
+    index_file_path = f"{base_file_dir}/{PACKED_DIRECTORY_NAME}/{INDEX_FILE_NAME}"
+    runs_file_path = f"{base_file_dir}/{PACKED_DIRECTORY_NAME}/{RUNS_FILE_NAME}"
+    if not os.path.isfile(index_file_path):
+        return np.zeros(0, dtype=INDEX_DTYPE), np.zeros(0, dtype=RUNS_DTYPE)
+
+    index = np.load(index_file_path, mmap_mode=mmap_mode)
+    if "fdir" in index.dtype.names:
+        print(f"{index_file_path} is in the old format. Run pack_cloudy_outputs.py to write it with {RUNS_FILE_NAME}.")
+        return convert_old_index(np.asarray(index))
+
+    return index, np.load(runs_file_path, mmap_mode=mmap_mode)
+
+
+def convert_old_index(old_index):
+    # Returns the file and run tables of an index with the fields fdir, file_name, shard, offset and size
+
+    old_index = old_index[np.argsort(old_index["fdir"], kind="stable")]
+    fdirs, first_rows, counts = np.unique(old_index["fdir"], return_index=True, return_counts=True)
+
+    index = np.zeros(len(old_index), dtype=INDEX_DTYPE)
+    index["file_name"] = [
+        stored_file_name(str(fdir), str(file_name)) for fdir, file_name in zip(old_index["fdir"], old_index["file_name"])
+    ]
+    for field in ["shard", "offset", "size"]:
+        index[field] = old_index[field]
+
+    runs = np.zeros(len(fdirs), dtype=RUNS_DTYPE)
+    runs["fdir"] = [fdir.encode() for fdir in fdirs]
+    runs["first_row"] = first_rows
+    runs["number_of_files"] = counts
+
+    return index, runs
+
+
+def stored_file_name(fdir, file_name):
+    # Name of a file in index.npy. Files of a run start with the directory name, only the rest is stored.
+
+    if file_name.startswith(fdir):
+        file_name = file_name[len(fdir):]
+
+    stored = file_name.encode()
+    if len(stored) > INDEX_DTYPE["file_name"].itemsize:
+        raise ValueError(f"File name {file_name} of {fdir} is too long for the index")
+
+    return stored
+
+
+def write_array(array, fname):
+
+    # Write to a temporary file first so that a killed job never leaves a half written index behind
+    with open(f"{fname}.tmp", "wb") as file:
+        np.save(file, array)
+    os.replace(f"{fname}.tmp", fname)
+
+    return 0
+
+
+def write_index(index, runs, base_file_dir):
+
+    # index.npy is written first. New files are only appended to it, so the old runs.npy is still right until the new one replaces it.
+    write_array(index, f"{base_file_dir}/{PACKED_DIRECTORY_NAME}/{INDEX_FILE_NAME}")
+    write_array(runs, f"{base_file_dir}/{PACKED_DIRECTORY_NAME}/{RUNS_FILE_NAME}")
+
+    return 0
+
+
+def read_run_directory(base_file_dir, fdir):
+    # Returns a list of (file name, content) of all files in the directory of the run
+
+    files = []
+    with os.scandir(f"{base_file_dir}/{fdir}") as entries:
+        for entry in entries:
+            if entry.is_file():
+                with open(entry.path, "rb") as file:
+                    files.append((entry.name, file.read()))
+
+    return files
+
+
+def read_run_directories(base_file_dir, fdirs, max_threads):
+    # Yields (fdir, files) in the order of fdirs. At most max_threads * RUNS_IN_FLIGHT_PER_THREAD runs are read ahead, so the memory used
+    # does not grow with the number of runs.
+
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        fdirs = iter(fdirs)
+        in_flight = deque()
+
+        for fdir in fdirs:
+            in_flight.append((fdir, executor.submit(read_run_directory, base_file_dir, fdir)))
+            if len(in_flight) >= max_threads * RUNS_IN_FLIGHT_PER_THREAD:
+                break
+
+        while len(in_flight) > 0:
+            fdir, future = in_flight.popleft()
+            next_fdir = next(fdirs, None)
+            if next_fdir is not None:
+                in_flight.append((next_fdir, executor.submit(read_run_directory, base_file_dir, next_fdir)))
+            yield fdir, future.result()
+
+
+def pack_runs(base_file_dir, max_threads=16, remove_packed=False):
+    """
+    Packs the directories of the runs that are OK in the run status manifest (run run_status_manifest.py first) and that are not packed yet.
+    New shards are appended, existing shards are never rewritten. The directories are read with max_threads threads and the files are
+    written to the shards by this thread as soon as they are read. If remove_packed is True the directories of the packed runs are deleted
+    after the index is written.
+    """
+
+    os.makedirs(f"{base_file_dir}/{PACKED_DIRECTORY_NAME}", exist_ok=True)
+
+    manifest = read_manifest(base_file_dir)
+    index, runs = read_index(base_file_dir)
+
+    packed_fdirs = set(fdir.decode() for fdir in runs["fdir"])
+    fdirs_to_pack = [fdir for fdir in directory_names(manifest[manifest["status"] == STATUS_OK]) if fdir not in packed_fdirs]
+
+    print(f"{len(packed_fdirs)} runs are already packed. {len(fdirs_to_pack)} runs will be packed.")
+    if len(fdirs_to_pack) == 0:
+        if (len(runs) > 0) and not os.path.isfile(f"{base_file_dir}/{PACKED_DIRECTORY_NAME}/{RUNS_FILE_NAME}"):
+            # Index in the old format
+            write_index(index, runs, base_file_dir)
+        return 0
+
+    # Always start a new shard
+    shard = int(index["shard"].max()) + 1 if len(index) > 0 else 0
+    shard_file = open(shard_file_path(base_file_dir, shard), "ab")
+
+    new_rows = []
+    new_runs = []
+    for number_of_packed, (fdir, files) in enumerate(read_run_directories(base_file_dir, fdirs_to_pack, max_threads), start=1):
+        # Files of a run are always in the same shard
+        if shard_file.tell() > MAX_SHARD_BYTES:
+            shard_file.close()
+            shard += 1
+            shard_file = open(shard_file_path(base_file_dir, shard), "ab")
+
+        if len(fdir.encode()) > RUNS_DTYPE["fdir"].itemsize:
+            raise ValueError(f"Directory name {fdir} is too long for the index")
+
+        new_runs.append((fdir.encode(), len(index) + len(new_rows), len(files)))
+        for file_name, content in files:
+            new_rows.append((stored_file_name(fdir, file_name), shard, shard_file.tell(), len(content)))
+            shard_file.write(content)
+
+        if (number_of_packed % PRINT_EVERY_RUNS == 0) or (number_of_packed == len(fdirs_to_pack)):
+            print(f"{number_of_packed} runs packed. Left {len(fdirs_to_pack) - number_of_packed}")
+
+    shard_file.close()
+
+    # Index is written only after all shards are closed. The run table is sorted once here, the readers only search it.
+    index = np.concatenate([index, np.array(new_rows, dtype=INDEX_DTYPE)])
+    runs = np.concatenate([runs, np.array(new_runs, dtype=RUNS_DTYPE)])
+    runs = runs[np.argsort(runs["fdir"], kind="stable")]
+    write_index(index, runs, base_file_dir)
+
+    print(f"{len(new_rows)} files of {len(fdirs_to_pack)} runs are written to {base_file_dir}/{PACKED_DIRECTORY_NAME}")
+
+    if remove_packed:
+        for fdir in fdirs_to_pack:
+            shutil.rmtree(f"{base_file_dir}/{fdir}")
+        print(f"{len(fdirs_to_pack)} packed run directories are removed")
+
+    return 0
+
+
+class PackedGrid:
+    # Reads the files of the packed runs. Each shard is opened once and read with os.pread, so the same object can be used by many threads.
+    # The tables are memory mapped, only the pages of the rows that are searched are read.
+
+    def __init__(self, base_file_dir):
+
+        self.base_file_dir = base_file_dir
+        self.index, self.runs = read_index(base_file_dir, mmap_mode="r")
+        self.fdirs = self.runs["fdir"]
+
+        self.shard_file_descriptors = {}
+
+    def run_rows(self, fdir):
+        # Returns (first row, last row + 1) of the files of the run in the index or None if the run is not packed
+
+        key = fdir.encode()
+        i = bisect.bisect_left(self.fdirs, key)
+        if (i == len(self.fdirs)) or (self.fdirs[i] != key):
+            return None
+
+        first_row = int(self.runs["first_row"][i])
+        return first_row, first_row + int(self.runs["number_of_files"][i])
+
+    def is_packed(self, fdir):
+
+        return self.run_rows(fdir) is not None
+
+    def file_range(self, fdir, file_name):
+        # Returns the FileRange of the file in its shard or None if it is not packed. Nothing is read from the shard.
+
+        rows = self.run_rows(fdir)
+        if rows is None:
+            return None
+
+        first_row, last_row = rows
+        matches = np.flatnonzero(self.index["file_name"][first_row:last_row] == stored_file_name(fdir, file_name))
+        if len(matches) == 0:
+            return None
+
+        row = first_row + int(matches[0])
+        shard = int(self.index["shard"][row])
+        if shard not in self.shard_file_descriptors:
+            self.shard_file_descriptors[shard] = os.open(shard_file_path(self.base_file_dir, shard), os.O_RDONLY)
+
+        return FileRange(self.shard_file_descriptors[shard], int(self.index["offset"][row]), int(self.index["size"][row]))
+
+    def read(self, fdir, file_name):
+        # Returns the content of the file or None if it is not packed
+
+        file_range = self.file_range(fdir, file_name)
+        if file_range is None:
+            return None
+
+        with stage("read"):
+            content = file_range.read()
+        add_bytes("read", len(content))
+
+        return content
+
+
+# One PackedGrid per grid directory and process. None if the grid is not packed.
+_packed_grids = {}
+
+
+def get_packed_grid(base_file_dir):
+
+    if base_file_dir not in _packed_grids:
+        if os.path.isfile(f"{base_file_dir}/{PACKED_DIRECTORY_NAME}/{INDEX_FILE_NAME}"):
+            _packed_grids[base_file_dir] = PackedGrid(base_file_dir)
+        else:
+            _packed_grids[base_file_dir] = None
+
+    return _packed_grids[base_file_dir]
+
+
+def run_file_source(base_file_dir, fdir, suffix):
+    """
+    Returns the FileRange of the file <fdir><suffix> in its shard if the run is packed, otherwise the path of the file. The readers in
+    cloudy_file_readers.py and out_file_status.py accept both and decompress compressed files. Only the bytes the reader needs are read from
+    the shard, e.g. the end of the .out file or the last iteration of the _em.str file.
+    """
+
+    packed_grid = get_packed_grid(base_file_dir)
+    if packed_grid is not None:
+        # Runs compressed before they were packed have <fdir><suffix>.gz or .zst in the shard (see compress_cloudy_outputs.py)
+        for extension in [""] + COMPRESSED_EXTENSIONS:
+            file_range = packed_grid.file_range(fdir, f"{fdir}{suffix}{extension}")
+            if file_range is not None:
+                return file_range
+
+    return f"{base_file_dir}/{fdir}/{fdir}{suffix}"
+
+
+if __name__ == "__main__":
+
+    base_file_dir = "/scratch/m/murray/dtolgay/cloudy_runs/z_0/cr_1_CO87_CII_H_O3/cr_1_CO87_CII_H_O3_metallicity_above_minus_2"
+
+    main(base_file_dir)
@@ -0,0 +1,430 @@
+# Imports
+import os
+import numpy as np
+import pandas as pd
+from time import time
+from functools import partial
+
+from run_status_manifest import read_centers_file, directory_names, ok_runs_mask
+from results_store import parse_column_header, write_results, allocate_table
+from result_checkpoints import ResultsCheckpoint, out_file_mtimes, split_done_and_todo
+from grid_shards import select_shard, shard_name, shard_from_argv
+from instrumentation import stage, Progress, write_summary
+from shared_pool import SharedArrays, map_ranges
+from run_prefetch import prefetch_runs
+from run_cache import RowCache, read_run_keys, take_cached_rows, add_rows, cache_from_argv
+from line_catalog import CENTER_COLUMNS_AND_UNITS
+
+import calculate_intensity_finished_cloudy_jobs_2 as intensity
+
+
+################################################################################
+# Post-processes every run directory of a grid in a single visit: the end of the .out file is checked, the line emissivities in _em.str
+# are integrated (calculate_intensity_finished_cloudy_jobs_2.py) and the mass weighted fractions are calculated from the .ovr file
+# (calculate_other_properties_from_finished_cloudy_runs.py). The results are written to one combined table. If WRITE_SEPARATE_OUTPUTS is
+# True I_line_values_without_reversing.txt and other_properties.csv are written from the same results as well, so the two scripts do not
+# need to be run.
+#
+# post_process_grid is the implementation of the two scripts as well: they call it with only the lines or only the properties. Line
+# intensities are calculated for the runs that are OK. fh2, fCO and the averaged EXTRA_OVR_COLUMNS are calculated for every run whose .ovr
+# file can be read, so the separate outputs are the same as the outputs of the two scripts.
+################################################################################
+
+# Global variables
+BASE_FILE_DIR = "/scratch/m/murray/dtolgay/cloudy_runs/z_0/cr_1_CO87_CII_H_O3/cr_1_CO87_CII_H_O3_metallicity_above_minus_2"
+
+# Number of processes. Set it to 1 to run serially in a single process (useful for debugging).
+MAX_WORKERS = 40
+CHUNKS_PER_WORKER = 4
+
+# Each process reads the _em.str and .ovr files of the next PREFETCH_DEPTH runs with IO_THREADS threads while it processes the current run
+# (see run_prefetch.py). 0 reads the files when they are needed.
+PREFETCH_DEPTH = 8
+IO_THREADS = 4
+
+OUTPUT_FILE_NAME = "post_processed_runs"
+# "txt" writes <OUTPUT_FILE_NAME>.txt with np.savetxt, "csv" with DataFrame.to_csv, "npy" or "parquet" write a binary table (see
+# results_store.py)
+OUTPUT_BACKEND = "txt"
+WRITE_SEPARATE_OUTPUTS = True
+
+# Version of the post-processing. Rows in the run cache (see run_cache.py) calculated by another version are not used, so increase it when
+# the values calculated for a run change.
+POST_PROCESSING_VERSION = 1
+
+
+# Main
+def main(
+    base_file_dir=BASE_FILE_DIR,
+    max_workers=MAX_WORKERS,
+    use_manifest=False,
+    output_backend=OUTPUT_BACKEND,
+    checkpoint=False,
+    resume=False,
+    shard=None,
+    run_cache_directory=None,
+):
+
+    return post_process_grid(
+        base_file_dir=base_file_dir,
+        name=OUTPUT_FILE_NAME,
+        lines=True,
+        properties=True,
+        max_workers=max_workers,
+        use_manifest=use_manifest,
+        output_backend=output_backend,
+        checkpoint=checkpoint,
+        resume=resume,
+        shard=shard,
+        run_cache_directory=run_cache_directory,
+        separate_outputs=WRITE_SEPARATE_OUTPUTS,
+    )
+
+
+# Functions
+
+def post_process_grid(
+    base_file_dir,
+    name=OUTPUT_FILE_NAME,
+    lines=True,
+    properties=True,
+    max_workers=MAX_WORKERS,
+    use_manifest=False,
+    output_backend=OUTPUT_BACKEND,
+    float32=False,
+    output_memmap=False,
+    checkpoint=False,
+    resume=False,
+    shard=None,
+    run_cache_directory=None,
+    separate_outputs=False,
+    chunks_per_worker=CHUNKS_PER_WORKER,
+    prefetch_depth=PREFETCH_DEPTH,
+    io_threads=IO_THREADS,
+):
+    """
+    Writes <base_file_dir>/<name> (with the shard added to the name, see grid_shards.py) with one row per center: the center followed by
+    the line intensities if lines is True and fh2, fCO and the averaged EXTRA_OVR_COLUMNS if properties is True. Values that can not be
+    calculated are NaN.
+
+    use_manifest: only the runs that are OK in the run status manifest are visited and their .out files are not read again.
+    output_memmap: the table is a memory map of <base_file_dir>/<name>_table.npy (removed after the output is written), so the memory used
+        does not grow with the number of centers.
+    checkpoint, resume: see result_checkpoints.py. resume turns the checkpoints on. They are off by default because the .out file of every
+        center is stat'ed and <base_file_dir>/checkpoints/ is written.
+    run_cache_directory: see run_cache.py, only used for the line intensities.
+    separate_outputs: the lines and the properties are written to I_line_values_without_reversing.txt and other_properties.csv as well.
+    """
+
+    start = time()
+
+    centers = read_centers_file(base_file_dir)
+    print(f"Using {base_file_dir}/centers.txt as a center.txt file")
+
+    # With a shard (i, N) only the centers of the shard are processed and the outputs are named by the shard (see grid_shards.py)
+    centers = select_shard(base_file_dir, centers, shard)
+    out_file_name = shard_name(name, shard)
+
+    names, units = output_columns(lines, properties)
+    number_of_values = len(names) - len(centers.columns)
+    number_of_lines = len(intensity.COLUMNS_EMISSIVITY) - 1 if lines else 0
+
+    # One row per center: the center followed by the values. Rows are filled in place, centers that are not processed stay NaN. The workers
+    # write their rows directly to the table (see post_process_runs), so it is a memory map of <name>_table.npy with output_memmap and it is
+    # in shared memory otherwise.
+    fortran_order = output_backend not in ["txt", "csv"]
+    if output_memmap:
+        table = allocate_table(
+            number_of_rows=len(centers),
+            number_of_columns=len(names),
+            file_path=f"{base_file_dir}/{out_file_name}_table.npy",
+            fortran_order=fortran_order,
+        )
+        shared = SharedArrays(memmaps={"table": table})
+    else:
+        shared = SharedArrays(outputs={"table": ((len(centers), len(names)), np.float64)}, order="F" if fortran_order else "C")
+
+    with shared:
+        table = shared.arrays["table"]
+        table[:, : len(centers.columns)] = centers.to_numpy()
+        values = table[:, len(centers.columns) :]
+
+        if use_manifest:
+            to_process = ok_runs_mask(base_file_dir=base_file_dir, centers=centers)
+            print(f"{np.sum(to_process)} OK runs are taken from the manifest")
+        else:
+            to_process = np.ones(len(centers), dtype=bool)
+
+        # Centers that are done in a previous run and whose .out file did not change since then are not processed again
+        checkpoint = checkpoint or resume
+        is_done = np.zeros(len(centers), dtype=bool)
+        if checkpoint:
+            fdirs = directory_names(centers)
+            out_mtimes = out_file_mtimes(base_file_dir, fdirs)
+            results_checkpoint = ResultsCheckpoint(
+                base_file_dir=base_file_dir,
+                name=out_file_name,
+                number_of_values=number_of_values,
+            )
+
+            done = results_checkpoint.load() if resume else {}
+            is_done = split_done_and_todo(done, fdirs, out_mtimes)
+            for i in np.flatnonzero(is_done):
+                values[i] = done[fdirs[i]][1]
+            to_process &= ~is_done
+            print(f"{np.sum(is_done)} centers are taken from the checkpoints. {np.sum(to_process)} centers will be processed.")
+
+        # Rows of the runs whose .in file is the same as a run that is already post-processed are taken from the row cache. Only the runs
+        # with line intensities (OK runs) are added to it, a run that is not OK now can be OK after it is run again.
+        use_run_cache = (run_cache_directory is not None) and lines
+        if use_run_cache:
+            run_keys = np.full(len(centers), None, dtype=object)
+            run_keys[to_process] = read_run_keys(base_file_dir, directory_names(centers[to_process]))
+            row_cache = RowCache(run_cache_directory, name, text_header(names, units), number_of_values, POST_PROCESSING_VERSION)
+            to_process = take_cached_rows(row_cache, run_keys, values, to_process)
+
+        def on_chunk_result(rows):
+            for row in rows:
+                results_checkpoint.add(fdirs[row], out_mtimes[row], values[row])
+
+        progress = Progress(int(np.sum(to_process)))
+        rows_to_process = np.flatnonzero(to_process)
+        post_process_runs(
+            base_file_dir=base_file_dir,
+            shared=shared,
+            rows=rows_to_process,
+            columns=list(centers.columns),
+            lines=lines,
+            properties=properties,
+            max_workers=max_workers,
+            check_out_file=not use_manifest,
+            on_chunk_result=on_chunk_result if checkpoint else None,
+            progress=progress,
+            chunks_per_worker=chunks_per_worker,
+            prefetch_depth=prefetch_depth,
+            io_threads=io_threads,
+        )
+
+        if checkpoint:
+            results_checkpoint.write()
+
+        if use_run_cache:
+            has_lines = ~np.all(np.isnan(values[rows_to_process, :number_of_lines]), axis=1)
+            add_rows(row_cache, run_keys, values, rows_to_process[has_lines])
+
+        if lines:
+            number_of_ok_runs = int(np.sum(~np.all(np.isnan(values[:, :number_of_lines]), axis=1)))
+            print(f"OK runs: {number_of_ok_runs} --------------------------- broken runs: {len(centers) - number_of_ok_runs}")
+
+        with stage("write"):
+            write_table(table, names, units, base_file_dir, out_file_name, output_backend, float32)
+
+            if separate_outputs:
+                number_of_columns = len(centers.columns) + number_of_lines
+                center_columns = list(range(len(centers.columns)))
+
+                if lines:
+                    columns = list(range(number_of_columns))
+                    write_table(
+                        table[:, columns], names[:number_of_columns], units[:number_of_columns], base_file_dir,
+                        shard_name("I_line_values_without_reversing", shard), "txt",
+                    )
+                if properties:
+                    columns = center_columns + list(range(number_of_columns, len(names)))
+                    write_table(
+                        table[:, columns], [names[i] for i in columns], [units[i] for i in columns], base_file_dir,
+                        shard_name("other_properties", shard), "csv",
+                    )
+
+        # Stage timers, runs per second and MB/s of all workers (see instrumentation.py)
+        write_summary(base_file_dir, out_file_name, progress, max_workers)
+
+        if checkpoint:
+            # Output is written. Keep all processed centers in a single checkpoint part for the next resume.
+            results_checkpoint.consolidate(
+                {fdirs[i]: (out_mtimes[i], values[i]) for i in np.flatnonzero(to_process | is_done)}
+            )
+
+        del table, values
+
+    if output_memmap:
+        os.remove(f"{base_file_dir}/{out_file_name}_table.npy")
+
+    print(f"It took {round((time() - start) / 60, 2)} minutes to post-process the runs!")
+
+    return 0
+
+
+def output_columns(lines=True, properties=True):
+    # Names and units of the columns of the table: centers, line intensities, fh2, fCO and the averaged EXTRA_OVR_COLUMNS
+
+    names = [name for name, unit in CENTER_COLUMNS_AND_UNITS]
+    units = [unit for name, unit in CENTER_COLUMNS_AND_UNITS]
+
+    if lines:
+        line_names, line_units = parse_column_header(intensity.OUTPUT_HEADER)
+        names += line_names[len(CENTER_COLUMNS_AND_UNITS) :]
+        units += line_units[len(CENTER_COLUMNS_AND_UNITS) :]
+
+    if properties:
+        other_properties = properties_module()
+        property_names = ["fh2", "fCO"] + other_properties.EXTRA_OVR_COLUMNS
+        names += property_names
+        units += ["dimensionless"] * len(property_names)
+
+    return names, units
+
+
+def properties_module():
+    # calculate_other_properties_from_finished_cloudy_runs.py needs tools.constants (only on Niagara), so it is imported only when the
+    # properties are calculated. The line intensities can be calculated without it.
+    import calculate_other_properties_from_finished_cloudy_runs
+
+    return calculate_other_properties_from_finished_cloudy_runs
+
+
+def text_header(names, units):
+    # "Column i: <name> [<unit>]" lines, the header of the txt tables (same as line_catalog.output_header)
+
+    return "\n" + "".join(f"Column {i}: {name} [{unit}]\n" for i, (name, unit) in enumerate(zip(names, units)))
+
+
+def write_table(table, names, units, base_file_dir, out_file_name, output_backend, float32=False):
+
+    if output_backend == "txt":
+        np.savetxt(
+            fname=f"{base_file_dir}/{out_file_name}.txt",
+            X=table,
+            fmt="%.8e",
+            header=text_header(names, units),
+        )
+        print(f"File written to {base_file_dir}/{out_file_name}.txt")
+
+    elif output_backend == "csv":
+        pd.DataFrame(table, columns=names, copy=False).to_csv(f"{base_file_dir}/{out_file_name}.csv", index=False)
+        print(f"File is written to {base_file_dir}/{out_file_name}.csv")
+
+    else:
+        # Binary table (npy or parquet) with the column names and units, see results_store.py
+        write_results(
+            df=pd.DataFrame(table, columns=names, copy=False),
+            base_file_dir=base_file_dir,
+            name=out_file_name,
+            units=units,
+            backend=output_backend,
+            float32=float32,
+        )
+
+    return 0
+
+
+def post_process_run(base_file_dir, center, lines=True, properties=True, check_out_file=True, files=None):
+    """
+    Visits the directory of a run once. Returns an array with the line intensities (in the order of COLUMNS_EMISSIVITY) if lines is True
+    followed by fh2, fCO and the averaged EXTRA_OVR_COLUMNS if properties is True. Values that can not be calculated are NaN. files are the
+    files of the run already read by run_prefetch.py. If it is None the files are read here.
+    """
+
+    values = []
+
+    if lines:
+        # NaN if the run is not OK
+        path_integrals = intensity.get_L_line(center, check_out_file, files, base_file_dir)[0]
+        values.append(path_integrals if path_integrals is not None else np.full(len(intensity.COLUMNS_EMISSIVITY) - 1, np.nan))
+
+    if properties:
+        # The .ovr file is read even if the run is not OK
+        values.append(properties_module().calculate_properties(base_file_dir, center, files))
+
+    return np.concatenate(values)
+
+
+def post_process_chunk(chunk_centers, base_file_dir, lines=True, properties=True, check_out_file=True, prefetch_depth=PREFETCH_DEPTH, io_threads=IO_THREADS):
+    # Returns a 2D array with one row per center of the chunk
+
+    # The .out file is only needed for the lines
+    check_out_file = check_out_file and lines
+
+    if prefetch_depth <= 0:
+        return np.array(
+            [post_process_run(base_file_dir, center, lines, properties, check_out_file) for row, center in chunk_centers.iterrows()]
+        )
+
+    runs = prefetch_runs(
+        base_file_dir,
+        directory_names(chunk_centers),
+        ["_em.str"] if lines else [],
+        check_out_file=check_out_file,
+        depth=prefetch_depth,
+        io_threads=io_threads,
+        always_read=[".ovr"] if properties else [],
+    )
+
+    return np.array(
+        [
+            post_process_run(base_file_dir, center, lines, properties, check_out_file, files)
+            for (row, center), (fdir, files) in zip(chunk_centers.iterrows(), runs)
+        ]
+    )
+
+
+def post_process_range(arrays, start, stop, columns, base_file_dir, **kwargs):
+    # Runs in the workers of shared_pool.py: writes the values of the centers in the rows arrays["rows"][start:stop] of arrays["table"]
+    # to the same rows of the table
+
+    rows = arrays["rows"][start:stop]
+    table = arrays["table"]
+
+    chunk_centers = pd.DataFrame(table[rows, : len(columns)], columns=columns)
+    table[rows, len(columns) :] = post_process_chunk(chunk_centers, base_file_dir, **kwargs)
+
+    return 0
+
+
+def post_process_runs(
+    base_file_dir, shared, rows, columns, max_workers, check_out_file, on_chunk_result=None, progress=None, lines=True, properties=True,
+    chunks_per_worker=CHUNKS_PER_WORKER, prefetch_depth=PREFETCH_DEPTH, io_threads=IO_THREADS,
+):
+    """
+    Post-processes the centers in the given rows of the table shared.arrays["table"] (a SharedArrays, the centers are in the first
+    len(columns) columns) in chunks. The workers write the values of their chunk directly to the rows of the table, so the values are not
+    copied and the table is not allocated twice (see shared_pool.py). on_chunk_result(rows) is called with the rows of a chunk as soon as
+    the chunk is finished, the chunks are returned in order. The stage timers of the workers are added to the timers of this process (see
+    instrumentation.py).
+    """
+
+    if len(rows) == 0:
+        return 0
+
+    progress = Progress(len(rows)) if progress is None else progress
+
+    # Workers get only (start, stop), the rows are in the shared memory as well
+    shared.create("rows", (len(rows),), np.dtype(np.int64))[...] = rows
+
+    chunks = map_ranges(
+        partial(
+            post_process_range,
+            columns=columns,
+            base_file_dir=base_file_dir,
+            lines=lines,
+            properties=properties,
+            check_out_file=check_out_file,
+            prefetch_depth=prefetch_depth,
+            io_threads=io_threads,
+        ),
+        shared,
+        number_of_rows=len(rows),
+        max_workers=max_workers,
+        number_of_chunks=max_workers * chunks_per_worker,
+    )
+    for start, stop in chunks:
+        if on_chunk_result is not None:
+            on_chunk_result(rows[start:stop])
+
+        progress.add(stop - start)
+
+    return 0
+
+
+if __name__ == "__main__":
+    main(shard=shard_from_argv(), run_cache_directory=cache_from_argv())
@@ -0,0 +1,213 @@
+# Imports
+import sys
+import numpy as np
+import pandas as pd
+from time import time
+from scipy.spatial import cKDTree
+
+from intensity_lookup import read_table, log_values, TABLE_NAME
+from line_catalog import select_lines
+from run_status_manifest import read_centers_file, CENTER_COLUMNS
+
+
+################################################################################
+# Proposes new centers where the line intensities of the finished runs change fastest, so the next runs are spent on the transitions
+# instead of on the regions where the intensities are smooth.
+#
+#   python refine_grid.py <base_file_dir> [number of new centers]
+#
+# The intensity table (I_line_values_without_reversing, see intensity_lookup.py) is read and every finished run is predicted from its
+# NUMBER_OF_NEIGHBOURS nearest runs by inverse distance weighting of log10 of the intensities of REFINEMENT_LINES (leave one out). The
+# difference between the prediction and the run in dex is the interpolation error at that run. Candidate centers are the midpoints between
+# each run and its neighbours. They are scored by
+#
+#   "error":    mean interpolation error of the two runs
+#   "gradient": largest change of log10 intensity between the two runs divided by their distance
+#
+# and the best candidates are taken until the budget is reached. Distances are measured in the 5-D log parameter space with every parameter
+# divided by its range. Candidates closer than MIN_SEPARATION to a center of centers.txt (finished or not) or to an already proposed center
+# are skipped. Centers are rounded to 5 decimals like the directory names.
+#
+# The new centers are written to <base_file_dir>/centers_refinement.txt in the format of centers.txt. Create their runs with
+# create_cloudy_directories_and_files.main(fdir, verbose, centers_file_name="centers_refinement.txt"). If append is True they are appended to
+# centers.txt as well, so the post-processing scripts pick them up.
+################################################################################
+
+# Global variables
+BASE_FILE_DIR = "/scratch/m/murray/dtolgay/cloudy_runs/z_0/cr_1_CO87_CII_H_O3/cr_1_CO87_CII_H_O3_metallicity_above_minus_2"
+
+REFINEMENT_FILE_NAME = "centers_refinement.txt"
+
+# Lines whose intensities are used to find the transitions (names of line_catalog.py)
+REFINEMENT_LINES = ["CO10", "CO21", "CO32", "CO43", "CO54", "CO65", "CO76", "CO87", "C2"]
+
+# Number of new centers
+BUDGET = 1000
+NUMBER_OF_NEIGHBOURS = 8
+SCORE = "error"
+
+# Smallest distance between a new center and the other centers, in units of the parameter ranges
+MIN_SEPARATION = 0.01
+
+# Runs are predicted in chunks, each chunk holds NUMBER_OF_NEIGHBOURS values of every line for each run
+CHUNK_SIZE = 100000
+
+
+# Main
+def main(base_file_dir=BASE_FILE_DIR, budget=BUDGET, score=SCORE, append=False, name=TABLE_NAME):
+
+    start = time()
+
+    new_centers = refine_grid(base_file_dir, budget=budget, score=score, name=name)
+    write_centers(new_centers, base_file_dir, append=append)
+
+    print(f"It took {round((time() - start) / 60, 3)} minutes to refine the grid")
+
+    return 0
+
+
+# Functions
+
+def read_finished_runs(base_file_dir, name=TABLE_NAME, lines=REFINEMENT_LINES):
+    # Centers and log10 of the intensities of the lines of the runs that have all intensities
+
+    centers, values, columns = read_table(base_file_dir, name)
+
+    output_names = [line["output_name"] for line in select_lines(lines)]
+    missing = [output_name for output_name in output_names if output_name not in columns]
+    if len(missing) > 0:
+        raise KeyError(f"Columns {missing} are not in the {name} table. Columns: {columns}")
+    values = values[:, [columns.index(output_name) for output_name in output_names]]
+
+    finished = np.all(np.isfinite(values), axis=1)
+    print(f"{np.sum(finished)} of {len(centers)} runs are finished")
+
+    # Lines that are not emitted are 0. Intensities are floored at the smallest positive intensity of their line before the log is taken.
+    return centers[finished], log_values(values[finished])
+
+
+def interpolation_errors(points, log_values, distances, rows, chunk_size=CHUNK_SIZE):
+    # Largest difference (dex) between the log values of each run and their inverse distance weighted average over its neighbours
+
+    errors = np.empty(len(points))
+    for start in range(0, len(points), chunk_size):
+        stop = start + chunk_size
+        weights = 1 / np.maximum(distances[start:stop], 1e-12) ** 2
+        predicted = np.sum(weights[:, :, None] * log_values[rows[start:stop]], axis=1) / np.sum(weights, axis=1)[:, None]
+        errors[start:stop] = np.max(np.abs(predicted - log_values[start:stop]), axis=1)
+
+    return errors
+
+
+def score_pairs(points, log_values, number_of_neighbours=NUMBER_OF_NEIGHBOURS, score=SCORE):
+    """
+    Returns the pairs of neighbouring runs (number of pairs, 2) and their scores. Each pair is listed once. Also returns the interpolation
+    error of every run.
+    """
+
+    number_of_neighbours = min(number_of_neighbours, len(points) - 1)
+    distances, rows = cKDTree(points).query(points, k=number_of_neighbours + 1)
+
+    # The first neighbour is the run itself
+    distances, rows = distances[:, 1:], rows[:, 1:]
+    errors = interpolation_errors(points, log_values, distances, rows)
+
+    pairs = np.sort(np.column_stack([np.repeat(np.arange(len(points)), number_of_neighbours), rows.ravel()]), axis=1)
+    pairs = np.unique(pairs[pairs[:, 0] != pairs[:, 1]], axis=0)
+
+    if score == "error":
+        scores = 0.5 * (errors[pairs[:, 0]] + errors[pairs[:, 1]])
+    elif score == "gradient":
+        jumps = np.max(np.abs(log_values[pairs[:, 0]] - log_values[pairs[:, 1]]), axis=1)
+        scores = jumps / np.maximum(np.linalg.norm(points[pairs[:, 0]] - points[pairs[:, 1]], axis=1), 1e-12)
+    else:
+        raise ValueError(f"Unknown score {score}. Possible scores: error, gradient")
+
+    return pairs, scores, errors
+
+
+def select_candidates(candidates, existing_points, scales, budget, min_separation=MIN_SEPARATION):
+    """
+    Goes through the candidates (best first) and keeps the ones farther than min_separation from the existing points and from the kept
+    candidates, until budget candidates are kept. Returns the kept candidates.
+    """
+
+    distances_to_existing = cKDTree(existing_points / scales).query(candidates / scales, k=1)[0]
+
+    kept = np.empty((0, candidates.shape[1]))
+    for candidate, distance in zip(candidates, distances_to_existing):
+        if len(kept) == budget:
+            break
+        if distance < min_separation:
+            continue
+        if len(kept) > 0 and np.min(np.linalg.norm((kept - candidate) / scales, axis=1)) < min_separation:
+            continue
+
+        kept = np.vstack([kept, candidate])
+
+    return kept
+
+
+def refine_grid(base_file_dir, budget=BUDGET, score=SCORE, name=TABLE_NAME, min_separation=MIN_SEPARATION):
+    # Returns at most budget new centers (DataFrame with the CENTER_COLUMNS)
+
+    centers, log_values = read_finished_runs(base_file_dir, name)
+    all_centers = read_centers_file(base_file_dir).to_numpy()
+
+    # Every parameter is divided by its range
+    scales = np.ptp(all_centers, axis=0)
+    scales[scales == 0] = 1
+
+    pairs, scores, errors = score_pairs(centers / scales, log_values, score=score)
+    print(f"Interpolation error of the runs (dex): median {np.median(errors):.3f}, 90th percentile {np.percentile(errors, 90):.3f}, max {np.max(errors):.3f}")
+
+    # Midpoints of the best pairs, rounded like the directory names. More candidates are looked at if too many of them are skipped.
+    order = np.argsort(-scores, kind="stable")
+    new_centers = np.empty((0, len(CENTER_COLUMNS)))
+    number_of_candidates = 0
+    while len(new_centers) < budget and number_of_candidates < len(order):
+        block = order[number_of_candidates : number_of_candidates + 10 * budget]
+        number_of_candidates += len(block)
+
+        candidates = np.round(0.5 * (centers[pairs[block, 0]] + centers[pairs[block, 1]]), 5)
+        new_centers = np.vstack([
+            new_centers,
+            select_candidates(
+                candidates,
+                np.vstack([all_centers, new_centers]),
+                scales,
+                budget - len(new_centers),
+                min_separation,
+            ),
+        ])
+
+    print(f"{len(new_centers)} new centers are proposed from {number_of_candidates} candidates")
+
+    return pd.DataFrame(new_centers, columns=CENTER_COLUMNS)
+
+
+def write_centers(centers, base_file_dir, append=False):
+    # Writes the centers to REFINEMENT_FILE_NAME and appends them to centers.txt if append is True
+
+    np.savetxt(
+        fname=f"{base_file_dir}/{REFINEMENT_FILE_NAME}",
+        X=centers.to_numpy(),
+        fmt="%.5f",
+        header=" ".join(CENTER_COLUMNS),
+    )
+    print(f"{len(centers)} centers written to {base_file_dir}/{REFINEMENT_FILE_NAME}")
+
+    if append:
+        with open(f"{base_file_dir}/centers.txt", "a") as file:
+            np.savetxt(file, centers.to_numpy(), fmt="%.5f")
+        print(f"{len(centers)} centers appended to {base_file_dir}/centers.txt")
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    main(
+        base_file_dir=sys.argv[1] if len(sys.argv) > 1 else BASE_FILE_DIR,
+        budget=int(sys.argv[2]) if len(sys.argv) > 2 else BUDGET,
+    )
@@ -0,0 +1,141 @@
+# Imports
+import os
+import glob
+import numpy as np
+from time import time
+
+from instrumentation import stage
+from cloudy_file_readers import stat_file
+
+
+################################################################################
+# Partial results of the post-processing scripts are written to <base_file_dir>/checkpoints/<name>/part_XXXXX.npy while the script runs.
+# Every part has one row per finished center: the directory name of the run, the mtime of its .out file when it was processed and the
+# calculated values (NaN for broken runs). A rerun with resume loads the parts and only processes the centers that are not done yet or
+# whose .out file changed since then.
+################################################################################
+
+# Partial results are written at most this often
+CHECKPOINT_INTERVAL_SECONDS = 600
+
+
+# Functions
+
+def out_file_mtimes(base_file_dir, fdirs):
+    # mtime of the .out file of each run. NaN if the run is not started.
+
+    mtimes = np.full(len(fdirs), np.nan)
+    for i, fdir in enumerate(fdirs):
+        try:
+            with stage("stat"):
+                mtimes[i] = stat_file(f"{base_file_dir}/{fdir}/{fdir}.out").st_mtime
+        except OSError:
+            pass
+
+    return mtimes
+
+
+class ResultsCheckpoint:
+
+    def __init__(self, base_file_dir, name, number_of_values, interval_seconds=CHECKPOINT_INTERVAL_SECONDS):
+
+        self.directory = f"{base_file_dir}/checkpoints/{name}"
+        self.number_of_values = number_of_values
+        self.interval_seconds = interval_seconds
+        self.dtype = np.dtype(
+            [
+                ("fdir", "U128"),
+                ("out_mtime", np.float64),
+                ("values", np.float64, (number_of_values,)),
+            ]
+        )
+
+        self.pending = []
+        self.last_write = time()
+
+    def part_file_paths(self):
+
+        return sorted(glob.glob(f"{self.directory}/part_*.npy"))
+
+    def load(self):
+        """
+        Returns a dictionary fdir -> (out_mtime, values) of the centers in the existing parts. If the same center is in more than one part
+        the latest one is used. Parts written with a different number of values (e.g. different columns) are ignored.
+        """
+
+        done = {}
+        for part_file_path in self.part_file_paths():
+            part = np.load(part_file_path)
+
+            if part.dtype != self.dtype:
+                print(f"{part_file_path} has a different format. It is not used.")
+                continue
+
+            for fdir, out_mtime, values in zip(part["fdir"], part["out_mtime"], part["values"]):
+                done[str(fdir)] = (out_mtime, values)
+
+        print(f"{len(done)} centers are loaded from the checkpoints in {self.directory}")
+
+        return done
+
+    def add(self, fdir, out_mtime, values):
+        # values is None for broken runs
+
+        if values is None:
+            values = np.full(self.number_of_values, np.nan)
+
+        self.pending.append((fdir, out_mtime, values))
+
+        if time() - self.last_write > self.interval_seconds:
+            self.write()
+
+    def write(self):
+        # Writes the pending rows as a new part
+
+        self.last_write = time()
+        if len(self.pending) == 0:
+            return 0
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        part_file_paths = self.part_file_paths()
+        part_number = int(os.path.basename(part_file_paths[-1])[5:10]) + 1 if len(part_file_paths) > 0 else 0
+        fname = f"{self.directory}/part_{part_number:05d}.npy"
+
+        part = np.array(self.pending, dtype=self.dtype)
+        with open(f"{fname}.tmp", "wb") as file:
+            np.save(file, part)
+        os.replace(f"{fname}.tmp", fname)
+
+        print(f"{len(self.pending)} centers are written to the checkpoint {fname}")
+        self.pending = []
+
+        return 0
+
+    def consolidate(self, done):
+        # Replaces all parts with a single part that has the rows in done (dictionary fdir -> (out_mtime, values))
+
+        old_part_file_paths = self.part_file_paths()
+
+        self.pending = [(fdir, out_mtime, values) for fdir, (out_mtime, values) in done.items()]
+        self.write()
+
+        for part_file_path in old_part_file_paths:
+            os.remove(part_file_path)
+
+        return 0
+
+
+def split_done_and_todo(done, fdirs, out_mtimes):
+    """
+    Returns a boolean array that is True for the centers that are already in done with the same .out mtime (both NaN for runs that are
+    still not started) and should not be processed again.
+    """
+
+    is_done = np.zeros(len(fdirs), dtype=bool)
+    for i, (fdir, out_mtime) in enumerate(zip(fdirs, out_mtimes)):
+        if fdir in done:
+            previous_mtime = done[fdir][0]
+            is_done[i] = (previous_mtime == out_mtime) or (np.isnan(previous_mtime) and np.isnan(out_mtime))
+
+    return is_done
@@ -0,0 +1,154 @@
+# Imports
+import os
+import re
+import json
+import numpy as np
+import pandas as pd
+
+
+################################################################################
+# Binary alternatives to the text tables (I_line_values_without_reversing.txt, other_properties.csv).
+#
+# "npy":     <name>.npy holds a 2D array in column major (Fortran) order, so every column is contiguous on disk and can be read alone
+#            through a memory map. <name>.json next to it stores the column names, units and the number of rows.
+# "parquet": <name>.parquet written by pandas. Needs pyarrow (or fastparquet). Columns and units are stored in <name>.json as well.
+################################################################################
+
+BACKENDS = ["npy", "parquet"]
+
+
+# Functions
+
+def parse_column_header(header):
+    # Returns the column names and units of a header written as "Column 0: log_metallicity [log(Zsolar)]" lines
+
+    names, units = [], []
+    for line in header.strip().splitlines():
+        match = re.match(r"\s*Column\s+\d+:\s*(\S+)\s*(?:\[(.*)\])?", line)
+        if match is not None:
+            names.append(match.group(1))
+            units.append(match.group(2) or "")
+
+    return names, units
+
+
+def sidecar_file_path(base_file_dir, name):
+
+    return f"{base_file_dir}/{name}.json"
+
+
+def write_results(df, base_file_dir, name, units=None, backend="npy", float32=False):
+    """
+    Writes the DataFrame df to base_file_dir/<name>.<backend> with a json sidecar that stores the column names and units. units is a list
+    with the unit of each column ("" if dimensionless). If float32 is True the values are downcasted to float32.
+    """
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}. Possible backends: {BACKENDS}")
+
+    columns = [str(column) for column in df.columns]
+    units = [""] * len(columns) if units is None else list(units)
+    if len(units) != len(columns):
+        raise ValueError(f"{len(units)} units are given for {len(columns)} columns")
+
+    dtype = np.float32 if float32 else np.float64
+    fname = f"{base_file_dir}/{name}.{backend}"
+
+    if backend == "npy":
+        # Column major order so that each column is contiguous in the file
+        data = np.asfortranarray(df.to_numpy(dtype=dtype))
+        with open(f"{fname}.tmp", "wb") as file:
+            np.save(file, data)
+        os.replace(f"{fname}.tmp", fname)
+
+    elif backend == "parquet":
+        df.astype(dtype).to_parquet(fname, index=False)
+
+    metadata = {
+        "backend": backend,
+        "file_name": os.path.basename(fname),
+        "number_of_rows": len(df),
+        "dtype": np.dtype(dtype).name,
+        "columns": columns,
+        "units": units,
+    }
+    with open(sidecar_file_path(base_file_dir, name), "w") as file:
+        json.dump(metadata, file, indent=4)
+
+    print(f"File written to {fname}")
+
+    return 0
+
+
+def allocate_table(number_of_rows, number_of_columns, file_path=None, fortran_order=False):
+    """
+    Returns a float64 table filled with NaN that is filled in place, one row per center. If file_path is given the table is a memory map
+    of a .npy file on disk, so pages of the table that are written can be dropped from the memory (grids with millions of centers). With
+    fortran_order the columns are contiguous as the npy backend writes them, so write_results does not copy the table.
+    """
+
+    if file_path is None:
+        return np.full((number_of_rows, number_of_columns), np.nan, order="F" if fortran_order else "C")
+
+    table = np.lib.format.open_memmap(
+        file_path, mode="w+", dtype=np.float64, shape=(number_of_rows, number_of_columns), fortran_order=fortran_order
+    )
+    table[:] = np.nan
+
+    return table
+
+
+def read_metadata(base_file_dir, name):
+
+    with open(sidecar_file_path(base_file_dir, name), "r") as file:
+        return json.load(file)
+
+
+def read_results(base_file_dir, name, columns=None, mmap=True, float32=False):
+    """
+    Reads the table written by write_results. Only the given columns are read (all columns if columns is None). For the npy backend the
+    file is memory mapped if mmap is True, so only the pages of the requested columns are read from the disk. Returns a DataFrame.
+    """
+
+    metadata = read_metadata(base_file_dir, name)
+    columns = metadata["columns"] if columns is None else list(columns)
+
+    missing = [column for column in columns if column not in metadata["columns"]]
+    if len(missing) > 0:
+        raise KeyError(f"Columns {missing} are not in {name}. Columns: {metadata['columns']}")
+
+    fname = f"{base_file_dir}/{metadata['file_name']}"
+
+    if metadata["backend"] == "npy":
+        data = np.load(fname, mmap_mode="r" if mmap else None)
+        df = pd.DataFrame(
+            {column: np.asarray(data[:, metadata["columns"].index(column)]) for column in columns}
+        )
+
+    elif metadata["backend"] == "parquet":
+        df = pd.read_parquet(fname, columns=columns)
+
+    if float32:
+        df = df.astype(np.float32)
+
+    return df
+
+
+def read_column(base_file_dir, name, column):
+    # Returns a single column of a npy table as a read only memory mapped array. Nothing is copied into memory.
+
+    metadata = read_metadata(base_file_dir, name)
+    if metadata["backend"] != "npy":
+        raise ValueError(f"read_column only works for the npy backend, {name} is written with {metadata['backend']}")
+
+    data = np.load(f"{base_file_dir}/{metadata['file_name']}", mmap_mode="r")
+
+    return data[:, metadata["columns"].index(column)]
+
+
+def read_units(base_file_dir, name):
+    # Returns a dictionary column -> unit
+
+    metadata = read_metadata(base_file_dir, name)
+
+    return dict(zip(metadata["columns"], metadata["units"]))
@@ -0,0 +1,401 @@
+# Imports
+import os
+import sys
+import glob
+import socket
+import shutil
+import hashlib
+import numpy as np
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pack_cloudy_outputs import run_file_source
+from cloudy_file_readers import read_file
+
+
+################################################################################
+# Cache of Cloudy runs shared by the grids (z_0/..., z_3/..., testing_clumping_factor, ...). Runs with the same .in file give the same
+# outputs, so a center that is already run in another grid is not run or post-processed again. The key of a run is the sha256 of its
+# normalized .in file (comments, blank lines, trailing spaces and line endings removed) and CLOUDY_VERSION:
+#
+#   <cache directory>/runs/<key[:2]>/<key>/run<suffix>                  output files of an OK run, e.g. run.out, run_em.str, run.ovr.gz
+#   <cache directory>/rows/<name>_v<version>_<signature>/<part>.npy     post-processed rows (e.g. line intensities) of the runs
+#
+# The cache is off by default. It is used by run_cloudy_grid.py and the post-processing scripts if a cache directory is given to them, e.g.
+#
+#   python run_cloudy_grid.py --cache /scratch/m/murray/dtolgay/cloudy_runs/run_cache
+#
+# run_cloudy_grid.py restores the runs found in the cache before the queue is started and stores every run that finishes OK. Stored files
+# are hard links to the files of the run (copies if the cache is on another file system), made by a thread so the driver does not wait.
+# The post-processing takes the line intensities of the runs in the row cache and adds the runs it calculates. The signature of the rows is
+# the header of the table and the version is the version of the post-processing, so rows calculated with other lines or by older code are
+# not used. RowCache.invalidate removes single runs.
+#
+# Rows are stored with the hex run key as a 64 byte string. Every job writes its own part file; when there are more than MAX_ROW_PARTS
+# parts they are merged into one file sorted by key. The rows of a grid are found with a binary search in each part, the parts are memory
+# mapped.
+#
+# Restored files are hard links to the cache (LINK_MODE, copies if the cache is on another file system). The mode of the files is never
+# changed, because a hard link shares it with the files of the grid. Instead run_cloudy_grid.py removes the files of a run that are shared
+# with the cache (unlink_cached_files) before it starts the run again, so Cloudy never writes into the cache. Entries are written to a
+# temporary directory and renamed, so a job that is killed never leaves a partial entry and two jobs never write the same entry. The
+# directory of a stored entry is read only.
+################################################################################
+
+# Global variables
+# None does not use the cache. Scripts take the directory with --cache <directory> (see cache_from_argv).
+CACHE_DIRECTORY = None
+
+# Runs of another Cloudy version are not reused
+CLOUDY_VERSION = "c23.01"
+
+# "hardlink", "symlink" or "copy"
+LINK_MODE = "hardlink"
+
+# Files of a run directory that are not cached
+NOT_CACHED_SUFFIXES = [".in", ".lock", ".tmp"]
+
+# Row parts are merged into one file when there are more than this
+MAX_ROW_PARTS = 16
+
+# A merge lock older than this is left behind by a killed job
+STALE_MERGE_LOCK_SECONDS = 3600
+
+
+# Functions
+
+def cache_from_argv(argv=None, default=CACHE_DIRECTORY):
+    # Returns the directory given with --cache <directory> (or --cache=<directory>) on the command line, default if there is no --cache
+
+    argv = sys.argv[1:] if argv is None else argv
+
+    for i, argument in enumerate(argv):
+        if argument == "--cache" and i + 1 < len(argv):
+            return argv[i + 1]
+        if argument.startswith("--cache="):
+            return argument[len("--cache="):]
+
+    return default
+
+
+def normalize_in_file(content):
+    # Content of the .in file without comments, blank lines, trailing spaces and with \n line endings
+
+    lines = []
+    for line in content.replace("\r\n", "\n").split("\n"):
+        if line.lstrip().startswith(("#", "//", "%")):
+            continue
+
+        # Comments after the command, e.g. "H  1 1215.67 # Lya"
+        line = line.split(" #")[0].rstrip()
+        if line != "":
+            lines.append(line)
+
+    return "\n".join(lines) + "\n"
+
+
+def run_key(in_file_content):
+
+    return hashlib.sha256(f"{CLOUDY_VERSION}\n{normalize_in_file(in_file_content)}".encode()).hexdigest()
+
+
+def read_run_key(base_file_dir, fdir):
+    # Key of the run from its .in file. None if the run has no .in file.
+
+    try:
+        return run_key(read_file(run_file_source(base_file_dir, fdir, ".in")).decode("ascii", errors="replace"))
+    except FileNotFoundError:
+        return None
+
+
+def read_run_keys(base_file_dir, fdirs, max_threads=16):
+
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        return list(executor.map(lambda fdir: read_run_key(base_file_dir, fdir), fdirs))
+
+
+def cached_run_directory(cache_directory, key):
+
+    return f"{cache_directory}/runs/{key[:2]}/{key}"
+
+
+def store_run(base_file_dir, fdir, key, cache_directory):
+    # Hard links (or copies) the output files of the run to the cache. Returns False if the run is already in the cache.
+
+    directory = cached_run_directory(cache_directory, key)
+    if key is None or os.path.isdir(directory):
+        return False
+
+    tmp_directory = f"{directory}.tmp.{socket.gethostname()}.{os.getpid()}"
+    os.makedirs(tmp_directory, exist_ok=True)
+
+    with os.scandir(f"{base_file_dir}/{fdir}") as entries:
+        for entry in entries:
+            suffix = entry.name[len(fdir):]
+            if not entry.is_file() or not entry.name.startswith(fdir) or suffix.endswith(tuple(NOT_CACHED_SUFFIXES)):
+                continue
+
+            # The mode of the files is not changed, a hard link shares it with the file of the run
+            try:
+                os.link(entry.path, f"{tmp_directory}/run{suffix}")
+            except OSError:
+                # e.g. the cache is on another file system
+                shutil.copy2(entry.path, f"{tmp_directory}/run{suffix}")
+
+    try:
+        os.rename(tmp_directory, directory)
+    except OSError:
+        # Stored by another job in the meantime
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        return False
+
+    # Files can not be added to, removed from or renamed in a stored entry
+    os.chmod(directory, 0o555)
+
+    return True
+
+
+def store_finished_run(base_file_dir, fdir, cache_directory):
+    # Stores a run that finished OK. Called by a thread of run_cloudy_grid.py. Returns True if the run is stored.
+
+    try:
+        return store_run(base_file_dir, fdir, read_run_key(base_file_dir, fdir), cache_directory)
+    except OSError as e:
+        print(f"{fdir} could not be stored in the cache: {e}")
+        return False
+
+
+def restore_run(base_file_dir, fdir, key, cache_directory, link_mode=LINK_MODE):
+    # Links (or copies) the cached output files of the run into its directory. Returns False if the run is not in the cache.
+
+    directory = cached_run_directory(cache_directory, key)
+    if key is None or not os.path.isdir(directory):
+        return False
+
+    for file_name in os.listdir(directory):
+        source = f"{directory}/{file_name}"
+        target = f"{base_file_dir}/{fdir}/{fdir}{file_name[len('run'):]}"
+        try:
+            os.remove(target)
+        except FileNotFoundError:
+            pass
+
+        if link_mode == "hardlink":
+            try:
+                os.link(source, target)
+                continue
+            except OSError:
+                # e.g. the cache is on another file system
+                pass
+        elif link_mode == "symlink":
+            os.symlink(source, target)
+            continue
+
+        # Only the content is copied. Files stored by older versions are read only.
+        shutil.copyfile(source, target)
+
+    return True
+
+
+def unlink_cached_files(base_file_dir, fdir):
+    """
+    Removes the output files of the run that are shared with the cache (hard links or symbolic links) before the run is started again, so
+    Cloudy writes new files instead of overwriting the files in the cache. Returns the number of removed files.
+    """
+
+    number_of_removed = 0
+    with os.scandir(f"{base_file_dir}/{fdir}") as entries:
+        for entry in entries:
+            suffix = entry.name[len(fdir):]
+            if not entry.name.startswith(fdir) or suffix.endswith(tuple(NOT_CACHED_SUFFIXES)):
+                continue
+
+            if entry.is_symlink() or (entry.is_file() and entry.stat().st_nlink > 1):
+                os.remove(entry.path)
+                number_of_removed += 1
+
+    return number_of_removed
+
+
+def restore_cached_runs(base_file_dir, fdirs, cache_directory, max_threads=16):
+    # Restores the runs that are in the cache. Returns the runs that are not in the cache and the number of restored runs.
+
+    def restore(fdir):
+        return restore_run(base_file_dir, fdir, read_run_key(base_file_dir, fdir), cache_directory)
+
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        restored = list(executor.map(restore, fdirs))
+
+    print(f"{sum(restored)} of {len(fdirs)} runs are restored from the cache in {cache_directory}")
+
+    return [fdir for fdir, is_restored in zip(fdirs, restored) if not is_restored], sum(restored)
+
+
+class RowCache:
+    """
+    Post-processed rows of the runs keyed by the run key. Every job writes its own part files, so jobs of different grids can share it.
+    Rows of a later part replace the rows of the same run in the earlier parts. Rows that are all NaN mark invalidated runs.
+    """
+
+    def __init__(self, cache_directory, name, signature, number_of_values, version):
+
+        self.directory = f"{cache_directory}/rows/{name}_v{version}_{hashlib.sha256(signature.encode()).hexdigest()[:16]}"
+        self.dtype = np.dtype([("key", "S64"), ("values", np.float64, (number_of_values,))])
+        self.pending = []
+
+    def part_file_paths(self):
+        # Part files from the oldest to the newest. Their names start with the time they are written.
+
+        return sorted(glob.glob(f"{self.directory}/*.npy"))
+
+    def lookup(self, keys):
+        """
+        Returns (is_cached, values): whether each key has a row in the cache and the rows ((number of keys, number of values), NaN if not
+        cached). None keys are not cached.
+        """
+
+        if len(self.part_file_paths()) > MAX_ROW_PARTS:
+            self.merge_parts()
+
+        query = np.array([b"" if key is None else key.encode() for key in keys], dtype=self.dtype["key"])
+        values = np.full((len(keys), self.dtype["values"].shape[0]), np.nan)
+
+        for part_file_path in self.part_file_paths():
+            try:
+                part = np.load(part_file_path, mmap_mode="r")
+            except FileNotFoundError:
+                # Merged by another job. Its rows are in the newest part.
+                continue
+            if part.dtype != self.dtype:
+                continue
+
+            rows, is_found = find_keys(np.asarray(part["key"]), query)
+            values[is_found] = part["values"][rows[is_found]]
+
+        return ~np.all(np.isnan(values), axis=1), values
+
+    def add(self, key, values):
+
+        self.pending.append((key, values))
+
+    def invalidate(self, keys):
+        # The rows of the runs are not used anymore (e.g. the post-processing of the runs changed). They are removed when the parts are merged.
+
+        for key in keys:
+            self.add(key, np.full(self.dtype["values"].shape, np.nan))
+
+        return self.write()
+
+    def write(self):
+
+        if len(self.pending) == 0:
+            return 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        fname = f"{self.directory}/{time():.6f}_{socket.gethostname()}_{os.getpid()}.npy"
+        write_part(np.array(self.pending, dtype=self.dtype), fname)
+
+        print(f"{len(self.pending)} rows are written to the cache {fname}")
+        self.pending = []
+
+        return 0
+
+    def merge_parts(self):
+        """
+        Merges the parts into the newest one: one row per run (the newest), sorted by key, without the invalidated runs. The older parts are
+        removed. Only one job merges at a time, the others read the parts as they are.
+        """
+
+        lock_file_path = f"{self.directory}/merge.lock"
+        try:
+            if time() - os.stat(lock_file_path).st_mtime > STALE_MERGE_LOCK_SECONDS:
+                os.remove(lock_file_path)
+        except OSError:
+            pass
+
+        try:
+            os.close(os.open(lock_file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return 0
+
+        try:
+            part_file_paths = self.part_file_paths()
+            parts = [part for part in (np.load(part_file_path) for part_file_path in part_file_paths) if part.dtype == self.dtype]
+            if len(parts) == 0:
+                return 0
+            rows = np.concatenate(parts)
+
+            # Newest row of every run: np.unique returns the first row of each key of the reversed rows
+            keys, first_rows = np.unique(rows["key"][::-1], return_index=True)
+            rows = rows[::-1][first_rows]
+            rows = rows[~np.all(np.isnan(rows["values"]), axis=1)]
+
+            # The merged rows replace the newest part, so parts written in the meantime are still newer
+            write_part(rows, part_file_paths[-1])
+            for part_file_path in part_file_paths[:-1]:
+                os.remove(part_file_path)
+
+            print(f"{len(part_file_paths)} parts of the cache in {self.directory} are merged into {len(rows)} rows")
+        finally:
+            os.remove(lock_file_path)
+
+        return 0
+
+
+def write_part(rows, fname):
+
+    # Written to a temporary file first so that a reader never sees a partial file
+    with open(f"{fname}.tmp", "wb") as file:
+        np.save(file, rows)
+    os.replace(f"{fname}.tmp", fname)
+
+    return 0
+
+
+def find_keys(keys, query):
+    # Returns the row of each of query in keys and whether it is found. keys of a merged part are sorted already.
+
+    if len(keys) == 0:
+        return np.zeros(len(query), dtype=np.int64), np.zeros(len(query), dtype=bool)
+
+    order = None if np.all(keys[1:] >= keys[:-1]) else np.argsort(keys, kind="stable")
+    sorted_keys = keys if order is None else keys[order]
+
+    positions = np.minimum(np.searchsorted(sorted_keys, query, side="right") - 1, len(keys) - 1)
+    is_found = (positions >= 0) & (sorted_keys[np.maximum(positions, 0)] == query) & (query != b"")
+    rows = positions if order is None else order[np.maximum(positions, 0)]
+
+    return np.where(is_found, rows, 0), is_found
+
+
+def take_cached_rows(row_cache, keys, values, to_process):
+    """
+    Copies the cached rows of the runs that are to be processed to values (rows in the order of keys). Returns to_process without the
+    runs that are taken from the cache.
+    """
+
+    rows = np.flatnonzero(to_process)
+    is_cached, cached_values = row_cache.lookup(list(keys[rows]))
+    values[rows[is_cached]] = cached_values[is_cached]
+
+    print(f"{np.sum(is_cached)} centers are taken from the run cache")
+
+    to_process = to_process.copy()
+    to_process[rows[is_cached]] = False
+
+    return to_process
+
+
+def add_rows(row_cache, keys, values, rows):
+    # Adds the given rows that have a key and values (rows of broken runs are all NaN) to the cache and writes them
+
+    for i in rows:
+        if keys[i] is not None and not np.all(np.isnan(values[i])):
+            row_cache.add(keys[i], values[i])
+
+    try:
+        row_cache.write()
+    except OSError as e:
+        print(f"Rows could not be written to the cache: {e}")
+
+    return 0
@@ -0,0 +1,403 @@
+# Imports
+import os
+import signal
+import socket
+import subprocess
+import numpy as np
+from time import time, sleep
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from run_status_manifest import refresh_manifest, read_centers_file, directory_names, find_rows, failed_runs_mask, STATUS_OK
+from out_file_status import classify_out_file, REASON_OK
+from runtime_model import read_runtime_model, predict_runtime, longest_first
+from grid_shards import shard_from_argv, shard_name
+from instrumentation import Progress, write_summary
+from run_cache import CACHE_DIRECTORY, restore_cached_runs, store_finished_run, unlink_cached_files, cache_from_argv
+
+
+################################################################################
+# Runs Cloudy over a grid made by create_cloudy_directories_and_files.py. Every run is started in its own directory as
+#
+#   <CLOUDY_EXECUTABLE> -r <fdir>
+#
+# so Cloudy reads <fdir>.in and writes <fdir>.out and the save files next to it. At most max_workers runs are started at the same time and a
+# new run is taken from the queue as soon as one finishes, so slow (high density) runs do not hold up the others. If the runtime model of
+# the grid is fitted (runtime_model.py) the runs with the longest predicted runtime are started first, so the long runs do not start at
+# the end of the job. A centers_job_XXX.txt file written by runtime_model.py can be given to run only its centers in its order.
+#
+# A run is claimed by creating <fdir>.lock in its directory (with O_EXCL, which is atomic on Lustre as well). The lock holds the host, the
+# pid and the SLURM job id of the driver and it is removed when the run ends. Several drivers (e.g. one per node) can work on the same grid
+# at the same time: each of them skips the runs that are claimed by the others. A lock is left behind by a job that was killed if it was
+# written on this host by a process that does not exist anymore, or by a SLURM job that is not in squeue anymore (squeue is called at most
+# once every SQUEUE_CACHE_SECONDS). Such locks and locks older than the wall time are taken over: they are renamed to a name of the driver
+# (only one driver can rename a lock) and checked again before the run is claimed. After a run is claimed its .out file is checked again,
+# so a run that another driver finished OK after the queue was made is not run again.
+#
+# Runs that aborted or finished with warnings fail the same way every time, so they are not started again unless rerun_failed is True.
+#
+# The driver stops starting new runs and terminates the running ones shutdown_margin_minutes before the wall time ends, or when it receives
+# SIGTERM (e.g. sbatch --signal=TERM@600). Terminated runs are truncated and they are run again by the next job.
+#
+# Any executable that accepts "-r <name>" can be used in place of Cloudy to test the driver (see cloudy_stand_in.py).
+################################################################################
+
+# Global variables
+BASE_FILE_DIR = "/scratch/m/murray/dtolgay/cloudy_runs/z_0/cr_1_CO87_CII_H_O3/cr_1_CO87_CII_H_O3_metallicity_above_minus_2"
+CLOUDY_EXECUTABLE = "/scratch/m/murray/dtolgay/cloudy/c23.01/source/cloudy.exe"
+
+# One Cloudy process per core
+MAX_WORKERS = 40
+
+# Must be the same as the --time of the SLURM job
+WALL_TIME_HOURS = 23
+SHUTDOWN_MARGIN_MINUTES = 15
+
+# Seconds between the checks of the running processes
+POLL_SECONDS = 1
+# Seconds to wait for the terminated processes before they are killed
+TERMINATE_TIMEOUT_SECONDS = 30
+
+LOCK_SUFFIX = ".lock"
+
+# Threads that store the finished runs in the run cache (see run_cache.py), so the driver does not wait for the file system
+CACHE_THREADS = 2
+
+# Seconds the list of the running SLURM jobs is reused before squeue is called again
+SQUEUE_CACHE_SECONDS = 300
+
+# If False the runs that aborted or finished with warnings in the manifest are skipped
+RERUN_FAILED = False
+
+
+# Main
+def main(
+    base_file_dir=BASE_FILE_DIR,
+    cloudy_executable=CLOUDY_EXECUTABLE,
+    max_workers=MAX_WORKERS,
+    wall_time_hours=WALL_TIME_HOURS,
+    shutdown_margin_minutes=SHUTDOWN_MARGIN_MINUTES,
+    use_manifest=True,
+    centers_file_name=None,
+    shard=None,
+    cache_directory=CACHE_DIRECTORY,
+    rerun_failed=RERUN_FAILED,
+):
+
+    start = time()
+    deadline = start + wall_time_hours * 3600 - shutdown_margin_minutes * 60
+
+    fdirs = runs_to_start(base_file_dir, use_manifest, max_workers, centers_file_name, shard, rerun_failed)
+
+    # Runs with the same .in file as a run in the cache are not run again, their outputs are linked from the cache (see run_cache.py)
+    number_of_restored = 0
+    if cache_directory is not None:
+        fdirs, number_of_restored = restore_cached_runs(base_file_dir, fdirs, cache_directory)
+    print(f"{len(fdirs)} runs are in the queue")
+
+    progress = Progress(len(fdirs))
+    counts = run_queue(
+        base_file_dir=base_file_dir,
+        fdirs=fdirs,
+        cloudy_executable=cloudy_executable,
+        max_workers=max_workers,
+        deadline=deadline,
+        stale_lock_seconds=wall_time_hours * 3600,
+        progress=progress,
+        cache_directory=cache_directory,
+    )
+    counts["restored_from_cache"] = number_of_restored
+
+    for name, count in counts.items():
+        print(f"{name}: {count}")
+    print(f"It took {round((time() - start) / 60, 3)} minutes to run the queue")
+
+    write_summary(base_file_dir, shard_name("run_cloudy_grid", shard), progress, max_workers, extra={"counts": counts})
+
+    return 0
+
+
+# Functions
+
+def runs_to_start(base_file_dir, use_manifest=True, max_workers=MAX_WORKERS, centers_file_name=None, shard=None, rerun_failed=RERUN_FAILED):
+    """
+    Returns the directory names of the runs that have an .in file in the order they are started. If centers_file_name is given only its
+    centers are returned in the order of the file, otherwise the centers in centers.txt are returned longest-first if runtime_model.json
+    exists and in the order of centers.txt if not. The manifest is refreshed first (see run_status_manifest.py) and if use_manifest is True
+    the runs that are already OK are not returned. Runs that aborted or finished with warnings are not returned unless rerun_failed is True
+    (also if they are in centers_file_name). If shard (i, N) is given only the centers of the shard are returned (see grid_shards.py).
+    """
+
+    manifest = refresh_manifest(base_file_dir, max_workers=max_workers, shard=shard)
+
+    if centers_file_name is not None:
+        rows = find_rows(directory_names(manifest), directory_names(read_centers_file(base_file_dir, centers_file_name)))
+        if np.any(rows < 0):
+            print(f"{np.sum(rows < 0)} centers in {centers_file_name} are not in centers.txt. They are skipped.")
+        manifest = manifest[rows[rows >= 0]]
+    else:
+        model = read_runtime_model(base_file_dir)
+        if model is not None:
+            manifest = manifest[longest_first(predict_runtime(model, manifest))]
+            print("Runs are sorted longest-first with the runtime model")
+
+    fdirs = directory_names(manifest)
+
+    if use_manifest:
+        is_ok = manifest["status"] == STATUS_OK
+        print(f"{np.sum(is_ok)} runs are OK in the manifest. They are skipped.")
+        fdirs = [fdir for fdir, ok in zip(fdirs, is_ok) if not ok]
+
+    if not rerun_failed:
+        # The same .in file fails the same way again
+        has_failed = failed_runs_mask(manifest)
+        print(f"{np.sum(has_failed)} runs aborted or finished with warnings. They are skipped, use rerun_failed=True to run them again.")
+        failed_fdirs = set(directory_names(manifest[has_failed]))
+        fdirs = [fdir for fdir in fdirs if fdir not in failed_fdirs]
+
+    has_in_file = [os.path.isfile(f"{base_file_dir}/{fdir}/{fdir}.in") for fdir in fdirs]
+    if not all(has_in_file):
+        print(f"{len(fdirs) - sum(has_in_file)} runs do not have an .in file. Run create_cloudy_directories_and_files.py first.")
+
+    return [fdir for fdir, exists in zip(fdirs, has_in_file) if exists]
+
+
+def claim_run(base_file_dir, fdir, stale_lock_seconds):
+    # Returns True if the run is claimed by this driver. The lock file holds the host, the pid and the SLURM job id ("-" outside of SLURM) of
+    # the driver.
+
+    lock_file_path = f"{base_file_dir}/{fdir}/{fdir}{LOCK_SUFFIX}"
+
+    try:
+        if is_lock_stale(lock_file_path, stale_lock_seconds):
+            # Left behind by a job that does not run anymore
+            take_over_stale_lock(lock_file_path, stale_lock_seconds)
+    except OSError:
+        pass
+
+    try:
+        file_descriptor = os.open(lock_file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+
+    with os.fdopen(file_descriptor, "w") as file:
+        file.write(f"{socket.gethostname()} {os.getpid()} {os.environ.get('SLURM_JOB_ID', '-')}\n")
+
+    return True
+
+
+def take_over_stale_lock(lock_file_path, stale_lock_seconds):
+    """
+    Removes a stale lock. The lock is renamed to a name of this driver first (rename is atomic, only one driver gets it) and checked again,
+    because another driver can have replaced the stale lock with its own lock after it was checked. A lock that is not stale is put back
+    (os.link does not overwrite a lock created in the meantime).
+    """
+
+    taken_lock_file_path = f"{lock_file_path}.{socket.gethostname()}.{os.getpid()}.stale"
+    try:
+        os.rename(lock_file_path, taken_lock_file_path)
+    except FileNotFoundError:
+        # Taken over by another driver
+        return 0
+
+    try:
+        if not is_lock_stale(taken_lock_file_path, stale_lock_seconds):
+            os.link(taken_lock_file_path, lock_file_path)
+    finally:
+        os.remove(taken_lock_file_path)
+
+    return 0
+
+
+def is_lock_stale(lock_file_path, stale_lock_seconds):
+    # Returns True if the driver that wrote the lock does not run anymore. Raises OSError if there is no lock.
+
+    if time() - os.stat(lock_file_path).st_mtime > stale_lock_seconds:
+        return True
+
+    with open(lock_file_path) as file:
+        fields = file.read().split()
+
+    if (len(fields) < 2) or not fields[1].isdigit():
+        # Being written by the driver that claimed the run
+        return False
+    host, pid = fields[0], int(fields[1])
+    # Locks of older drivers have only the host and the pid
+    job_id = fields[2] if len(fields) > 2 else "-"
+
+    if host == socket.gethostname():
+        return not is_process_running(pid)
+
+    if job_id != "-":
+        running_jobs = running_slurm_jobs()
+        if running_jobs is not None:
+            return job_id not in running_jobs
+
+    return False
+
+
+def is_process_running(pid):
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Runs as another user
+        return True
+
+    return True
+
+
+# Job ids returned by the last squeue call and the time of the call
+_squeue_cache = {"time": -np.inf, "jobs": None}
+
+
+def running_slurm_jobs():
+    # Returns the set of the ids of the pending and running SLURM jobs or None if squeue can not be called. squeue is called at most once
+    # every SQUEUE_CACHE_SECONDS.
+
+    if time() - _squeue_cache["time"] > SQUEUE_CACHE_SECONDS:
+        try:
+            output = subprocess.run(["squeue", "-h", "-o", "%A"], capture_output=True, text=True, timeout=60, check=True).stdout
+            _squeue_cache["jobs"] = set(output.split())
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"squeue could not be called: {e}")
+            _squeue_cache["jobs"] = None
+        _squeue_cache["time"] = time()
+
+    return _squeue_cache["jobs"]
+
+
+def release_run(base_file_dir, fdir):
+
+    try:
+        os.remove(f"{base_file_dir}/{fdir}/{fdir}{LOCK_SUFFIX}")
+    except OSError:
+        pass
+
+
+def start_run(base_file_dir, fdir, cloudy_executable):
+
+    # Outputs restored from or stored in the run cache are shared with it. They are removed, so Cloudy does not overwrite the cache.
+    unlink_cached_files(base_file_dir, fdir)
+
+    return subprocess.Popen(
+        [cloudy_executable, "-r", fdir],
+        cwd=f"{base_file_dir}/{fdir}",
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def run_queue(base_file_dir, fdirs, cloudy_executable, max_workers, deadline, stale_lock_seconds=WALL_TIME_HOURS * 3600, progress=None, cache_directory=None):
+    """
+    Runs the given runs with at most max_workers Cloudy processes at the same time until the queue is empty or the deadline (time in
+    seconds since the epoch) is reached. Returns the number of runs that are finished OK, finished not OK, terminated at the shutdown,
+    skipped because another driver claimed or finished them and not started. Runs that finish OK are stored in the cache by CACHE_THREADS threads if
+    cache_directory is given.
+    """
+
+    queue = deque(fdirs)
+    running = {}
+    counts = {"ok": 0, "not_ok": 0, "terminated": 0, "claimed_by_others": 0, "finished_by_others": 0, "not_started": 0}
+
+    # SLURM sends SIGTERM before the job is killed
+    shutdown_requested = []
+    previous_handler = signal.signal(signal.SIGTERM, lambda signum, frame: shutdown_requested.append(signum))
+
+    progress = Progress(len(fdirs)) if progress is None else progress
+    number_of_finished = 0
+
+    cache_executor = ThreadPoolExecutor(max_workers=CACHE_THREADS) if cache_directory is not None else None
+    stored = []
+
+    try:
+        while len(queue) > 0 or len(running) > 0:
+
+            if shutdown_requested or time() > deadline:
+                print(f"Shutting down. {len(running)} running processes are terminated.")
+                terminate_runs(base_file_dir, running)
+                counts["terminated"] += len(running)
+                running = {}
+                break
+
+            # Fill the free cores
+            while len(running) < max_workers and len(queue) > 0:
+                fdir = queue.popleft()
+                if not claim_run(base_file_dir, fdir, stale_lock_seconds):
+                    counts["claimed_by_others"] += 1
+                    continue
+
+                # The queue is made when the driver starts. Another driver can have finished the run since then.
+                if classify_out_file(f"{base_file_dir}/{fdir}/{fdir}.out") == REASON_OK:
+                    release_run(base_file_dir, fdir)
+                    counts["finished_by_others"] += 1
+                    continue
+
+                try:
+                    running[fdir] = start_run(base_file_dir, fdir, cloudy_executable)
+                except OSError as e:
+                    print(f"{fdir} could not be started: {e}")
+                    release_run(base_file_dir, fdir)
+                    counts["not_ok"] += 1
+
+            sleep(POLL_SECONDS)
+
+            for fdir, process in list(running.items()):
+                if process.poll() is None:
+                    continue
+
+                del running[fdir]
+                release_run(base_file_dir, fdir)
+
+                reason = classify_out_file(f"{base_file_dir}/{fdir}/{fdir}.out")
+                if reason == REASON_OK:
+                    counts["ok"] += 1
+                    if cache_executor is not None:
+                        stored.append(cache_executor.submit(store_finished_run, base_file_dir, fdir, cache_directory))
+                else:
+                    counts["not_ok"] += 1
+                    print(f"{fdir} finished with exit code {process.returncode}: {reason}")
+
+                # Runs claimed or finished by other drivers are counted as finished, so the ETA is for the runs of this driver
+                number_of_finished += 1
+                progress.update(number_of_finished + counts["claimed_by_others"] + counts["finished_by_others"])
+
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        # Nothing is left running if the driver stops because of an error
+        terminate_runs(base_file_dir, running)
+
+        if cache_executor is not None:
+            # Waits for the runs that are being stored
+            cache_executor.shutdown(wait=True)
+
+    counts["not_started"] = len(queue)
+    if cache_executor is not None:
+        counts["stored_in_cache"] = sum(future.result() for future in stored)
+
+    return counts
+
+
+def terminate_runs(base_file_dir, running):
+    # Sends SIGTERM to the running processes, kills the ones that did not stop after TERMINATE_TIMEOUT_SECONDS and removes their locks
+
+    for process in running.values():
+        if process.poll() is None:
+            process.terminate()
+
+    end = time() + TERMINATE_TIMEOUT_SECONDS
+    for fdir, process in running.items():
+        try:
+            process.wait(timeout=max(end - time(), 0))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        release_run(base_file_dir, fdir)
+
+    return 0
+
+
+if __name__ == "__main__":
+    main(shard=shard_from_argv(), cache_directory=cache_from_argv())
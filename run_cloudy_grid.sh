@@ -0,0 +1,19 @@
+#!/bin/bash
+#SBATCH --account=rrg-rbond-ac
+#SBATCH --nodes=1
+#SBATCH --ntasks-per-node=40
+#SBATCH --time=23:00:00
+#SBATCH --signal=B:TERM@600
+#SBATCH --job-name=run_cloudy_grid
+#SBATCH --output=run_cloudy_grid.out
+#SBATCH --error=run_cloudy_grid.err
+
+cd "/scratch/m/murray/dtolgay/cloudy_runs"
+
+module purge 
+ml python/3.11.5
+
+# WALL_TIME_HOURS in run_cloudy_grid.py must be the same as --time. The same script can be submitted more than once to run the grid
+# on more nodes, the drivers do not start the runs that are claimed by the others. To split the grid over a job array instead, add
+# "#SBATCH --array=0-9" and run "python run_cloudy_grid.py --shard ${SLURM_ARRAY_TASK_ID}/10" (see grid_shards.py).
+exec python run_cloudy_grid.py
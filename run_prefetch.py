@@ -0,0 +1,111 @@
+# Imports
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from out_file_status import classify_out_file, REASON_OK
+from cloudy_file_readers import read_file, read_last_iteration_bytes
+from pack_cloudy_outputs import run_file_source
+
+
+################################################################################
+# Reads the files of the next runs with a few threads while the current run is parsed and integrated, so the process does not wait for
+# the file system (open and read latency on Lustre) between the runs:
+#
+#   for fdir, files in prefetch_runs(base_file_dir, fdirs, ["_em.str"], depth=8, io_threads=4):
+#       if files["reason"] == REASON_OK:
+#           data = read_converged_iteration(file_source(files, "_em.str"), ...)
+#
+# At most depth runs are read ahead (backpressure): a new run is only started when the loop takes a finished one, so the memory is
+# bounded by depth * (size of the files of a run) per process. The runs are returned in the given order. The best depth depends on the
+# file system: a few runs are enough on a local disk, Lustre needs more runs in flight to hide its latency.
+#
+# Only the end of the .out file is read (see out_file_status.py) and the other files are read only if the run is OK (the always_read files
+# are read for every run). Files with a reader in PREFETCH_READERS are read with it: only the header and the last iteration of _em.str are
+# read (read_last_iteration_bytes), the same bytes read_converged_iteration reads from the disk. The other files are read completely.
+################################################################################
+
+PREFETCH_DEPTH = 8
+IO_THREADS = 4
+
+# suffix -> function that returns the content to keep of the file (path or packed bytes)
+PREFETCH_READERS = {"_em.str": read_last_iteration_bytes}
+
+
+# Functions
+
+def read_run_files(base_file_dir, fdir, suffixes, check_out_file=True, always_read=()):
+    """
+    Returns a dictionary with the reason of the run (out_file_status.py, REASON_OK if check_out_file is False) and the content of the
+    files <fdir><suffix> for the given suffixes (the part returned by PREFETCH_READERS for the suffixes in it). Files are read only if the
+    run is OK, the suffixes in always_read are read for every run (e.g. .ovr, the properties are calculated for the runs that are not OK as
+    well). If a file can not be read the exception is stored in place of the content and raised by file_source.
+    """
+
+    files = {"reason": REASON_OK}
+
+    if check_out_file:
+        try:
+            files["reason"] = classify_out_file(run_file_source(base_file_dir, fdir, ".out"))
+        except Exception as e:
+            files["reason"] = e
+
+    for suffix in list(always_read) + (list(suffixes) if files["reason"] == REASON_OK else []):
+        try:
+            files[suffix] = PREFETCH_READERS.get(suffix, read_file)(run_file_source(base_file_dir, fdir, suffix))
+        except Exception as e:
+            files[suffix] = e
+
+    return files
+
+
+def file_source(files, key):
+    # Content of a file read by read_run_files. Raises the exception if the file could not be read.
+
+    if isinstance(files[key], Exception):
+        raise files[key]
+
+    return files[key]
+
+
+def prefetch(items, load, depth=PREFETCH_DEPTH, io_threads=IO_THREADS):
+    """
+    Yields (item, load(item)) for the items in order. load is called by io_threads threads for at most depth items ahead of the item
+    that is yielded. If depth is 0 load is called when the item is needed, without threads.
+    """
+
+    if depth <= 0:
+        for item in items:
+            yield item, load(item)
+        return
+
+    items = iter(items)
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=io_threads) as executor:
+
+        for item in items:
+            pending.append((item, executor.submit(load, item)))
+            if len(pending) == depth:
+                break
+
+        while len(pending) > 0:
+            item, future = pending.popleft()
+            result = future.result()
+
+            # One item out, one item in
+            for next_item in items:
+                pending.append((next_item, executor.submit(load, next_item)))
+                break
+
+            yield item, result
+
+
+def prefetch_runs(base_file_dir, fdirs, suffixes, check_out_file=True, depth=PREFETCH_DEPTH, io_threads=IO_THREADS, always_read=()):
+    # Yields (fdir, files) with the files read by read_run_files
+
+    return prefetch(
+        fdirs,
+        lambda fdir: read_run_files(base_file_dir, fdir, suffixes, check_out_file, always_read),
+        depth=depth,
+        io_threads=io_threads,
+    )
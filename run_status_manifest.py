@@ -0,0 +1,382 @@
+# Imports
+import os
+import socket
+import numpy as np
+import pandas as pd
+from time import time
+from functools import partial
+
+from out_file_status import classify_out_file, REASONS, REASON_OK, REASON_MISSING, REASON_ABORT, REASON_WARNINGS
+from cloudy_file_readers import stat_file
+from instrumentation import stage, Progress, write_summary
+from shared_pool import SharedArrays, map_ranges
+
+
+################################################################################
+# Global variables
+
+# The manifest is stored in the grid directory next to centers.txt
+MANIFEST_FILE_NAME = "run_status_manifest.npy"
+
+# Status codes stored in the manifest
+STATUS_NOT_STARTED = 0
+STATUS_OK = 1
+STATUS_BROKEN = 2
+STATUS_LOW_HDEN = 3
+
+STATUS_NAMES = {
+    STATUS_NOT_STARTED: "not_started",
+    STATUS_OK: "ok",
+    STATUS_BROKEN: "broken",
+    STATUS_LOW_HDEN: "low_hden",
+}
+
+# hden-4.xxx is not properly run in cloudy. nH is too low. Runs below this value are not checked.
+LOW_HDEN_THRESHOLD = -10
+
+CENTER_COLUMNS = [
+    "log_metallicity",
+    "log_hden",
+    "log_turbulence",
+    "log_isrf",
+    "log_radius",
+]
+
+# One row per center. The .out mtime and size are used to decide whether the .out file has to be read again. reason is the result of
+# out_file_status.classify_out_file ("" if the run is not checked yet). Directory names are not stored, they are made from the centers with
+# directory_names(manifest) when they are needed.
+MANIFEST_DTYPE = np.dtype(
+    [(column, np.float64) for column in CENTER_COLUMNS]
+    + [
+        ("status", np.int8),
+        ("reason", "U9"),
+        ("out_mtime", np.float64),
+        ("out_size", np.int64),
+    ]
+)
+################################################################################
+
+
+# Main
+def main(base_file_dir, max_workers=40, recheck_ok=False, write_rerun_files=True, shard=None):
+
+    start = time()
+
+    manifest = refresh_manifest(
+        base_file_dir=base_file_dir,
+        max_workers=max_workers,
+        recheck_ok=recheck_ok,
+        shard=shard,
+    )
+
+    print_status_counts(manifest)
+
+    if write_rerun_files:
+        write_rerun_centers_files(manifest, base_file_dir, shard)
+
+    end = time()
+    print(f"It took {np.round((end - start) / 60, 3)} minutes to refresh the manifest")
+
+    return 0
+
+
+# Functions
+
+def directory_name(center):
+    # Directory name of a single run. center is a row of the centers DataFrame (or a dictionary) with the CENTER_COLUMNS.
+    return f"hden{center['log_hden']:.5f}_metallicity{center['log_metallicity']:.5f}_turbulence{center['log_turbulence']:.5f}_isrf{center['log_isrf']:.5f}_radius{center['log_radius']:.5f}"
+
+
+def directory_names(centers):
+    # Directory name of each run. centers is a DataFrame (or structured array) with the CENTER_COLUMNS.
+    return [
+        f"hden{log_hden:.5f}_metallicity{log_metallicity:.5f}_turbulence{log_turbulence:.5f}_isrf{log_isrf:.5f}_radius{log_radius:.5f}"
+        for log_metallicity, log_hden, log_turbulence, log_isrf, log_radius in zip(
+            *(np.asarray(centers[column], dtype=float) for column in CENTER_COLUMNS)
+        )
+    ]
+
+
+def read_centers_file(base_file_dir, centers_file_name="centers.txt"):
+
+    try:
+        centers = np.loadtxt(fname=f"{base_file_dir}/{centers_file_name}", ndmin=2)
+    except ValueError:
+        # Some centers.txt files have a header line without the comment character
+        centers = np.loadtxt(fname=f"{base_file_dir}/{centers_file_name}", ndmin=2, skiprows=1)
+
+    if centers.size == 0:
+        # e.g. an empty centers_rerun_<reason>.txt
+        centers = centers.reshape(0, len(CENTER_COLUMNS))
+
+    return pd.DataFrame(centers, columns=CENTER_COLUMNS)
+
+
+def find_rows(fdirs, fdirs_to_find):
+    """
+    Returns the row of each of fdirs_to_find in fdirs, -1 if it is not in fdirs. centers.txt can have the same center more than once, the
+    first row of a directory name is returned then.
+    """
+
+    index = pd.Index(fdirs)
+    if index.is_unique:
+        return index.get_indexer(fdirs_to_find)
+
+    unique_rows = np.flatnonzero(~index.duplicated())
+    rows = index[unique_rows].get_indexer(fdirs_to_find)
+
+    return np.where(rows >= 0, unique_rows[rows], -1)
+
+
+def create_manifest(centers):
+    # New manifest where nothing is checked yet
+
+    manifest = np.zeros(len(centers), dtype=MANIFEST_DTYPE)
+
+    for column in CENTER_COLUMNS:
+        manifest[column] = centers[column]
+
+    manifest["status"] = np.where(
+        manifest["log_hden"] > LOW_HDEN_THRESHOLD, STATUS_NOT_STARTED, STATUS_LOW_HDEN
+    )
+    manifest["reason"] = ""
+    manifest["out_mtime"] = np.nan
+    manifest["out_size"] = -1
+
+    return manifest
+
+
+def read_manifest(base_file_dir, file_name=MANIFEST_FILE_NAME):
+
+    return np.load(f"{base_file_dir}/{file_name}")
+
+
+def write_manifest(manifest, base_file_dir, file_name=MANIFEST_FILE_NAME):
+
+    fname = f"{base_file_dir}/{file_name}"
+
+    # Write to a temporary file first so that a killed job never leaves a half written manifest behind. The temporary file is different for
+    # every process since more than one driver (run_cloudy_grid.py) can refresh the manifest at the same time.
+    tmp_fname = f"{fname}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp_fname, "wb") as file:
+        np.save(file, manifest)
+    os.replace(tmp_fname, fname)
+
+    return 0
+
+
+def status_from_reason(reason):
+
+    if reason == REASON_OK:
+        return STATUS_OK
+    elif reason == REASON_MISSING:
+        return STATUS_NOT_STARTED
+    else:
+        return STATUS_BROKEN
+
+
+def check_runs(base_file_dir, fdirs, previous_mtimes, previous_sizes, previous_statuses, previous_reasons):
+    """
+    Stats the .out file of the given runs. The .out file is only read (only its tail, see out_file_status.py) if the mtime or the size is 
+    different than the values stored in the manifest. Returns the new status, reason, mtime and size arrays.
+    """
+
+    statuses = np.array(previous_statuses, dtype=np.int8)
+    reasons = np.array(previous_reasons, dtype=MANIFEST_DTYPE["reason"])
+    mtimes = np.array(previous_mtimes, dtype=np.float64)
+    sizes = np.array(previous_sizes, dtype=np.int64)
+
+    # Imported here because pack_cloudy_outputs.py reads the manifest
+    from pack_cloudy_outputs import get_packed_grid
+    packed_grid = get_packed_grid(base_file_dir)
+
+    for i, fdir in enumerate(fdirs):
+        out_file_path = f"{base_file_dir}/{fdir}/{fdir}.out"
+
+        try:
+            with stage("stat"):
+                stat = stat_file(out_file_path)
+        except OSError:
+            if (packed_grid is not None) and packed_grid.is_packed(fdir):
+                # Only OK runs are packed. Their directories can be removed after packing.
+                statuses[i], reasons[i] = STATUS_OK, REASON_OK
+                continue
+            statuses[i], reasons[i], mtimes[i], sizes[i] = STATUS_NOT_STARTED, REASON_MISSING, np.nan, -1
+            continue
+
+        if (stat.st_mtime == mtimes[i]) and (stat.st_size == sizes[i]) and (reasons[i] != "") and (reasons[i] != REASON_MISSING):
+            # Nothing changed since the last refresh
+            continue
+
+        try:
+            reasons[i] = classify_out_file(out_file_path)
+        except Exception as e:
+            print(f"Error: {e}")
+            reasons[i] = ""
+        statuses[i] = status_from_reason(reasons[i]) if reasons[i] != "" else STATUS_BROKEN
+
+        mtimes[i], sizes[i] = stat.st_mtime, stat.st_size
+
+    return statuses, reasons, mtimes, sizes
+
+
+def check_runs_range(arrays, start, stop, base_file_dir):
+    # Runs in the workers of shared_pool.py: checks the runs start:stop of arrays["runs"] (rows of the manifest) and updates them in place
+
+    runs = arrays["runs"][start:stop]
+    runs["status"], runs["reason"], runs["out_mtime"], runs["out_size"] = check_runs(
+        base_file_dir, directory_names(runs), runs["out_mtime"], runs["out_size"], runs["status"], runs["reason"]
+    )
+
+    return 0
+
+
+def refresh_manifest(base_file_dir, max_workers=40, recheck_ok=False, shard=None):
+    """
+    Loads the manifest of the grid (or creates it if it does not exist), adds the centers in centers.txt that are not in the manifest yet
+    and re-checks the runs that are not finished successfully. Runs that are already OK are not touched unless recheck_ok is True, in which
+    case they are stat'ed and re-read only if their .out file changed. The refreshed manifest is written back to the grid directory.
+
+    If shard (i, N) is given only the centers of the shard are checked (see grid_shards.py) and they are written to
+    run_status_manifest_shard<i>of<N>.npy. grid_shards.py merges the shard manifests into the manifest of the grid.
+    """
+
+    centers = read_centers_file(base_file_dir)
+    manifest_file_name = MANIFEST_FILE_NAME
+    previous_manifest_file_names = [MANIFEST_FILE_NAME]
+    if shard is not None:
+        # Imported here because grid_shards.py uses this module
+        from grid_shards import select_shard, shard_name
+        centers = select_shard(base_file_dir, centers, shard)
+        manifest_file_name = f"{shard_name(MANIFEST_FILE_NAME[:-len('.npy')], shard)}.npy"
+        previous_manifest_file_names.append(manifest_file_name)
+
+    manifest = create_manifest(centers)
+    fdirs = directory_names(manifest)
+
+    # Copy the stored state of the centers that are already in the manifest (the shard manifest is newer than the manifest of the grid)
+    for previous_manifest_file_name in previous_manifest_file_names:
+        if not os.path.isfile(f"{base_file_dir}/{previous_manifest_file_name}"):
+            continue
+
+        previous_manifest = read_manifest(base_file_dir, previous_manifest_file_name)
+        previous_rows = find_rows(directory_names(previous_manifest), fdirs)
+        found = previous_rows >= 0
+
+        for column in ["status", "reason", "out_mtime", "out_size"]:
+            # Manifests written before a column was added are refreshed with the default value of that column
+            if column in previous_manifest.dtype.names:
+                manifest[column][found] = previous_manifest[column][previous_rows[found]]
+
+        print(f"{np.sum(found)} of {len(manifest)} centers found in {previous_manifest_file_name}")
+
+    if recheck_ok:
+        to_check = manifest["status"] != STATUS_LOW_HDEN
+    else:
+        to_check = (manifest["status"] != STATUS_LOW_HDEN) & (manifest["status"] != STATUS_OK)
+    indices_to_check = np.flatnonzero(to_check)
+
+    print(f"Checking {len(indices_to_check)} runs")
+
+    progress = Progress(len(indices_to_check), name="Checked:")
+    runs = manifest[indices_to_check]
+
+    if max_workers == 1:
+        check_runs_range({"runs": runs}, 0, len(runs), base_file_dir)
+        progress.add(len(runs))
+    else:
+        # The rows to check are kept in shared memory and the workers update their rows in place (see shared_pool.py)
+        with SharedArrays(inputs={"runs": runs}) as shared:
+            chunks = map_ranges(
+                partial(check_runs_range, base_file_dir=base_file_dir),
+                shared,
+                number_of_rows=len(runs),
+                max_workers=max_workers,
+                number_of_chunks=max_workers,
+            )
+            for start, stop in chunks:
+                progress.add(stop - start)
+            runs = shared.arrays["runs"].copy()
+
+    manifest[indices_to_check] = runs
+
+    with stage("write"):
+        write_manifest(manifest, base_file_dir, manifest_file_name)
+
+    write_summary(base_file_dir, manifest_file_name[:-len(".npy")], progress, max_workers)
+
+    return manifest
+
+
+def print_status_counts(manifest):
+
+    print("Lengths: ")
+    for status, name in STATUS_NAMES.items():
+        print(f"{name}: {np.sum(manifest['status'] == status)}")
+
+    print("Reasons: ")
+    for reason in REASONS:
+        print(f"{reason}: {np.sum(manifest['reason'] == reason)}")
+
+    print(f"len(centers): {len(manifest)}")
+
+    return 0
+
+
+def write_rerun_centers_files(manifest, base_file_dir, shard=None):
+    """
+    Writes the centers of the runs that are not OK into one file per reason (centers_rerun_<reason>.txt) in the centers.txt format. 
+    These files can be given to create_cloudy_directories_and_files.main to resubmit the runs. Low hden runs are not written. With a shard
+    (i, N) the files are named centers_rerun_<reason>_shard<i>of<N>.txt.
+    """
+
+    for reason in REASONS:
+        if reason == REASON_OK:
+            continue
+
+        rows = (manifest["reason"] == reason) & (manifest["status"] != STATUS_LOW_HDEN)
+        fname = f"{base_file_dir}/centers_rerun_{reason}.txt"
+        if shard is not None:
+            from grid_shards import shard_name
+            fname = f"{base_file_dir}/{shard_name(f'centers_rerun_{reason}', shard)}.txt"
+
+        np.savetxt(
+            fname=fname,
+            X=np.column_stack([manifest[column][rows] for column in CENTER_COLUMNS]),
+            fmt="%.5f",
+            header=" ".join(CENTER_COLUMNS),
+        )
+
+        print(f"{np.sum(rows)} centers written to {fname}")
+
+    return 0
+
+
+def ok_runs_mask(base_file_dir, centers):
+    """
+    Returns a boolean array which is True for the centers that are OK in the manifest. Centers that are not in the manifest are False.
+    The manifest is not refreshed here, run refresh_manifest first.
+    """
+
+    manifest = read_manifest(base_file_dir)
+    rows = find_rows(directory_names(manifest), directory_names(centers))
+
+    mask = np.zeros(len(rows), dtype=bool)
+    mask[rows >= 0] = manifest["status"][rows[rows >= 0]] == STATUS_OK
+
+    return mask
+
+
+def failed_runs_mask(manifest):
+    # True for the runs that aborted or finished with warnings. They fail the same way if they are run again with the same .in file, so
+    # run_cloudy_grid.py does not run them unless rerun_failed is True.
+
+    return np.isin(manifest["reason"], [REASON_ABORT, REASON_WARNINGS])
+
+
+if __name__ == "__main__":
+
+    base_file_dir = "/home/m/murray/dtolgay/scratch/cloudy_runs/z_0/cr_1_CO87_CII_H_O3/cr_1_CO87_CII_H_O3_metallicity_minus2_minus3point5"
+
+    from grid_shards import shard_from_argv
+    main(base_file_dir, shard=shard_from_argv())
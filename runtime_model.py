@@ -0,0 +1,279 @@
+# Imports
+import os
+import re
+import json
+import heapq
+import numpy as np
+import pandas as pd
+from time import time
+from concurrent.futures import ProcessPoolExecutor
+
+from run_status_manifest import (
+    read_manifest, refresh_manifest, directory_names, failed_runs_mask, CENTER_COLUMNS, STATUS_OK, STATUS_NOT_STARTED, STATUS_BROKEN
+)
+from out_file_status import read_out_file_tail
+from cloudy_file_readers import read_header, read_columns
+from pack_cloudy_outputs import run_file_source
+
+
+################################################################################
+# Runtime model of the Cloudy runs of a grid.
+#
+# The wall time, number of zones and number of iterations of the finished runs are read from the end of their .out files ("Cloudy ends:
+# 437 zones, 3 iterations, ..." and "ExecTime(s) 123.4"). If ExecTime is not in the .out file the largest value of the time column of the
+# .per file (save performance) is used. The results are written to <base_file_dir>/runtime_performance.csv.
+#
+# log10(wall time) is fitted with a quadratic polynomial of the five log center parameters (least squares). The coefficients are written to
+# <base_file_dir>/runtime_model.json. The predicted wall times are used to sort the unfinished runs longest-first (run_cloudy_grid.py does
+# it when runtime_model.json exists) and to split them into SLURM jobs with the same total predicted wall time (write_job_centers_files).
+################################################################################
+
+# Global variables
+PERFORMANCE_FILE_NAME = "runtime_performance.csv"
+MODEL_FILE_NAME = "runtime_model.json"
+
+MAX_WORKERS = 40
+
+# A quadratic model needs 21 coefficients. With fewer runs a linear model is fitted.
+MIN_RUNS_FOR_QUADRATIC = 100
+
+
+# Main
+def main(base_file_dir, number_of_jobs=10, max_workers=MAX_WORKERS, rerun_failed=False):
+
+    start = time()
+
+    performance = collect_performance(base_file_dir, max_workers)
+    model = fit_runtime_model(performance)
+    write_runtime_model(model, base_file_dir)
+
+    write_job_centers_files(base_file_dir, number_of_jobs, model, rerun_failed=rerun_failed)
+
+    print(f"It took {round((time() - start) / 60, 3)} minutes")
+
+    return 0
+
+
+# Functions
+
+def parse_out_file_tail(tail):
+    # Returns wall time in seconds, number of zones and number of iterations written at the end of the .out file. NaN if not found.
+
+    wall_time, zones, iterations = np.nan, np.nan, np.nan
+
+    match = re.search(r"ExecTime\(s\)\s+([0-9.eE+-]+)", tail)
+    if match is not None:
+        wall_time = float(match.group(1))
+
+    match = re.search(r"Cloudy ends:\s*(\d+)\s+zones?,\s*(\d+)\s+iterations?", tail)
+    if match is not None:
+        zones, iterations = int(match.group(1)), int(match.group(2))
+
+    return wall_time, zones, iterations
+
+
+def read_per_file_wall_time(source):
+    # Largest value of the first column with "time" in its name in the .per file
+
+    header = read_header(source)
+    time_columns = [i for i, column in enumerate(header) if "time" in column.lower()]
+    if len(time_columns) == 0:
+        return np.nan
+
+    values = read_columns(source, columns=time_columns[:1])
+
+    return float(np.max(values)) if len(values) > 0 else np.nan
+
+
+def read_run_performance(base_file_dir, fdir):
+    # Returns (wall time, zones, iterations) of a finished run. Packed runs are read from their shard.
+
+    try:
+        wall_time, zones, iterations = parse_out_file_tail(read_out_file_tail(run_file_source(base_file_dir, fdir, ".out")))
+    except OSError:
+        return np.nan, np.nan, np.nan
+
+    if np.isnan(wall_time):
+        try:
+            wall_time = read_per_file_wall_time(run_file_source(base_file_dir, fdir, ".per"))
+        except Exception as e:
+            print(f"An error occurred while reading {fdir}.per: {e}")
+
+    return wall_time, zones, iterations
+
+
+def read_performance_for_chunk(fdirs, base_file_dir):
+
+    return [read_run_performance(base_file_dir, fdir) for fdir in fdirs]
+
+
+def split_array(array, max_workers):
+    n = len(array)
+    chunk_size = -(
+        -n // max_workers
+    )  # Ceiling division to ensure all rows are included
+
+    # Split the array into chunks and store in an array
+    return [array[i : i + chunk_size] for i in range(0, n, chunk_size)]
+
+
+def collect_performance(base_file_dir, max_workers=MAX_WORKERS):
+    """
+    Reads the performance of the runs that are OK in the manifest (the manifest is refreshed first). Returns a DataFrame with the
+    CENTER_COLUMNS, wall_time [s], zones and iterations, and writes it to <base_file_dir>/runtime_performance.csv.
+    """
+
+    manifest = refresh_manifest(base_file_dir, max_workers=max_workers)
+    manifest = manifest[manifest["status"] == STATUS_OK]
+    fdirs = directory_names(manifest)
+
+    print(f"Reading the performance of {len(fdirs)} OK runs")
+
+    results = []
+    if len(fdirs) > 0:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for chunk_results in executor.map(
+                read_performance_for_chunk, split_array(fdirs, max_workers), [base_file_dir] * max_workers
+            ):
+                results += chunk_results
+
+    performance = pd.DataFrame({column: manifest[column] for column in CENTER_COLUMNS})
+    performance[["wall_time", "zones", "iterations"]] = np.array(results, dtype=float).reshape(-1, 3)
+
+    performance.to_csv(f"{base_file_dir}/{PERFORMANCE_FILE_NAME}", index=False)
+    print(f"File written to {base_file_dir}/{PERFORMANCE_FILE_NAME}")
+
+    return performance
+
+
+def design_matrix(centers, degree):
+    # 1, the log center parameters and (for degree 2) their products
+
+    x = np.column_stack([np.asarray(centers[column], dtype=float) for column in CENTER_COLUMNS])
+
+    columns = [np.ones(len(x))] + [x[:, i] for i in range(x.shape[1])]
+    if degree == 2:
+        columns += [x[:, i] * x[:, j] for i in range(x.shape[1]) for j in range(i, x.shape[1])]
+
+    return np.column_stack(columns)
+
+
+def fit_runtime_model(performance):
+    """
+    Fits log10(wall_time) with a polynomial of the CENTER_COLUMNS. Runs without a wall time are not used. Returns a dictionary with the
+    degree, the coefficients and the rms of the residuals in dex.
+    """
+
+    performance = performance[np.isfinite(performance["wall_time"]) & (performance["wall_time"] > 0)]
+    if len(performance) == 0:
+        raise ValueError("There are no runs with a wall time to fit the runtime model")
+
+    degree = 2 if len(performance) >= MIN_RUNS_FOR_QUADRATIC else 1
+    a = design_matrix(performance, degree)
+    b = np.log10(performance["wall_time"].to_numpy(dtype=float))
+
+    coefficients = np.linalg.lstsq(a, b, rcond=None)[0]
+    rms = float(np.sqrt(np.mean((a @ coefficients - b) ** 2)))
+
+    print(f"Runtime model of degree {degree} is fitted with {len(performance)} runs. rms of the residuals: {rms:.3f} dex")
+
+    return {"degree": degree, "coefficients": coefficients.tolist(), "rms_dex": rms, "number_of_runs": len(performance)}
+
+
+def write_runtime_model(model, base_file_dir):
+
+    with open(f"{base_file_dir}/{MODEL_FILE_NAME}", "w") as file:
+        json.dump(model, file, indent=4)
+
+    print(f"File written to {base_file_dir}/{MODEL_FILE_NAME}")
+
+    return 0
+
+
+def read_runtime_model(base_file_dir):
+    # Returns None if the model is not fitted for this grid
+
+    if not os.path.isfile(f"{base_file_dir}/{MODEL_FILE_NAME}"):
+        return None
+
+    with open(f"{base_file_dir}/{MODEL_FILE_NAME}", "r") as file:
+        return json.load(file)
+
+
+def predict_runtime(model, centers):
+    # Predicted wall time in seconds of each center
+
+    return 10 ** (design_matrix(centers, model["degree"]) @ np.array(model["coefficients"]))
+
+
+def longest_first(predicted_runtimes):
+    # Order of the runs with the longest predicted runtime first. Ties keep the original order.
+
+    return np.argsort(-np.asarray(predicted_runtimes), kind="stable")
+
+
+def pack_into_jobs(predicted_runtimes, number_of_jobs):
+    """
+    Assigns each run to one of number_of_jobs jobs so that the jobs have about the same total predicted runtime (longest processing time
+    first: the runs are taken longest-first and each of them is given to the job with the smallest total so far). Returns the job of each
+    run and the total predicted runtime of each job.
+    """
+
+    jobs = np.zeros(len(predicted_runtimes), dtype=int)
+    heap = [(0.0, job) for job in range(number_of_jobs)]
+
+    for i in longest_first(predicted_runtimes):
+        total, job = heapq.heappop(heap)
+        jobs[i] = job
+        heapq.heappush(heap, (total + predicted_runtimes[i], job))
+
+    totals = np.zeros(number_of_jobs)
+    np.add.at(totals, jobs, predicted_runtimes)
+
+    return jobs, totals
+
+
+def write_job_centers_files(base_file_dir, number_of_jobs, model, cores_per_job=MAX_WORKERS, rerun_failed=False):
+    """
+    Splits the runs that are not started or broken in the manifest into number_of_jobs files centers_job_XXX.txt (centers.txt format) with
+    about the same total predicted runtime. Low hden runs are not run again, so they are not in the files. Runs that aborted or finished
+    with warnings are left out unless rerun_failed is True, the same as in run_cloudy_grid.py (give it the same rerun_failed), so the
+    predicted totals are for the runs the jobs actually run. The centers in every file are sorted longest-first. The files can be given to
+    run_cloudy_grid.py.
+    """
+
+    manifest = read_manifest(base_file_dir)
+    to_run = np.isin(manifest["status"], [STATUS_NOT_STARTED, STATUS_BROKEN])
+    if not rerun_failed:
+        to_run &= ~failed_runs_mask(manifest)
+    manifest = manifest[to_run]
+
+    centers = pd.DataFrame({column: manifest[column] for column in CENTER_COLUMNS})
+    predicted_runtimes = predict_runtime(model, centers)
+    jobs, totals = pack_into_jobs(predicted_runtimes, number_of_jobs)
+
+    for job in range(number_of_jobs):
+        rows = np.flatnonzero(jobs == job)
+        rows = rows[longest_first(predicted_runtimes[rows])]
+
+        fname = f"{base_file_dir}/centers_job_{job:03d}.txt"
+        np.savetxt(
+            fname=fname,
+            X=centers.to_numpy()[rows],
+            fmt="%.5f",
+            header=" ".join(CENTER_COLUMNS),
+        )
+
+        print(
+            f"{len(rows)} centers written to {fname}. Predicted runtime: {totals[job] / 3600:.2f} core hours, "
+            f"{totals[job] / 3600 / cores_per_job:.2f} hours on {cores_per_job} cores"
+        )
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    base_file_dir = "/scratch/m/murray/dtolgay/cloudy_runs/z_0/cr_1_CO87_CII_H_O3/cr_1_CO87_CII_H_O3_metallicity_above_minus_2"
+
+    main(base_file_dir)
@@ -0,0 +1,146 @@
+# Imports
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+from instrumentation import collect_stages, merge_stages
+
+
+################################################################################
+# Pool of worker processes whose input and output arrays are kept in shared memory (multiprocessing.shared_memory), so the centers and the
+# results are not pickled between the processes. Every worker attaches the arrays once when it starts, receives only ranges of rows
+# (start, stop) and writes the results of its rows directly into the shared output. Only the stage timers are sent back to the parent
+# (see instrumentation.py).
+#
+#   with SharedArrays(inputs={"centers": centers}, outputs={"values": ((len(centers), 16), np.float64)}) as shared:
+#       for start, stop in map_ranges(calculate_range, shared, len(centers), max_workers=40, number_of_chunks=160):
+#           values[start:stop] = shared.arrays["values"][start:stop]
+#
+# calculate_range(arrays, start, stop) must be a top level function (or a partial of one) because it is sent to the workers. It reads
+# arrays["centers"][start:stop] and writes arrays["values"][start:stop]. Outputs are filled with NaN (0 for integer types) before the
+# workers start. The shared memory is freed when the with block ends, so copy the results out of shared.arrays before that.
+#
+# An output can be the final table itself, so nothing has to be copied: it is created in the shared memory (outputs, in Fortran order with
+# order="F") or it is a memory map of a .npy file (memmaps, e.g. made by results_store.allocate_table) that every worker opens with r+.
+################################################################################
+
+# Arrays attached by attach_shared_arrays in a worker. The blocks are kept so that the memory stays mapped while the worker lives.
+_arrays = {}
+_blocks = []
+
+
+# Functions
+
+class SharedArrays:
+
+    def __init__(self, inputs=None, outputs=None, memmaps=None, order="C"):
+        """
+        inputs: dictionary name -> array. The arrays are copied to the shared memory.
+        outputs: dictionary name -> (shape, dtype) or (shape, dtype, fill value). The arrays are created in the shared memory in the given
+            order ("C" or "F").
+        memmaps: dictionary name -> memory map of a .npy file (np.lib.format.open_memmap). The workers open the file with mode r+ and write
+            to it directly.
+        The arrays are in self.arrays. self.spec is sent to the workers to attach them.
+        """
+
+        self.blocks = []
+        self.spec = {}
+        self.arrays = {}
+
+        try:
+            for name, array in (inputs or {}).items():
+                array = np.asarray(array)
+                self.create(name, array.shape, array.dtype)[...] = array
+
+            for name, output in (outputs or {}).items():
+                shape, dtype = tuple(output[0]), np.dtype(output[1])
+                fill_value = output[2] if len(output) > 2 else (np.nan if dtype.kind in "fc" else 0)
+                self.create(name, shape, dtype, order)[...] = fill_value
+
+            for name, memmap in (memmaps or {}).items():
+                self.spec[name] = {"file": memmap.filename}
+                self.arrays[name] = memmap
+        except Exception:
+            self.close()
+            raise
+
+    def create(self, name, shape, dtype, order="C"):
+
+        # A block can not be empty
+        block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+        self.blocks.append(block)
+
+        self.spec[name] = {"block": block.name, "shape": shape, "dtype": dtype, "order": order}
+        self.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf, order=order)
+
+        return self.arrays[name]
+
+    def close(self):
+        # Frees the shared memory. Views of self.arrays that are still referenced keep their mapping until they are deleted.
+
+        self.arrays = {}
+        for block in self.blocks:
+            try:
+                block.close()
+            except BufferError:
+                pass
+            block.unlink()
+        self.blocks = []
+
+        return 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def attach_shared_arrays(spec):
+    # Initializer of the workers
+
+    for name, array_spec in spec.items():
+        if "file" in array_spec:
+            _arrays[name] = np.load(array_spec["file"], mmap_mode="r+")
+            continue
+
+        block = shared_memory.SharedMemory(name=array_spec["block"])
+        _blocks.append(block)
+        _arrays[name] = np.ndarray(array_spec["shape"], dtype=array_spec["dtype"], buffer=block.buf, order=array_spec["order"])
+
+
+def call_with_shared_arrays(function, start, stop):
+
+    return function(_arrays, start, stop)
+
+
+def split_ranges(number_of_rows, number_of_chunks):
+    # (start, stop) of number_of_chunks ranges that cover the rows
+
+    chunk_size = max(-(-number_of_rows // number_of_chunks), 1)  # Ceiling division to ensure all rows are included
+
+    return [(start, min(start + chunk_size, number_of_rows)) for start in range(0, number_of_rows, chunk_size)]
+
+
+def map_ranges(function, shared, number_of_rows, max_workers, number_of_chunks):
+    """
+    Calls function(arrays, start, stop) for number_of_chunks ranges of the rows in max_workers processes and yields (start, stop) of the
+    ranges in order as soon as they are finished. If max_workers is 1 the function is called in this process. The stage timers of the
+    workers are added to the timers of this process.
+    """
+
+    ranges = split_ranges(number_of_rows, number_of_chunks)
+
+    if max_workers == 1:
+        for start, stop in ranges:
+            function(shared.arrays, start, stop)
+            yield start, stop
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=attach_shared_arrays, initargs=(shared.spec,)) as executor:
+        futures = [executor.submit(collect_stages, call_with_shared_arrays, function, start, stop) for start, stop in ranges]
+
+        for (start, stop), future in zip(ranges, futures):
+            result, stages = future.result()
+            merge_stages(stages)
+            yield start, stop